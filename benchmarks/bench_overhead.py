@@ -0,0 +1,252 @@
+"""
+Measure the overhead of pytainer itself, offline.
+
+A stub apptainer executable with a configurable latency and output size is
+put first on PATH, so that the time spent in pytainer (option building,
+command assembly, process spawn and result wrapping) can be compared with
+spawning the stub directly.
+
+The "direct" and "exec" modes are also timed with each backend of
+pytainer.backends, e.g. "exec:posix_spawn". `--rss-mb` grows the resident
+memory of the benchmark first, to show how launches scale with the size of
+the parent process. "exec:fake" runs against the in-process FakeBackend
+with the same latency and output size, so its overhead is the one of
+pytainer alone.
+
+Usage:
+    python benchmarks/bench_overhead.py [--calls N] [--latency SECONDS]
+        [--output-size BYTES] [--concurrency 1,8,32] [--rss-mb MB]
+        [--json FILE]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytainer  # noqa: E402
+from pytainer.backends import BACKENDS  # noqa: E402
+from pytainer.fake import FakeBackend  # noqa: E402
+from pytainer.utils import CommandHandler, flatten  # noqa: E402
+
+STUB = """#!/bin/sh
+[ "$PYTAINER_BENCH_LATENCY" != 0 ] && sleep "$PYTAINER_BENCH_LATENCY"
+head -c "$PYTAINER_BENCH_OUTPUT_SIZE" /dev/zero
+"""
+
+
+def install_stub(directory, latency, output_size):
+    """Put the stub apptainer first on PATH."""
+    path = os.path.join(directory, "apptainer")
+    with open(path, "w") as fo:
+        fo.write(STUB)
+    os.chmod(path, 0o755)
+    os.environ["PATH"] = f"{directory}{os.pathsep}{os.environ['PATH']}"
+    os.environ["PYTAINER_BENCH_LATENCY"] = str(latency)
+    os.environ["PYTAINER_BENCH_OUTPUT_SIZE"] = str(output_size)
+    return path
+
+
+def make_options():
+    options = pytainer.PytainerOptionsExec()
+    options.cleanenv()
+    options.bind("/data", "/mnt/data", "ro")
+    options.env("OMP_NUM_THREADS", "4")
+    options.env("GREETING", "hello world")
+    options.workdir("/tmp")
+    return options
+
+
+def bench_micro(number=20000):
+    """Time the pure Python steps of a call, in microseconds per call."""
+    pytnr = pytainer.Pytainer("image.sif")
+    options = make_options()
+    command = pytnr.plan_exec("echo hello", options).command
+    completed = subprocess.CompletedProcess(command, 0, "", "")
+    steps = {
+        "options": make_options,
+        "to_argv": options.to_argv,
+        "flatten": lambda: flatten(command),
+        "plan": lambda: pytnr.plan_exec("echo hello", options),
+        "result": lambda: CommandHandler(command, result=completed),
+    }
+    return {
+        name: timeit.timeit(step, number=number) / number * 1e6
+        for name, step in steps.items()
+    }
+
+
+def run_direct(stub, calls):
+    for _ in range(calls):
+        subprocess.run([stub], capture_output=True)
+
+
+def run_backend(backend, stub, calls):
+    for _ in range(calls):
+        backend.run([stub])
+
+
+def run_exec(pytnr, options, calls):
+    for _ in range(calls):
+        pytnr.exec("echo hello", options)
+
+
+def run_launch(pytnr, options, calls, concurrency):
+    plan = pytnr.plan_exec("echo hello", options)
+    for start in range(0, calls, concurrency):
+        futures = [plan.launch() for _ in range(min(concurrency, calls - start))]
+        for future in futures:
+            future.result()
+
+
+def run_map(pytnr, options, calls, concurrency):
+    commands = ["echo hello"] * calls
+    for _ in pytnr.map(commands, options, max_workers=concurrency):
+        pass
+
+
+def run_async(pytnr, options, calls, concurrency):
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call():
+            async with semaphore:
+                await pytnr.exec_async("echo hello", options)
+
+        await asyncio.gather(*(call() for _ in range(calls)))
+
+    asyncio.run(main())
+
+
+def run_stream(pytnr, options, calls):
+    for _ in range(calls):
+        stream = pytnr.exec_stream("echo hello", options, binary=True)
+        with stream:
+            for _ in stream:
+                pass
+
+
+def measure(fn, calls):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    return {"us_per_call": elapsed / calls * 1e6, "calls_per_s": calls / elapsed}
+
+
+def bench_modes(stub, calls, concurrency_levels, latency=0, output_size=0):
+    """Time every execution mode end to end."""
+    pytnr = pytainer.Pytainer("image.sif")
+    options = make_options()
+    modes = {
+        "direct": measure(lambda: run_direct(stub, calls), calls),
+        "exec": measure(lambda: run_exec(pytnr, options, calls), calls),
+        "stream": measure(lambda: run_stream(pytnr, options, calls), calls),
+    }
+    for name, backend_class in BACKENDS.items():
+        if name == "subprocess":
+            continue
+        if backend_class is FakeBackend:
+            backend = FakeBackend(latency=latency, output_size=output_size)
+        else:
+            backend = backend_class()
+            modes[f"direct:{name}"] = measure(
+                lambda: run_backend(backend, stub, calls), calls
+            )
+        pytnr_backend = pytainer.Pytainer("image.sif", backend=backend)
+        modes[f"exec:{name}"] = measure(
+            lambda: run_exec(pytnr_backend, options, calls), calls
+        )
+    for concurrency in concurrency_levels:
+        for name, fn in [
+            ("launch", run_launch),
+            ("map", run_map),
+            ("async", run_async),
+        ]:
+            modes[f"{name}[{concurrency}]"] = measure(
+                lambda: fn(pytnr, options, calls, concurrency), calls
+            )
+    direct = modes["direct"]["us_per_call"]
+    for mode in modes.values():
+        mode["overhead_us"] = mode["us_per_call"] - direct
+    return modes
+
+
+def grow_rss(megabytes):
+    """Return a buffer of `megabytes` MiB whose pages are all resident."""
+    ballast = bytearray(megabytes << 20)
+    ballast[::4096] = b"\x01" * len(range(0, len(ballast), 4096))
+    return ballast
+
+
+def bench_memory(calls):
+    """Return the memory kept per exec result, in bytes."""
+    pytnr = pytainer.Pytainer("image.sif")
+    options = make_options()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    results = [pytnr.exec("echo hello", options) for _ in range(calls)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return (after - before) / calls
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--output-size", type=int, default=1024)
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--rss-mb", type=int, default=0)
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args(argv)
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+
+    ballast = grow_rss(args.rss_mb)  # noqa: F841
+    environ = dict(os.environ)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            stub = install_stub(directory, args.latency, args.output_size)
+            report = {
+                "config": vars(args),
+                "micro_us": bench_micro(),
+                "modes": bench_modes(
+                    stub,
+                    args.calls,
+                    concurrency_levels,
+                    args.latency,
+                    args.output_size,
+                ),
+                "bytes_per_result": bench_memory(args.calls),
+            }
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+
+    print("Pure Python steps (us/call):")
+    for name, value in report["micro_us"].items():
+        print(f"  {name:<12} {value:10.2f}")
+    print("Execution modes:")
+    print(f"  {'mode':<20} {'us/call':>10} {'calls/s':>10} {'overhead':>10}")
+    for name, mode in report["modes"].items():
+        print(
+            f"  {name:<20} {mode['us_per_call']:10.1f} {mode['calls_per_s']:10.1f}"
+            f" {mode['overhead_us']:10.1f}"
+        )
+    print(f"Memory per result: {report['bytes_per_result']:.0f} bytes")
+    if args.json:
+        with open(args.json, "w") as fo:
+            json.dump(report, fo, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
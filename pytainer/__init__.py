@@ -6,3 +6,27 @@ from .pytainer import (
     PytainerOptionsExec,
     PytainerOptionsInspect,
 )
+from .utils import (
+    CaptureOptions,
+    CommandHandler,
+    CommandPlan,
+    CommandFuture,
+    CommandStream,
+    AsyncCommandStream,
+    PytainerBatchError,
+)
+from .store import ImageStore
+from .metadata import ImageMetadata, MetadataCache
+from .sif import SIFImage, SIFDescriptor, SIFPartition
+from .definition import Definition
+from .buildcache import BuildCache
+from .buildgraph import BuildGraph, BuildGraphResult
+from .capabilities import Capabilities, capabilities
+from .tracing import TraceRecord
+from .metrics import MetricsRegistry
+from .scheduler import ResourceScheduler, Topology
+from .pool import InstancePool
+from .batching import CommandBatcher
+from .resultcache import ResultCache
+from .backends import PosixSpawnBackend, SubprocessBackend
+from .fake import FakeBackend
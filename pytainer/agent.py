@@ -0,0 +1,414 @@
+"""
+Command agent running inside an instance.
+
+`apptainer exec instance://name` still starts the apptainer runtime and joins
+the namespaces of the instance for every command. The agent is started once
+with such an exec and then runs the commands it receives on a Unix socket,
+in a directory bound into the instance, so that each command only costs a
+local round trip.
+
+Commands run as `apptainer exec` would run them: with the environment of the
+caller, as it is when the command is sent, and in its working directory.
+The agent inherited the environment of the caller when it started, so each
+request carries the variables set or changed since then, and those unset.
+
+Protocol: the client sends one JSON line {"argv": [...], "env": {...},
+"unset": [...], "cwd": ...} per connection. The agent answers with frames made of a kind
+byte, the length of the payload as a 32-bit big-endian integer and the
+payload: b"o" for stdout, b"e" for stderr and finally b"x" with the return
+code in ASCII. Closing the connection kills the command. The agent exits
+when its stdin is closed.
+"""
+
+import asyncio
+import json
+import os
+import select
+import shutil
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+
+from . import tracing
+from .utils import DEFAULT_CAPTURE, CommandHandler, CommandPlan
+
+FRAME = struct.Struct("!cI")
+
+# Source of the agent. It runs with the Python of the image, so it sticks to
+# the standard library and to syntax supported by Python 3.6.
+AGENT_SOURCE = r"""
+import json
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+FRAME = struct.Struct("!cI")
+
+
+def send(conn, kind, data):
+    conn.sendall(FRAME.pack(kind, len(data)) + data)
+
+
+def handle(conn):
+    process = None
+    try:
+        request = json.loads(conn.makefile("rb").readline())
+        env = dict(os.environ)
+        env.update(request.get("env") or {})
+        for name in request.get("unset") or []:
+            env.pop(name, None)
+        cwd = request.get("cwd")
+        if cwd is not None and not os.path.isdir(cwd):
+            # As apptainer, stay in the current directory if it is not bound
+            cwd = None
+        argv = request["argv"]
+        try:
+            process = subprocess.Popen(
+                argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                cwd=cwd,
+            )
+        except OSError as e:
+            send(conn, b"e", ("%s: %s\n" % (argv[0], e.strerror)).encode())
+            code = b"127" if isinstance(e, FileNotFoundError) else b"126"
+            send(conn, b"x", code)
+            return
+        kinds = {process.stdout: b"o", process.stderr: b"e"}
+        selector = selectors.DefaultSelector()
+        for pipe in kinds:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, 65536)
+                if data:
+                    send(conn, kinds[key.fileobj], data)
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+        send(conn, b"x", str(process.wait()).encode())
+    except (OSError, ValueError, KeyError):
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+    finally:
+        conn.close()
+
+
+def watch_stdin():
+    while sys.stdin.buffer.read(65536):
+        pass
+    os._exit(0)
+
+
+def main(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        os.unlink(path)
+    server.bind(path)
+    server.listen(128)
+    threading.Thread(target=watch_stdin, daemon=True).start()
+    sys.stdout.write("ready\n")
+    sys.stdout.flush()
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+main(sys.argv[1])
+"""
+
+
+class AgentError(OSError):
+    """Raised when the connection to the agent breaks."""
+
+
+class AgentUnavailable(AgentError):
+    """Raised when the agent cannot be reached, before the command started."""
+
+
+class AgentClient:
+    """
+    Client of an agent listening on `socket_path`.
+
+    Args:
+    socket_path (str): Path of the socket on the host.
+    process (Popen): The `apptainer exec` running the agent, if started by
+        `start_agent`.
+    directory (str): Directory of the socket, removed by `close` if given.
+    environ (dict): Environment the agent was started with, defaults to the
+        current one.
+    """
+
+    def __init__(self, socket_path, process=None, directory=None, environ=None):
+        self.socket_path = socket_path
+        self.process = process
+        self.directory = directory
+        self.environ = dict(os.environ) if environ is None else environ
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.socket_path!r})"
+
+    def alive(self):
+        return self.process is None or self.process.poll() is None
+
+    def environment(self, env=None):
+        """
+        Return the variables to set and those to unset in the environment of
+        the agent for a command to get the current environment, updated with
+        `env`.
+        """
+        current = {**os.environ, **(env or {})}
+        changed = {
+            name: value
+            for name, value in current.items()
+            if self.environ.get(name) != value
+        }
+        return changed, [name for name in self.environ if name not in current]
+
+    def connect(self, argv, env=None, cwd=None):
+        """
+        Send the request to run `argv` with `env` on top of the current
+        environment, in `cwd`, by default the current working directory.
+
+        Returns:
+        socket: The connection, to be passed to `frames`.
+
+        Raises:
+        AgentUnavailable: If the agent cannot be reached.
+        """
+        env, unset = self.environment(env)
+        request = json.dumps(
+            {"argv": argv, "env": env, "unset": unset, "cwd": cwd or os.getcwd()}
+        )
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(self.socket_path)
+            conn.sendall(request.encode() + b"\n")
+        except OSError as e:
+            conn.close()
+            raise AgentUnavailable(e.errno, f"Cannot reach agent: {e.strerror}")
+        return conn
+
+    def frames(self, argv, env=None, cwd=None, conn=None):
+        """
+        Run `argv` and yield the (kind, payload) frames of the agent, where
+        kind is "stdout", "stderr" or "exit". The payload of "exit" is the
+        return code.
+
+        Args:
+        conn (socket): Connection returned by `connect`, on which the request
+            was already sent, in which case the other arguments are ignored.
+
+        Raises:
+        AgentUnavailable: If the agent cannot be reached.
+        AgentError: If the connection breaks while the command runs.
+        """
+        if conn is None:
+            conn = self.connect(argv, env, cwd)
+        try:
+            reader = conn.makefile("rb")
+            while True:
+                header = reader.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    raise AgentError("Connection to the agent closed unexpectedly")
+                kind, size = FRAME.unpack(header)
+                payload = reader.read(size)
+                if kind == b"x":
+                    yield "exit", int(payload)
+                    return
+                yield ("stdout" if kind == b"o" else "stderr"), payload
+        finally:
+            conn.close()
+
+    def run(
+        self,
+        argv,
+        env=None,
+        cwd=None,
+        capture=DEFAULT_CAPTURE,
+        span=None,
+        conn=None,
+    ):
+        """
+        Run `argv` in the instance and return its CompletedProcess, with the
+        output as bytes. See `frames` for the arguments.
+
+        Raises:
+        AgentUnavailable: If the agent cannot be reached.
+        AgentError: If the connection breaks while the command runs.
+        """
+        output = {"stdout": [], "stderr": []}
+        sizes = {"stdout": 0, "stderr": 0}
+        returncode = None
+        for kind, payload in self.frames(argv, env, cwd, conn):
+            if kind == "exit":
+                returncode = payload
+                break
+            if span is not None and "first_output" not in span.phases:
+                span.mark("first_output")
+            sizes[kind] += len(payload)
+            if capture.limit is not None:
+                kept = sizes[kind] - len(payload)
+                payload = payload[: max(capture.limit - kept, 0)]
+            if payload:
+                output[kind].append(payload)
+        if span is not None:
+            span.stdout_bytes += sizes["stdout"]
+            span.stderr_bytes += sizes["stderr"]
+        return subprocess.CompletedProcess(
+            args=argv,
+            stdout=b"".join(output["stdout"]) if capture.stdout else None,
+            stderr=b"".join(output["stderr"]) if capture.stderr else None,
+            returncode=returncode,
+        )
+
+    def close(self):
+        """Stop the agent and remove its directory."""
+        if self.process is not None:
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process.stdout.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def agent_directory():
+    """Return a new private directory for the socket of an agent."""
+    return tempfile.mkdtemp(prefix="pytainer-agent-")
+
+
+def start_agent(instance, directory, python="python3", timeout=30):
+    """
+    Start an agent in `instance`, listening in `directory`, which must be
+    bound at the same path in the instance.
+
+    Returns:
+    AgentClient: The client of the agent.
+
+    Raises:
+    AgentError: If the agent does not start within `timeout` seconds.
+    """
+    socket_path = os.path.join(directory, "agent.sock")
+    environ = dict(os.environ)
+    argv = [
+        "apptainer",
+        "exec",
+        f"instance://{instance}",
+        python,
+        "-c",
+        AGENT_SOURCE,
+        socket_path,
+    ]
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError as e:
+        raise AgentError(e.errno, f"Cannot start agent: {e.strerror}")
+    deadline = time.monotonic() + timeout
+    line = b""
+    while not line.endswith(b"\n"):
+        remaining = deadline - time.monotonic()
+        ready, _, _ = select.select([process.stdout], [], [], max(remaining, 0))
+        data = os.read(process.stdout.fileno(), 64) if ready else b""
+        if not data:
+            process.kill()
+            process.wait()
+            process.stdin.close()
+            process.stdout.close()
+            raise AgentError(f"Agent did not start in instance {instance}")
+        line += data
+    return AgentClient(
+        socket_path, process=process, directory=directory, environ=environ
+    )
+
+
+class AgentPlan(CommandPlan):
+    """
+    Plan of an exec that is run through the agent of an instance.
+
+    `run` and `run_async` go through the agent, with the current environment
+    and working directory of the caller unless the options set them, and fall
+    back to the equivalent `apptainer exec` if the agent cannot be reached. If the
+    connection breaks while the command runs, the command is not retried and
+    its result has the return code 255. `launch` and `stream` always run the
+    `apptainer exec` command of the plan.
+    """
+
+    def __init__(self, plan, agent, argv, env=None, cwd=None):
+        super().__init__(
+            plan.command,
+            subcommand=plan.subcommand,
+            image=plan.image,
+            capture=plan.capture,
+            backend=plan.backend,
+        )
+        self.phases = plan.phases
+        self.agent = agent
+        self.argv = argv
+        self.env = env
+        self.cwd = cwd
+
+    def run(self):
+        try:
+            conn = self.agent.connect(self.argv, self.env, self.cwd)
+        except AgentUnavailable:
+            # Only the fallback is traced
+            return super().run()
+        span = tracing.start(self)
+        if span is not None:
+            span.mark("spawn")
+        try:
+            result = self.agent.run(
+                self.argv, capture=self.capture, span=span, conn=conn
+            )
+        except AgentError as e:
+            result = subprocess.CompletedProcess(
+                args=self.argv, stdout=b"", stderr=f"FATAL:   {e}\n", returncode=255
+            )
+        if span is not None:
+            span.mark("exit")
+        handler = CommandHandler(self.command, result=result, text=self.capture.text)
+        if span is not None:
+            span.mark("decode")
+            span.finish(handler.returncode)
+        return handler
+
+    async def run_async(self):
+        return await asyncio.to_thread(self.run)
+
+
+def agent_request(options):
+    """
+    Return the (env, cwd) of exec `options` if the agent can honour them, that
+    is if they only set environment variables and the working directory,
+    otherwise None.
+    """
+    env, cwd = {}, None
+    for tokens in options.options:
+        if tokens[0] == "--env" and len(tokens) == 2 and "," not in tokens[1]:
+            name, sep, value = tokens[1].partition("=")
+            if not sep:
+                return None
+            env[name] = value
+        elif tokens[0] == "--pwd" and len(tokens) == 2:
+            cwd = tokens[1]
+        else:
+            return None
+    return env, cwd
@@ -0,0 +1,256 @@
+"""
+Backends starting the processes of command plans.
+
+A backend runs the commands given to it, as argv lists, or as strings with
+shell syntax, with four methods:
+
+- `run(command, capture, span)` runs a command to completion and returns its
+  CompletedProcess, with bytes output.
+- `run_async(command, capture, span)` is its coroutine counterpart.
+- `spawn(command, capture)` starts a command and returns a Popen-like
+  process, whose stdout and stderr are pipes or None, as selected by
+  `capture`.
+- `spawn_async(command)` starts a command and returns an asyncio
+  Process-like process, whose stdout and stderr are StreamReaders.
+
+The `span` of `run` is the tracing.Span of the command, or None, whose
+"spawn", "first_output" and "exit" phases and output bytes are recorded by
+the backend. See pytainer.fake for a backend that does not start processes.
+"""
+
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from .fake import FakeBackend
+from .utils import (
+    DEFAULT_CAPTURE,
+    pipes,
+    read_output,
+    run_command,
+    run_command_async,
+    spawn_error,
+)
+
+# Signals that Python ignores and that subprocess restores in the child.
+RESTORED_SIGNALS = tuple(
+    getattr(signal, name)
+    for name in ("SIGPIPE", "SIGXFZ", "SIGXFSZ")
+    if hasattr(signal, name)
+)
+
+
+class SubprocessBackend:
+    """Start processes with subprocess, the default."""
+
+    name = "subprocess"
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}()"
+
+    def run(self, command, capture=DEFAULT_CAPTURE, span=None):
+        return run_command(command, capture, span)
+
+    async def run_async(self, command, capture=DEFAULT_CAPTURE, span=None):
+        return await run_command_async(command, capture, span)
+
+    def spawn(self, command, capture=DEFAULT_CAPTURE):
+        if isinstance(command, str):
+            return subprocess.Popen(command, shell=True, **pipes(capture))
+        return subprocess.Popen(command, **pipes(capture))
+
+    async def spawn_async(self, command):
+        streams = {
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": asyncio.subprocess.PIPE,
+        }
+        if isinstance(command, str):
+            return await asyncio.create_subprocess_shell(command, **streams)
+        return await asyncio.create_subprocess_exec(*command, **streams)
+
+
+class PosixSpawnBackend(SubprocessBackend):
+    """
+    Start processes with os.posix_spawnp.
+
+    The C library starts the child with vfork or clone(CLONE_VFORK), so the
+    cost of a launch does not grow with the memory of the parent, which
+    matters for long-lived processes with a large resident set. The child
+    inherits the environment, stdin and the inheritable file descriptors of
+    the parent. A command given as a string is run by /bin/sh. Coroutines
+    use the subprocess machinery of asyncio.
+    """
+
+    name = "posix_spawn"
+
+    def run(self, command, capture=DEFAULT_CAPTURE, span=None):
+        try:
+            process = self.spawn(command, capture)
+        except OSError as e:
+            return spawn_error(command, e)
+        if span is not None:
+            span.mark("spawn")
+        stdout, stderr = read_output(process, span, capture.limit)
+        process.wait()
+        if span is not None:
+            span.mark("exit")
+        return subprocess.CompletedProcess(
+            args=command, stdout=stdout, stderr=stderr, returncode=process.returncode
+        )
+
+    def spawn(self, command, capture=DEFAULT_CAPTURE):
+        """
+        Start a command.
+
+        Returns:
+        SpawnedProcess: The process.
+
+        Raises:
+        OSError: If the command cannot be executed.
+        """
+        argv = ["/bin/sh", "-c", command] if isinstance(command, str) else command
+        actions = []
+        readers = []
+        writers = []
+        try:
+            for fd, captured in ((1, capture.stdout), (2, capture.stderr)):
+                if captured:
+                    reader, writer = os.pipe()
+                    readers.append(reader)
+                    writers.append(writer)
+                    actions.append((os.POSIX_SPAWN_DUP2, writer, fd))
+                else:
+                    readers.append(None)
+                    actions.append(
+                        (os.POSIX_SPAWN_OPEN, fd, os.devnull, os.O_WRONLY, 0)
+                    )
+            pid = os.posix_spawnp(
+                argv[0],
+                argv,
+                os.environ,
+                file_actions=actions,
+                setsigdef=RESTORED_SIGNALS,
+            )
+        except BaseException:
+            for reader in readers:
+                if reader is not None:
+                    os.close(reader)
+            raise
+        finally:
+            for writer in writers:
+                os.close(writer)
+        stdout, stderr = (
+            None if reader is None else open(reader, "rb") for reader in readers
+        )
+        return SpawnedProcess(command, pid, stdout, stderr)
+
+
+class SpawnedProcess:
+    """
+    Handle on a process started by PosixSpawnBackend, with the subset of the
+    Popen interface used by pytainer.
+    """
+
+    def __init__(self, args, pid, stdout=None, stderr=None):
+        self.args = args
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self._waitpid_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} pid={self.pid} "
+            f"returncode={self.returncode}>"
+        )
+
+    def _waitpid(self, blocking):
+        if not self._waitpid_lock.acquire(blocking):
+            # Another thread is waiting for the process
+            return None
+        try:
+            if self.returncode is None:
+                try:
+                    pid, status = os.waitpid(self.pid, 0 if blocking else os.WNOHANG)
+                except ChildProcessError:
+                    # Reaped elsewhere, e.g. SIGCHLD is ignored, as Popen does
+                    pid, status = self.pid, 0
+                if pid == self.pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+            return self.returncode
+        finally:
+            self._waitpid_lock.release()
+
+    def poll(self):
+        return self._waitpid(False)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the process to exit and return its return code.
+
+        Raises:
+        subprocess.TimeoutExpired: If it is still running after `timeout`
+            seconds.
+        """
+        if timeout is None:
+            while self.returncode is None:
+                self._waitpid(True)
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while self.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
+
+    def communicate(self):
+        """Read stdout and stderr until they are closed and wait for the exit."""
+        output = read_output(self)
+        self.wait()
+        return output
+
+    def send_signal(self, sig):
+        self.poll()
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (SubprocessBackend, PosixSpawnBackend, FakeBackend)
+}
+
+
+def get_backend(backend):
+    """
+    Return the backend named `backend`, one of BACKENDS, or `backend` itself
+    if it is already a backend, or None.
+
+    Raises:
+    ValueError: If there is no backend of this name.
+    """
+    if not isinstance(backend, str):
+        return backend
+    try:
+        return BACKENDS[backend]()
+    except KeyError:
+        raise ValueError(
+            f"backend must be one of {tuple(BACKENDS)}, not {backend!r}"
+        ) from None
+
@@ -0,0 +1,207 @@
+"""
+Batching of small commands into a single container invocation.
+
+Commands queued for the same target and options are run one after the other
+by a driver script within one `apptainer exec`. After each command, the
+driver writes on stdout and on stderr a delimiter made of a newline, a
+random token, the index of the command, its return code and a newline, so
+that the output of the batch can be split back into one result per command.
+"""
+
+import re
+import shlex
+import subprocess
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .pytainer import DEFAULT_EXEC_OPTIONS
+from .utils import DEFAULT_CAPTURE, CaptureOptions, CommandHandler, split_command
+
+# The output of the driver is split as bytes, and kept in full since the
+# delimiters carry the return codes.
+DRIVER_CAPTURE = CaptureOptions(text=False)
+
+# Runs each of "$@", an argv quoted for the shell, by executing it in a
+# subshell as apptainer exec would, and without stdin so that a command
+# cannot swallow the rest of the batch.
+DRIVER = r"""
+t=$1
+shift
+i=0
+for c in "$@"; do
+    (eval "exec $c") </dev/null
+    r=$?
+    printf '\n%s %d %d\n' "$t" "$i" "$r"
+    printf '\n%s %d %d\n' "$t" "$i" "$r" >&2
+    i=$((i + 1))
+done
+"""
+
+
+class CommandBatcher:
+    """
+    Group the commands submitted within `linger` seconds for the same target
+    and options into batches of at most `batch_size` commands, each run by a
+    single `apptainer exec`.
+
+    Commands run in a POSIX shell of the image, one after the other, so a
+    batch takes as long as its commands together: batching trades the
+    latency of each command for the start-up cost of the container.
+
+    Args:
+    pytainer (Pytainer): Runs the batches, on its image or instance.
+    batch_size (int): Maximum number of commands per batch.
+    linger (float): Seconds to wait for more commands before running an
+        incomplete batch.
+    max_workers (int): Maximum number of batches running concurrently.
+    """
+
+    def __init__(self, pytainer, batch_size=64, linger=0.01, max_workers=4):
+        self.pytainer = pytainer
+        self.batch_size = batch_size
+        self.linger = linger
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} batch_size={self.batch_size} "
+            f"linger={self.linger}>"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, command, options=DEFAULT_EXEC_OPTIONS):
+        """
+        Queue a command.
+
+        Returns:
+        Future: Resolves to the CommandHandler of the command.
+
+        Raises:
+        RuntimeError: If the batcher is closed.
+        """
+        options = options.freeze()
+        key = (self.pytainer._target(), options)
+        future = Future()
+        ready = None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Cannot submit commands after close")
+            batch = self._pending.setdefault(key, [])
+            batch.append((split_command(command), future))
+            if len(batch) >= self.batch_size:
+                ready = self._pending.pop(key)
+            elif len(batch) == 1:
+                timer = threading.Timer(self.linger, self._expire, (key, batch))
+                timer.daemon = True
+                timer.start()
+        if ready is not None:
+            self._executor.submit(self._run, key, ready)
+        return future
+
+    def exec(self, command, options=DEFAULT_EXEC_OPTIONS):
+        """Run a command as part of a batch and return its CommandHandler."""
+        return self.submit(command, options).result()
+
+    def map(self, commands, options=DEFAULT_EXEC_OPTIONS):
+        """Run commands in batches, returning the results in order."""
+        futures = [self.submit(command, options) for command in commands]
+        self.flush()
+        return [future.result() for future in futures]
+
+    def _expire(self, key, batch):
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+            del self._pending[key]
+            if self._closed:
+                return
+        self._executor.submit(self._run, key, batch)
+
+    def flush(self):
+        """Start the pending batches without waiting for `linger`."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for key, batch in pending.items():
+            self._executor.submit(self._run, key, batch)
+
+    def close(self):
+        """Run the pending batches and wait for all batches to complete."""
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+        for key, batch in pending.items():
+            self._executor.submit(self._run, key, batch)
+        self._executor.shutdown(wait=True)
+
+    def _run(self, key, batch):
+        futures = [f for _, f in batch if f.set_running_or_notify_cancel()]
+        argvs = [argv for argv, f in batch if f in futures]
+        if not futures:
+            return
+        _, options = key
+        try:
+            token = uuid.uuid4().hex
+            commands = [shlex.join(argv) for argv in argvs]
+            driver = ["sh", "-c", DRIVER, "sh", token, *commands]
+            plan = self.pytainer.plan_exec(driver, options)
+            capture, plan.capture = plan.capture, DRIVER_CAPTURE
+            results = split_batch(
+                plan.run(),
+                token,
+                [self.pytainer.plan_exec(argv, options).command for argv in argvs],
+                capture,
+            )
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+
+def split_batch(batch, token, commands, capture=DEFAULT_CAPTURE):
+    """
+    Split the result of a batch into the CommandHandler of each command.
+
+    Commands that the batch did not get to, e.g. because the container could
+    not start, get the return code of the batch, or 255, and the remaining
+    stderr of the batch goes to the first of them.
+
+    Args:
+    batch (CommandHandler): Result of the driver, with bytes output.
+    token (str): Token of the delimiters.
+    commands (list): Command of each result.
+    capture (CaptureOptions): How the output of each command is kept.
+    """
+    stdout, stderr = batch.stdout or b"", batch.stderr or b""
+    delimiter = re.compile(rb"\n" + token.encode() + rb" (\d+) (-?\d+)\n")
+    stdouts = delimiter.split(stdout)
+    stderrs = delimiter.split(stderr)
+    results = []
+    for index, command in enumerate(commands):
+        if 3 * index + 2 < len(stdouts):
+            out = stdouts[3 * index]
+            returncode = int(stdouts[3 * index + 2])
+            err = stderrs[3 * index] if 3 * index < len(stderrs) else b""
+        else:
+            first = 3 * index == len(stdouts) - 1
+            out = stdouts[-1] if first else b""
+            err = stderrs[-1] if first else b""
+            returncode = batch.returncode or 255
+        completed = subprocess.CompletedProcess(
+            args=command,
+            stdout=out[: capture.limit] if capture.stdout else None,
+            stderr=err[: capture.limit] if capture.stderr else None,
+            returncode=returncode,
+        )
+        results.append(CommandHandler(command, result=completed, text=capture.text))
+    return results
@@ -0,0 +1,133 @@
+import glob
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from .definition import Definition
+from .store import file_digest, place_file
+from .utils import make_result
+
+# Build options that do not change the built image.
+IGNORED_OPTIONS = {
+    "--force",
+    "--no-cleanup",
+    "--disable-cache",
+    "--warn-unused-build-args",
+}
+
+
+class BuildCache:
+    """
+    Cache of built images keyed by the inputs of the build.
+
+    The key is the sha256 of the definition file, of the local images it
+    bootstraps from, of the files copied by its %files sections, of the
+    build argument files and of the build options that affect the image.
+    Remote bootstrap sources are keyed by their URI as written in the
+    definition file. Sandbox builds are not cached.
+
+    Args:
+    root (str): Directory of the cache, created if needed.
+    link (str): How cached images are placed at the requested path, see
+        ImageStore.
+    """
+
+    def __init__(self, root, link="hardlink"):
+        self.root = os.path.abspath(root)
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.root!r})"
+
+    def key(self, definition_file, options):
+        """Return the cache key of a build."""
+        definition = Definition.from_file(definition_file)
+        digest = hashlib.sha256()
+        digest.update(definition.text.encode())
+        for image in definition.local_images():
+            digest.update(f"\0localimage\0{file_digest(image)}".encode())
+        for source, destination in definition.files():
+            digest.update(f"\0files\0{source}\0{destination}".encode())
+            for path in sorted(glob.glob(source)) or [source]:
+                _hash_path(digest, path)
+        argv = iter(options.to_argv())
+        for token in argv:
+            if token in IGNORED_OPTIONS:
+                continue
+            digest.update(f"\0option\0{token}".encode())
+            if token == "--build-arg-file":
+                digest.update(file_digest(next(argv, "")).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.sif")
+
+    def build(self, pytainer, definition_file, image_path, options):
+        """
+        Build `image_path` with `pytainer` unless an identical build is cached.
+
+        Returns:
+        CommandHandler: The result of the build. On a cache hit, the command
+            is not run and the result is successful.
+        """
+        plan = pytainer.plan_build(definition_file, image_path, options)
+        argv = options.to_argv()
+        if "--sandbox" in argv:
+            return pytainer._produce(plan, image_path)
+        try:
+            cached = self.path(self.key(definition_file, options))
+        except OSError:
+            # Missing inputs, let apptainer report the error
+            return pytainer._produce(plan, image_path)
+        if os.path.exists(cached):
+            with self._lock:
+                self.hits += 1
+            try:
+                place_file(cached, image_path, self.link, force="--force" in argv)
+            except OSError as e:
+                stderr = f"FATAL:   {e}\n"
+                return make_result(plan.command, returncode=255, stderr=stderr)
+            stderr = f"INFO:    Using cached image {cached}\n"
+            return make_result(plan.command, stderr=stderr)
+        with self._lock:
+            self.misses += 1
+        result = pytainer._produce(plan, image_path)
+        if result.has_succeeded() and os.path.isfile(image_path):
+            tmp_path = f"{cached}.{uuid.uuid4().hex}"
+            try:
+                os.link(image_path, tmp_path)
+            except OSError:
+                shutil.copyfile(image_path, tmp_path)
+            os.replace(tmp_path, cached)
+        return result
+
+    def stats(self):
+        """Return the number of hits, misses and cached images."""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        entries = sum(name.endswith(".sif") for name in os.listdir(self.root))
+        return {"hits": hits, "misses": misses, "entries": entries}
+
+    def clear(self):
+        """Remove all the cached images."""
+        for name in os.listdir(self.root):
+            if name.endswith(".sif"):
+                os.remove(os.path.join(self.root, name))
+
+
+def _hash_path(digest, path):
+    if os.path.islink(path):
+        digest.update(f"\0link\0{path}\0{os.readlink(path)}".encode())
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                _hash_path(digest, os.path.join(root, name))
+    else:
+        digest.update(f"\0file\0{path}\0{file_digest(path)}".encode())
@@ -0,0 +1,160 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .definition import Definition
+from .pytainer import DEFAULT_BUILD_OPTIONS, Pytainer, PytainerOptionsBuild
+
+
+class BuildGraphResult:
+    """
+    Outcome of BuildGraph.build.
+
+    Attributes:
+    results (dict): CommandHandler of each image that was built.
+    skipped (dict): Maps each image that was not built to the failed image
+        it depends on.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.skipped = {}
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(built={len(self.succeeded)}, "
+            f"failed={len(self.failed)}, skipped={len(self.skipped)})"
+        )
+
+    @property
+    def succeeded(self):
+        return [image for image, r in self.results.items() if r.has_succeeded()]
+
+    @property
+    def failed(self):
+        return [image for image, r in self.results.items() if r.has_failed()]
+
+    def has_failed(self):
+        return bool(self.failed or self.skipped)
+
+    def has_succeeded(self):
+        return not self.has_failed()
+
+
+class BuildGraph:
+    """
+    Build many images in parallel, in the order given by their dependencies.
+
+    An image depends on another image of the graph when its definition file
+    bootstraps from it with `Bootstrap: localimage`, a relative `From` being
+    resolved against the current directory as apptainer does. Independent
+    images are built concurrently, and when a build fails only the images
+    depending on it, directly or not, are skipped.
+
+    Args:
+    pytainer (Pytainer): Used to run the builds, so that they go through its
+        build cache for instance.
+    max_workers (int): Maximum number of concurrent builds, defaults to the
+        number of CPUs.
+    """
+
+    def __init__(self, pytainer=None, max_workers=None):
+        self.pytainer = pytainer or Pytainer()
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.targets = {}
+
+    def __len__(self):
+        return len(self.targets)
+
+    def add(
+        self,
+        definition_file,
+        image_path,
+        options: PytainerOptionsBuild = DEFAULT_BUILD_OPTIONS,
+    ):
+        """Add the build of `image_path` from `definition_file` to the graph."""
+        image_path = os.path.abspath(image_path)
+        if image_path in self.targets:
+            raise ValueError(f"{image_path} is already built by the graph")
+        definition = Definition.from_file(definition_file)
+        self.targets[image_path] = (definition, options)
+
+    def dependencies(self):
+        """Return the set of images of the graph each image depends on."""
+        return {
+            image: {
+                base
+                for base in definition.local_images()
+                if base in self.targets and base != image
+            }
+            for image, (definition, _) in self.targets.items()
+        }
+
+    def order(self):
+        """
+        Return the images in an order in which they can be built.
+
+        Raises:
+        ValueError: If the dependencies are circular.
+        """
+        dependencies = self.dependencies()
+        order, done = [], set()
+        while len(order) < len(dependencies):
+            ready = [
+                image
+                for image, bases in dependencies.items()
+                if image not in done and bases <= done
+            ]
+            if not ready:
+                cycle = sorted(set(dependencies) - done)
+                raise ValueError(f"Circular dependencies between {cycle}")
+            order.extend(sorted(ready))
+            done.update(ready)
+        return order
+
+    def build(self):
+        """
+        Build all the images of the graph.
+
+        Returns:
+        BuildGraphResult: The results of the builds and the skipped images.
+
+        Raises:
+        ValueError: If the dependencies are circular.
+        """
+        self.order()
+        dependencies = self.dependencies()
+        dependents = {image: set() for image in dependencies}
+        for image, bases in dependencies.items():
+            for base in bases:
+                dependents[base].add(image)
+        pending = {image: set(bases) for image, bases in dependencies.items()}
+        report = BuildGraphResult()
+
+        def skip(image, cause):
+            for dependent in dependents[image]:
+                if dependent not in report.skipped:
+                    report.skipped[dependent] = cause
+                    pending.pop(dependent, None)
+                    skip(dependent, cause)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for image in sorted(i for i, bases in pending.items() if not bases):
+                    del pending[image]
+                    definition, options = self.targets[image]
+                    future = executor.submit(
+                        self.pytainer.build, definition.path, image, options
+                    )
+                    running[future] = image
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image = running.pop(future)
+                    result = report.results[image] = future.result()
+                    if result.has_failed():
+                        skip(image, image)
+                        continue
+                    for dependent in dependents[image]:
+                        if dependent in pending:
+                            pending[dependent].discard(image)
+        return report
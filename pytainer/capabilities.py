@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import pwd
+import re
+import shutil
+import stat
+import threading
+import uuid
+from dataclasses import dataclass, field
+
+from .utils import CommandPlan
+
+# Subcommands whose flags are probed with `apptainer <subcommand> --help`.
+PROBED_SUBCOMMANDS = ("exec", "run", "pull", "build", "inspect", "instance start")
+
+FLAG = re.compile(r"^\s+(?:-\w, )?(--[a-z0-9][a-z0-9-]*)", re.MULTILINE)
+VERSION = re.compile(r"version\s+(\S+)")
+
+# Fields of Capabilities that only depend on the binary, cached on disk.
+BINARY_FIELDS = {"version", "subcommands", "flags", "suid"}
+
+
+@dataclass(frozen=True)
+class Capabilities:
+    """
+    What the installed apptainer binary supports.
+
+    Attributes:
+    binary (str): Resolved path of the binary.
+    version (str): Version reported by the binary, e.g. "1.2.4-1.el7".
+    subcommands (list): Top-level subcommands, e.g. "exec" or "instance".
+    flags (dict): Flags of the subcommands in PROBED_SUBCOMMANDS.
+    userns (bool): Unprivileged user namespaces are available.
+    suid (bool): The setuid starter is installed.
+    fakeroot (bool): The current user can use --fakeroot, through subordinate
+        ids or the fakeroot command.
+    cache_dir (str): Directory of the apptainer cache.
+    """
+
+    binary: str
+    version: str | None = None
+    subcommands: list = field(default_factory=list)
+    flags: dict = field(default_factory=dict)
+    userns: bool = False
+    suid: bool = False
+    fakeroot: bool = False
+    cache_dir: str | None = None
+
+    @property
+    def version_info(self):
+        """The version as a tuple of integers, e.g. (1, 2, 4)."""
+        if self.version is None:
+            return ()
+        return tuple(int(part) for part in re.findall(r"\d+", self.version)[:3])
+
+    def supports(self, subcommand, flag=None):
+        """Return whether the binary supports a subcommand, or one of its flags."""
+        if flag is None:
+            return subcommand.split()[0] in self.subcommands
+        return flag in self.flags.get(subcommand, ())
+
+
+_CAPABILITIES = {}
+_LOCK = threading.Lock()
+
+
+def capabilities(binary="apptainer", cache_dir=None, refresh=False):
+    """
+    Return the Capabilities of an apptainer binary.
+
+    The binary is probed once per process, and what depends only on the
+    binary (version, subcommands, flags and setuid starter) is persisted in
+    `cache_dir` (by default `$XDG_CACHE_HOME/pytainer`) keyed by the path and
+    modification time of the binary, so that other processes do not probe it
+    again until it is upgraded. What depends on the user and the environment
+    (user namespaces, fakeroot and the apptainer cache directory) is computed
+    by each process, and again when the user or APPTAINER_CACHEDIR change.
+
+    Raises:
+    FileNotFoundError: If the binary cannot be found.
+    """
+    path = shutil.which(binary)
+    if path is None:
+        raise FileNotFoundError(f"{binary}: command not found")
+    path = os.path.realpath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    process_key = (*key, os.getuid(), os.environ.get("APPTAINER_CACHEDIR"))
+    with _LOCK:
+        if not refresh and process_key in _CAPABILITIES:
+            return _CAPABILITIES[process_key]
+        cache_dir = cache_dir or default_cache_dir()
+        binary = None if refresh else _read(cache_dir, key)
+        if binary is None:
+            binary = probe_binary(path)
+            _write(cache_dir, key, binary)
+        result = Capabilities(binary=path, **binary, **probe_environment())
+        _CAPABILITIES[process_key] = result
+        return result
+
+
+def default_cache_dir():
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(root, "pytainer")
+
+
+def probe(path):
+    """Probe the capabilities of the apptainer binary at `path`."""
+    return Capabilities(binary=path, **probe_binary(path), **probe_environment())
+
+
+def probe_binary(path):
+    """
+    Probe what the apptainer binary at `path` supports, whoever runs it.
+
+    Returns:
+    dict: The version, subcommands, flags and suid fields of Capabilities.
+    """
+    commands = {
+        "version": [path, "--version"],
+        "help": [path, "help"],
+        "buildcfg": [path, "buildcfg"],
+    }
+    for subcommand in PROBED_SUBCOMMANDS:
+        commands[subcommand] = [path, *subcommand.split(), "--help"]
+    futures = {
+        name: CommandPlan(command).launch() for name, command in commands.items()
+    }
+    outputs = {}
+    for name, future in futures.items():
+        result = future.result()
+        outputs[name] = result.stdout if result.has_succeeded() else ""
+
+    match = VERSION.search(outputs["version"])
+    buildcfg = dict(re.findall(r"^(\w+)=(.*)$", outputs["buildcfg"], re.MULTILINE))
+    libexecdir = buildcfg.get("LIBEXECDIR") or os.path.join(
+        os.path.dirname(os.path.dirname(path)), "libexec"
+    )
+    return {
+        "version": match.group(1) if match else None,
+        "subcommands": _subcommands(outputs["help"]),
+        "flags": {
+            subcommand: sorted(set(FLAG.findall(outputs[subcommand])))
+            for subcommand in PROBED_SUBCOMMANDS
+        },
+        "suid": _suid(os.path.join(libexecdir, "apptainer", "bin", "starter-suid")),
+    }
+
+
+def probe_environment():
+    """
+    Probe what depends on the current user and environment.
+
+    Returns:
+    dict: The userns, fakeroot and cache_dir fields of Capabilities.
+    """
+    return {
+        "userns": _userns(),
+        "fakeroot": _fakeroot(),
+        "cache_dir": os.environ.get("APPTAINER_CACHEDIR")
+        or os.path.expanduser("~/.apptainer/cache"),
+    }
+
+
+def _subcommands(help):
+    subcommands = []
+    in_commands = False
+    for line in help.splitlines():
+        if line.strip().endswith("Commands:"):
+            in_commands = True
+        elif in_commands and line.startswith("  ") and line.split():
+            subcommands.append(line.split()[0])
+        elif in_commands and not line.strip():
+            in_commands = False
+    return sorted(subcommands)
+
+
+def _userns():
+    try:
+        with open("/proc/sys/user/max_user_namespaces") as fi:
+            if int(fi.read()) == 0:
+                return False
+    except (OSError, ValueError):
+        return False
+    try:
+        with open("/proc/sys/kernel/unprivileged_userns_clone") as fi:
+            return int(fi.read()) != 0
+    except (OSError, ValueError):
+        return True
+
+
+def _suid(starter):
+    try:
+        mode = os.stat(starter).st_mode
+    except OSError:
+        return False
+    return bool(mode & stat.S_ISUID)
+
+
+def _fakeroot():
+    if os.getuid() == 0 or shutil.which("fakeroot"):
+        return True
+    try:
+        user = pwd.getpwuid(os.getuid()).pw_name
+        with open("/etc/subuid") as fi:
+            entries = [line.split(":", 1)[0] for line in fi]
+    except (KeyError, OSError):
+        return False
+    return user in entries or str(os.getuid()) in entries
+
+
+def _cache_path(cache_dir, key):
+    digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"capabilities-{digest}.json")
+
+
+def _read(cache_dir, key):
+    try:
+        with open(_cache_path(cache_dir, key)) as fi:
+            binary = json.load(fi)
+        # Entries written with the environment-dependent fields are ignored
+        if set(binary) != BINARY_FIELDS:
+            return None
+        return binary
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _write(cache_dir, key, binary):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _cache_path(cache_dir, key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as fo:
+            json.dump(binary, fo)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
@@ -0,0 +1,128 @@
+import os
+import re
+
+SECTION = re.compile(r"^%(\w+)\s*(.*)$")
+HEADER = re.compile(r"^(\w+)\s*:\s*(.*)$")
+
+
+class Definition:
+    """
+    Parsed Apptainer definition file.
+
+    Attributes:
+    stages (list): Header of each build stage, as a dict mapping keywords
+        such as "Bootstrap" or "From" to their value. Single stage
+        definitions have one stage.
+    sections (list): (name, arguments, body) tuple of each section, in
+        order, e.g. ("files", "from build", "...").
+    path (str): Path of the definition file, if read from a file.
+
+    Relative paths of the definition, the `From` of `localimage` stages and
+    the sources of %files sections, are resolved against `directory`, or
+    against the current directory if it is None, as apptainer does, and not
+    against the directory of the definition file.
+    """
+
+    def __init__(self, text, path=None, directory=None):
+        self.text = text
+        self.path = path
+        self._directory = directory
+        self.stages = []
+        self.sections = []
+        self._parse()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.path or self.header!r})"
+
+    @classmethod
+    def from_file(cls, path, directory=None):
+        with open(path) as fi:
+            return cls(fi.read(), path=path, directory=directory)
+
+    def _parse(self):
+        section = None
+        for line in self.text.splitlines():
+            match = SECTION.match(line)
+            if match:
+                section = [match.group(1), match.group(2).strip(), []]
+                self.sections.append(section)
+                continue
+            match = HEADER.match(line.strip())
+            keyword = match.group(1).lower() if match else None
+            if match and (section is None or keyword == "bootstrap"):
+                if keyword == "bootstrap" or not self.stages:
+                    self.stages.append({})
+                    section = None
+                self.stages[-1][match.group(1)] = match.group(2).strip()
+            elif section is not None:
+                section[2].append(line)
+        self.sections = [
+            (name, arguments, "\n".join(body))
+            for name, arguments, body in self.sections
+        ]
+
+    @property
+    def header(self):
+        """Header of the first build stage."""
+        return self.stages[0] if self.stages else {}
+
+    def get(self, keyword, default=None):
+        """Return a keyword of the first stage header, case insensitively."""
+        return _get(self.header, keyword, default)
+
+    @property
+    def bootstrap(self):
+        return self.get("Bootstrap")
+
+    @property
+    def source(self):
+        return self.get("From")
+
+    def section(self, name):
+        """Return the body of the first section `name`, or None."""
+        for section, _, body in self.sections:
+            if section == name:
+                return body
+        return None
+
+    def directory(self):
+        """Directory against which relative paths are resolved."""
+        if self._directory is None:
+            return os.getcwd()
+        return os.path.abspath(self._directory)
+
+    def local_images(self):
+        """
+        Return the absolute paths of the local images the definition builds
+        upon, i.e. the `From` of `localimage` stages.
+        """
+        images = []
+        for stage in self.stages:
+            if (_get(stage, "Bootstrap") or "").lower() == "localimage":
+                images.append(os.path.join(self.directory(), _get(stage, "From", "")))
+        return [os.path.normpath(image) for image in images]
+
+    def files(self):
+        """
+        Return the (source, destination) pairs of the %files sections that
+        copy from the host, with sources resolved against `directory()`.
+        """
+        files = []
+        for name, arguments, body in self.sections:
+            if name != "files" or arguments.startswith("from"):
+                continue
+            for line in body.splitlines():
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                source, *destination = line.split(None, 1)
+                source = os.path.join(self.directory(), source)
+                files.append((source, destination[0] if destination else None))
+        return files
+
+
+def _get(header, keyword, default=None):
+    for key, value in header.items():
+        if key.lower() == keyword.lower():
+            return value
+    return default
@@ -0,0 +1,438 @@
+"""
+In-process stand-in for apptainer, to test and load-test code built on
+pytainer without containers.
+
+FakeBackend answers the apptainer commands of the plans it is given without
+starting any process: exec, run, pull, build, inspect, instance start, stop
+and list, and version. Latency, output volume and failure rates are
+configurable per subcommand. Random draws are derived from the seed, the
+command line and the number of times it was run before, so a workload gets
+the same results whatever the interleaving of its threads.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import random
+import select
+import subprocess
+import threading
+import time
+
+from .utils import DEFAULT_CAPTURE, read_output
+
+IMAGE_SUFFIXES = (".sif", ".sqsh", ".img")
+
+# Output of the commands that are not simulated, repeated to the output size.
+OUTPUT_LINE = b"pytainer fake backend output\n"
+
+
+def _echo(args):
+    return 0, " ".join(args) + "\n", ""
+
+
+# Programs whose exec or run is simulated, by default.
+COMMANDS = {
+    "echo": _echo,
+    "true": lambda args: (0, "", ""),
+    "false": lambda args: (1, "", ""),
+}
+
+
+class FakeBackend:
+    """
+    Backend simulating apptainer in-process, see pytainer.backends.
+
+    Commands of exec and run are not executed: `echo`, `true`, `false` and
+    the programs of `commands` are simulated, any other program succeeds and
+    writes `output_size` bytes. The image of exec and run is the first
+    argument that looks like an image, i.e. a URI, a path with a SIF, SquashFS
+    or ext3 suffix or an image pulled or built by the backend. Images are not
+    checked, except instances, which must have been started through the
+    backend. Pulls and builds write a small placeholder file at the image
+    path, so that code checking for the image finds it.
+
+    Args:
+    latency (float or dict): Seconds each command takes, or a dict of them
+        by subcommand, e.g. {"exec": 0.05, "pull": 2}, defaulting to 0.
+    jitter (float): Relative variation of the latency, e.g. 0.1 for +/-10%.
+    output_size (int): Bytes written on stdout by the commands of exec and
+        run that are not simulated, and by run without a command.
+    failure_rate (float or dict): Probability that a command fails with the
+        return code 255, or a dict of them by subcommand.
+    seed: Seed of the random draws.
+    commands (dict): Programs simulated by exec and run, by name, in addition
+        to COMMANDS. Each is called with its arguments and returns the return
+        code, stdout and stderr, as str or bytes.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        output_size=0,
+        failure_rate=0.0,
+        seed=0,
+        commands=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.output_size = output_size
+        self.failure_rate = failure_rate
+        self.seed = seed
+        self.commands = {**COMMANDS, **(commands or {})}
+        # Images pulled or built, by path, and running instances, by name
+        self.images = {}
+        self.instances = {}
+        self.calls = collections.Counter()
+        self.failures = collections.Counter()
+        self._runs = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(latency={self.latency!r}, "
+            f"failure_rate={self.failure_rate!r}, seed={self.seed!r})"
+        )
+
+    def run(self, command, capture=DEFAULT_CAPTURE, span=None):
+        latency, result = self.simulate(command)
+        if span is not None:
+            span.mark("spawn")
+        if latency > 0:
+            time.sleep(latency)
+        return _captured(result, capture, span)
+
+    async def run_async(self, command, capture=DEFAULT_CAPTURE, span=None):
+        latency, result = self.simulate(command)
+        if span is not None:
+            span.mark("spawn")
+        if latency > 0:
+            await asyncio.sleep(latency)
+        return _captured(result, capture, span)
+
+    def spawn(self, command, capture=DEFAULT_CAPTURE):
+        latency, result = self.simulate(command)
+        return FakeProcess(command, result, latency, capture)
+
+    async def spawn_async(self, command):
+        latency, result = self.simulate(command)
+        return FakeAsyncProcess(command, result, latency)
+
+    def simulate(self, command):
+        """
+        Simulate a command, applying its effects, e.g. the image written by
+        a pull, right away.
+
+        Returns:
+        tuple: The latency of the command, and its CompletedProcess with
+            bytes output.
+        """
+        argv = ["sh", "-c", command] if isinstance(command, str) else command
+        if not argv or os.path.basename(argv[0]) != "apptainer":
+            stderr = f"{argv[0] if argv else ''}: command not found\n"
+            return 0.0, _completed(argv, 127, b"", stderr)
+        args = list(argv[1:])
+        if args[:1] == ["instance"] and len(args) > 1:
+            subcommand, args = f"instance {args[1]}", args[2:]
+        elif args:
+            subcommand, args = args[0], args[1:]
+        else:
+            subcommand = ""
+        with self._lock:
+            key = "\0".join(argv)
+            rng = random.Random(f"{self.seed}\0{key}\0{self._runs[key]}")
+            self._runs[key] += 1
+            self.calls[subcommand] += 1
+        latency = _by_subcommand(self.latency, subcommand)
+        if self.jitter:
+            latency *= 1 + self.jitter * (2 * rng.random() - 1)
+        simulate = SUBCOMMANDS.get(subcommand)
+        if simulate is None:
+            returncode, stdout, stderr = _fatal(f"unknown command {subcommand!r}")
+        elif rng.random() < _by_subcommand(self.failure_rate, subcommand):
+            returncode, stdout, stderr = _fatal(f"simulated {subcommand} failure")
+        else:
+            returncode, stdout, stderr = simulate(self, args)
+        if returncode == 255:
+            with self._lock:
+                self.failures[subcommand] += 1
+        return max(latency, 0.0), _completed(argv, returncode, stdout, stderr)
+
+    def _is_image(self, token):
+        return (
+            "://" in token or token.endswith(IMAGE_SUFFIXES) or token in self.images
+        )
+
+    def _exec(self, args):
+        images = [index for index, arg in enumerate(args) if self._is_image(arg)]
+        if not images:
+            # A sandbox without options
+            images = [index for index, arg in enumerate(args) if arg[:1] != "-"]
+            if not images:
+                return _fatal("no image given")
+        image, command = args[images[0]], args[images[0] + 1 :]
+        if image.startswith("instance://"):
+            name = image[len("instance://") :]
+            with self._lock:
+                if name not in self.instances:
+                    return _fatal(f"no instance found with name {name}")
+        if not command:
+            return 0, self._output(), ""
+        simulate = self.commands.get(os.path.basename(command[0]))
+        if simulate is None:
+            return 0, self._output(), ""
+        return simulate(command[1:])
+
+    def _output(self):
+        count = self.output_size // len(OUTPUT_LINE) + 1
+        return (OUTPUT_LINE * count)[: self.output_size]
+
+    def _produce(self, args, content_of, overwrite=True):
+        positional = [arg for arg in args if not arg.startswith("-")]
+        if len(positional) < 2:
+            return _fatal("not enough arguments")
+        path, source = positional[-2:]
+        if not overwrite and os.path.exists(path):
+            return _fatal(f"Image file already exists: {path}")
+        content = content_of(source)
+        if content is None:
+            return _fatal(f"unable to open {source}")
+        with self._lock:
+            self.images[path] = source
+        with open(path, "w") as fo:
+            fo.write(content)
+        return 0, "", f"INFO:    Creating SIF file {path}\n"
+
+    def _pull(self, args):
+        overwrite = "--force" in args or "-F" in args
+        return self._produce(args, lambda uri: f"SIF:{uri}\n", overwrite)
+
+    def _build(self, args):
+        def content_of(definition):
+            if "://" in definition:
+                return f"SIF:{definition}\n"
+            try:
+                with open(definition) as fi:
+                    return fi.read()
+            except OSError:
+                return None
+
+        return self._produce(args, content_of)
+
+    def _inspect(self, args):
+        image = args[-1] if args else ""
+        if image not in self.images and not os.path.exists(image):
+            return _fatal(f"could not open image {image}")
+        metadata = {
+            "data": {
+                "attributes": {
+                    "labels": {"org.label-schema.usage": self.images.get(image, "")},
+                    "runscript": '#!/bin/sh\nexec /bin/sh "$@"\n',
+                }
+            },
+            "type": "container",
+        }
+        return 0, json.dumps(metadata) + "\n", ""
+
+    def _instance_start(self, args):
+        positional = [arg for arg in args if not arg.startswith("-")]
+        if len(positional) < 2:
+            return _fatal("not enough arguments")
+        image, name = positional[-2:]
+        with self._lock:
+            if name in self.instances:
+                return _fatal(f"instance {name} already exists")
+            self.instances[name] = image
+        return 0, "", "INFO:    instance started successfully\n"
+
+    def _instance_stop(self, args):
+        name = args[-1] if args else ""
+        with self._lock:
+            if self.instances.pop(name, None) is None:
+                return _fatal(f"no instance found with name {name}")
+        return 0, "", f"INFO:    Stopping {name} instance\n"
+
+    def _instance_list(self, args):
+        with self._lock:
+            instances = [
+                {"instance": name, "pid": 0, "img": image}
+                for name, image in sorted(self.instances.items())
+            ]
+        return 0, json.dumps({"instances": instances}) + "\n", ""
+
+    def _version(self, args):
+        return 0, "apptainer version 1.2.4\n", ""
+
+    def stats(self):
+        """Return the number of calls and failures by subcommand."""
+        with self._lock:
+            return {"calls": dict(self.calls), "failures": dict(self.failures)}
+
+
+SUBCOMMANDS = {
+    "exec": FakeBackend._exec,
+    "run": FakeBackend._exec,
+    "pull": FakeBackend._pull,
+    "build": FakeBackend._build,
+    "inspect": FakeBackend._inspect,
+    "instance start": FakeBackend._instance_start,
+    "instance stop": FakeBackend._instance_stop,
+    "instance list": FakeBackend._instance_list,
+    "version": FakeBackend._version,
+    "--version": FakeBackend._version,
+}
+
+
+class FakeProcess:
+    """
+    Popen-like process of FakeBackend. After the latency, a thread writes the
+    output to pipes, which can be read as those of a real process.
+    """
+
+    def __init__(self, args, result, latency, capture=DEFAULT_CAPTURE):
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self._result = result
+        self._killed = threading.Event()
+        self._done = threading.Event()
+        writers = []
+        for name, captured in (("stdout", capture.stdout), ("stderr", capture.stderr)):
+            if captured:
+                reader, writer = os.pipe()
+                setattr(self, name, open(reader, "rb"))
+                writers.append((writer, getattr(result, name)))
+            else:
+                setattr(self, name, None)
+        threading.Thread(
+            target=self._write, args=(writers, latency), daemon=True
+        ).start()
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} returncode={self.returncode}>"
+
+    def _write(self, writers, latency):
+        complete = False
+        try:
+            if not self._killed.wait(latency):
+                for writer, data in writers:
+                    view = memoryview(data)
+                    while view and not self._killed.is_set():
+                        # Wait for room in the pipe, without missing a kill
+                        if select.select([], [writer], [], 0.05)[1]:
+                            view = view[os.write(writer, view[:65536]) :]
+                complete = not self._killed.is_set()
+        except OSError:
+            # The reader is gone, as for a real process
+            complete = True
+        finally:
+            for writer, _ in writers:
+                os.close(writer)
+            self.returncode = self._result.returncode if complete else -9
+            self._done.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def communicate(self):
+        output = read_output(self)
+        self.wait()
+        return output
+
+    def send_signal(self, sig):
+        self._killed.set()
+
+    def terminate(self):
+        self._killed.set()
+
+    def kill(self):
+        self._killed.set()
+
+
+class FakeAsyncProcess:
+    """asyncio.subprocess.Process-like counterpart of FakeProcess."""
+
+    def __init__(self, args, result, latency):
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.stdout = asyncio.StreamReader()
+        self.stderr = asyncio.StreamReader()
+        self._killed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._write(result, latency))
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} returncode={self.returncode}>"
+
+    async def _write(self, result, latency):
+        try:
+            await asyncio.wait_for(self._killed.wait(), latency)
+            self.returncode = -9
+        except asyncio.TimeoutError:
+            self.stdout.feed_data(result.stdout)
+            self.stderr.feed_data(result.stderr)
+            self.returncode = result.returncode
+        finally:
+            self.stdout.feed_eof()
+            self.stderr.feed_eof()
+
+    async def wait(self):
+        await self._task
+        return self.returncode
+
+    async def communicate(self):
+        await self.wait()
+        return await self.stdout.read(), await self.stderr.read()
+
+    def send_signal(self, sig):
+        self._killed.set()
+
+    def terminate(self):
+        self._killed.set()
+
+    def kill(self):
+        self._killed.set()
+
+
+def _fatal(message):
+    return 255, "", f"FATAL:   {message}\n"
+
+
+def _by_subcommand(value, subcommand):
+    if isinstance(value, dict):
+        return value.get(subcommand, 0)
+    return value
+
+
+def _completed(argv, returncode, stdout, stderr):
+    return subprocess.CompletedProcess(
+        args=argv,
+        returncode=returncode,
+        stdout=stdout.encode() if isinstance(stdout, str) else stdout,
+        stderr=stderr.encode() if isinstance(stderr, str) else stderr,
+    )
+
+
+def _captured(result, capture, span):
+    """Apply `capture` to a simulated result, as a process's output would be."""
+    if span is not None:
+        if result.stdout or result.stderr:
+            span.mark("first_output")
+        span.stdout_bytes += len(result.stdout)
+        span.stderr_bytes += len(result.stderr)
+        span.mark("exit")
+    return subprocess.CompletedProcess(
+        args=result.args,
+        returncode=result.returncode,
+        stdout=result.stdout[: capture.limit] if capture.stdout else None,
+        stderr=result.stderr[: capture.limit] if capture.stderr else None,
+    )
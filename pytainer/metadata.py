@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from dataclasses import dataclass, field
+
+from .singleflight import SingleFlight
+from .store import file_digest
+
+BUILD_DATE_LABEL = "org.label-schema.build-date"
+
+
+@dataclass(frozen=True)
+class ImageMetadata:
+    """
+    Metadata of an image, as reported by `apptainer inspect --all --json`.
+
+    `environment` maps the environment files of the image to their content,
+    `apps` maps the name of each SCIF app to its own metadata.
+    """
+
+    labels: dict = field(default_factory=dict)
+    environment: dict = field(default_factory=dict)
+    runscript: str | None = None
+    startscript: str | None = None
+    test: str | None = None
+    helpfile: str | None = None
+    deffile: str | None = None
+    apps: dict = field(default_factory=dict)
+    raw: dict = field(default_factory=dict, repr=False, compare=False)
+
+    @property
+    def build_date(self):
+        return self.labels.get(BUILD_DATE_LABEL)
+
+    @classmethod
+    def from_json(cls, data):
+        """Parse the output of `apptainer inspect --json`, as str or dict."""
+        if isinstance(data, str):
+            data = json.loads(data)
+        attributes = data.get("data", {}).get("attributes", {})
+        labels = attributes.get("labels") or {}
+        environment = attributes.get("environment") or {}
+        apps = attributes.get("apps") or {}
+        if isinstance(environment, str):
+            environment = {"": environment}
+        if not isinstance(apps, dict):
+            apps = {name: {} for name in str(apps).split()}
+        return cls(
+            labels=labels,
+            environment=environment,
+            runscript=attributes.get("runscript") or None,
+            startscript=attributes.get("startscript") or None,
+            test=attributes.get("test") or None,
+            helpfile=attributes.get("helpfile") or None,
+            deffile=attributes.get("deffile") or None,
+            apps=apps,
+            raw=data,
+        )
+
+
+class MetadataCache:
+    """
+    Memoize the metadata of local images.
+
+    Entries are keyed by the real path of the image together with its size
+    and modification time, or with the sha256 of its content if `validate`
+    is "digest", so that a modified image is inspected again. When
+    `cache_dir` is given, the metadata is also stored on disk and shared
+    between processes. Remote images are not cached.
+
+    Args:
+    cache_dir (str): Directory of the on-disk cache, disabled if None.
+    validate (str): "stat" or "digest".
+    """
+
+    def __init__(self, cache_dir=None, validate="stat"):
+        if validate not in ("stat", "digest"):
+            raise ValueError(f"validate must be 'stat' or 'digest', not {validate!r}")
+        self.cache_dir = cache_dir
+        self.validate = validate
+        # Key and metadata of the current version of each image, by real path
+        self._entries = {}
+        # Signature and sha256 of each image, by real path
+        self._digests = {}
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_path):
+        """Return the cache key of an image, or None if it is not a local file."""
+        try:
+            stat = os.stat(image_path)
+        except (OSError, TypeError):
+            return None
+        path = os.path.realpath(image_path)
+        if self.validate == "digest" and os.path.isfile(path):
+            return (path, self._digest(path, stat))
+        return (path, stat.st_size, stat.st_mtime_ns)
+
+    def _digest(self, path, stat):
+        """
+        Return the sha256 of the image at `path`, only hashed again when its
+        size or modification time changes.
+        """
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            memo = self._digests.get(path)
+        if memo is not None and memo[0] == signature:
+            return memo[1]
+        digest = file_digest(path)
+        with self._lock:
+            self._digests[path] = (signature, digest)
+        return digest
+
+    def get(self, image_path, inspect):
+        """
+        Return the metadata of `image_path`, calling `inspect()` to obtain
+        it on a cache miss. Concurrent misses on the same image share a
+        single call.
+        """
+        key = self.key(image_path)
+        if key is None:
+            return inspect()
+        with self._lock:
+            entry = self._entries.get(key[0])
+        metadata = entry[1] if entry is not None and entry[0] == key else None
+        if metadata is None:
+            metadata = self._flights.do(key, self._load, key, inspect)
+        return metadata
+
+    def _load(self, key, inspect):
+        metadata = self._read(key)
+        if metadata is None:
+            metadata = inspect()
+            self._write(key, metadata)
+        with self._lock:
+            # Replaces the entry of the previous version of the image
+            self._entries[key[0]] = (key, metadata)
+        return metadata
+
+    def invalidate(self, image_path=None):
+        """Drop the entries of an image, or of all images if None."""
+        with self._lock:
+            if image_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.realpath(image_path), None)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._disk_path(key)) as fi:
+                return ImageMetadata.from_json(fi.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, key, metadata):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as fo:
+            json.dump(metadata.raw, fo)
+        os.replace(tmp_path, path)
+
+
+METADATA_CACHE = MetadataCache()
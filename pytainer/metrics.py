@@ -0,0 +1,356 @@
+"""
+Aggregated metrics of the commands run by pytainer.
+
+The registry is fed by the tracing hooks, so it sees every command run
+through a CommandPlan, whether it is run, launched, streamed or awaited.
+Snapshots can be dumped as JSON or in the Prometheus text format, e.g. for
+the textfile collector of the node exporter:
+
+    from pytainer.metrics import REGISTRY
+
+    REGISTRY.enable()
+    ...
+    REGISTRY.write("/var/lib/node_exporter/pytainer.prom")
+"""
+
+import bisect
+import json
+import os
+import threading
+import uuid
+
+from . import tracing
+
+# Upper bounds in seconds of the latency histogram buckets.
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    600.0,
+)
+
+QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    Quantiles are estimated by linear interpolation within the bucket they
+    fall in, as Prometheus' histogram_quantile does, so their precision is
+    that of the buckets.
+    """
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Return the estimated `q` quantile, or None if nothing was observed."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    # Unbounded bucket, the best estimate is its lower bound
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """Return the (upper bound, cumulative count) pairs of the buckets."""
+        pairs, total = [], 0
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class _Subcommand:
+    __slots__ = (
+        "returncodes",
+        "latency",
+        "stdout_bytes",
+        "stderr_bytes",
+        "in_flight",
+    )
+
+    def __init__(self, buckets):
+        self.returncodes = {}
+        self.latency = Histogram(buckets)
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self.in_flight = 0
+
+
+class MetricsRegistry:
+    """
+    Counters, latency histograms and in-flight gauges per subcommand.
+
+    Commands run without a subcommand, e.g. plans built by hand, are
+    accounted under "other". Commands interrupted before their exit could be
+    observed are counted with the return code "none".
+
+    Args:
+    buckets (tuple): Upper bounds in seconds of the latency buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._subcommands = {}
+        self._in_flight = 0
+        self._in_flight_max = 0
+
+    def __repr__(self) -> str:
+        state = "enabled" if self.enabled else "disabled"
+        return f"<{self.__class__.__name__} {state}>"
+
+    def enable(self):
+        """Start recording the commands run by pytainer."""
+        with self._lock:
+            if self.enabled:
+                return
+            self.enabled = True
+        tracing.add_hook(self.observe, on_start=self.started)
+
+    def disable(self):
+        with self._lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+        tracing.remove_hook(self.observe, on_start=self.started)
+
+    def reset(self):
+        """Forget all the recorded commands, except the ones in flight."""
+        with self._lock:
+            for name, entry in list(self._subcommands.items()):
+                fresh = self._subcommands[name] = _Subcommand(self.buckets)
+                fresh.in_flight = entry.in_flight
+            self._in_flight_max = self._in_flight
+
+    def _entry(self, subcommand):
+        name = subcommand or "other"
+        entry = self._subcommands.get(name)
+        if entry is None:
+            entry = self._subcommands[name] = _Subcommand(self.buckets)
+        return entry
+
+    def started(self, plan):
+        """Account for a command that has started, see tracing.add_hook."""
+        with self._lock:
+            self._entry(plan.subcommand).in_flight += 1
+            self._in_flight += 1
+            self._in_flight_max = max(self._in_flight_max, self._in_flight)
+
+    def observe(self, record):
+        """Account for a command that has completed, from its TraceRecord."""
+        returncode = "none" if record.returncode is None else str(record.returncode)
+        with self._lock:
+            entry = self._entry(record.subcommand)
+            entry.returncodes[returncode] = entry.returncodes.get(returncode, 0) + 1
+            entry.latency.observe(record.duration)
+            entry.stdout_bytes += record.stdout_bytes
+            entry.stderr_bytes += record.stderr_bytes
+            if entry.in_flight:
+                entry.in_flight -= 1
+                self._in_flight -= 1
+
+    def snapshot(self):
+        """
+        Return the current metrics as a dict that can be serialized to JSON.
+
+        Returns:
+        dict: "in_flight" and "in_flight_max" over all commands, and in
+            "subcommands" the count, success and failure counts, failure
+            rate, return codes, latency summary and histogram, output bytes
+            and in-flight count of each subcommand.
+        """
+        with self._lock:
+            subcommands = {}
+            for name, entry in sorted(self._subcommands.items()):
+                count = entry.latency.count
+                succeeded = entry.returncodes.get("0", 0)
+                latency = {
+                    "count": count,
+                    "sum": entry.latency.sum,
+                    **{
+                        key: entry.latency.quantile(q)
+                        for key, q in QUANTILES.items()
+                    },
+                    "buckets": [
+                        ["+Inf" if bound == float("inf") else bound, total]
+                        for bound, total in entry.latency.cumulative()
+                    ],
+                }
+                subcommands[name] = {
+                    "count": count,
+                    "succeeded": succeeded,
+                    "failed": count - succeeded,
+                    "failure_rate": (count - succeeded) / count if count else 0.0,
+                    "returncodes": dict(sorted(entry.returncodes.items())),
+                    "latency": latency,
+                    "stdout_bytes": entry.stdout_bytes,
+                    "stderr_bytes": entry.stderr_bytes,
+                    "in_flight": entry.in_flight,
+                }
+            return {
+                "in_flight": self._in_flight,
+                "in_flight_max": self._in_flight_max,
+                "subcommands": subcommands,
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="pytainer"):
+        """Return the current metrics in the Prometheus text format."""
+        snapshot = self.snapshot()
+        subcommands = snapshot["subcommands"]
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{prefix}_{name}{suffix}{_labels(labels)} {value}")
+
+        metric(
+            "commands_total",
+            "counter",
+            "Commands completed, by subcommand and return code.",
+            [
+                ("", {"subcommand": name, "returncode": code}, count)
+                for name, entry in subcommands.items()
+                for code, count in entry["returncodes"].items()
+            ],
+        )
+        metric(
+            "commands_failed_total",
+            "counter",
+            "Commands completed with a non-zero return code.",
+            [("", {"subcommand": n}, e["failed"]) for n, e in subcommands.items()],
+        )
+        samples = []
+        for name, entry in subcommands.items():
+            latency = entry["latency"]
+            for bound, total in latency["buckets"]:
+                labels = {"subcommand": name, "le": _number(bound)}
+                samples.append(("_bucket", labels, total))
+            samples.append(("_sum", {"subcommand": name}, _number(latency["sum"])))
+            samples.append(("_count", {"subcommand": name}, latency["count"]))
+        metric(
+            "command_duration_seconds",
+            "histogram",
+            "Duration of the commands, from the assembly of the command line "
+            "to the decoding of the output.",
+            samples,
+        )
+        metric(
+            "command_duration_quantile_seconds",
+            "gauge",
+            "Estimated quantiles of the duration of the commands.",
+            [
+                ("", {"subcommand": name, "quantile": str(q)}, _number(value))
+                for name, entry in subcommands.items()
+                for key, q in QUANTILES.items()
+                if (value := entry["latency"][key]) is not None
+            ],
+        )
+        for stream in ("stdout", "stderr"):
+            metric(
+                f"{stream}_bytes_total",
+                "counter",
+                f"Bytes written by the commands on {stream}.",
+                [
+                    ("", {"subcommand": n}, e[f"{stream}_bytes"])
+                    for n, e in subcommands.items()
+                ],
+            )
+        metric(
+            "commands_in_flight",
+            "gauge",
+            "Commands currently running.",
+            [("", {"subcommand": n}, e["in_flight"]) for n, e in subcommands.items()],
+        )
+        metric(
+            "commands_in_flight_max",
+            "gauge",
+            "Highest number of commands running at the same time.",
+            [("", {}, snapshot["in_flight_max"])],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, format="prometheus"):
+        """
+        Atomically write a snapshot to `path`, as "prometheus" text or "json".
+        """
+        if format == "prometheus":
+            text = self.to_prometheus()
+        elif format == "json":
+            text = self.to_json()
+        else:
+            raise ValueError(f"Unknown metrics format {format!r}")
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        name = f".{os.path.basename(path)}.{uuid.uuid4().hex}"
+        tmp_path = os.path.join(directory, name)
+        try:
+            with open(tmp_path, "w") as fo:
+                fo.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, str):
+        return value
+    return repr(float(value))
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Registry of the process, disabled until REGISTRY.enable() is called.
+REGISTRY = MetricsRegistry()
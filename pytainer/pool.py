@@ -0,0 +1,325 @@
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .backends import get_backend
+from .pytainer import DEFAULT_EXEC_OPTIONS, Pytainer
+from .utils import CommandPlan
+
+DISPATCH = ("round-robin", "least-loaded")
+
+
+class PoolMember:
+    """An instance of an InstancePool."""
+
+    __slots__ = ("pytainer", "load", "calls", "last_used", "dead")
+
+    def __init__(self, pytainer):
+        self.pytainer = pytainer
+        self.load = 0
+        self.calls = 0
+        self.last_used = time.monotonic()
+        self.dead = False
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.name} load={self.load}>"
+
+    @property
+    def name(self):
+        return self.pytainer.instance
+
+
+class InstancePool:
+    """
+    Pool of persistent instances of an image, to exec commands without
+    paying for the container setup.
+
+    Instances are started with the same options. Each exec is dispatched to
+    one of them, round-robin or to the least loaded one. When every instance
+    runs `max_load` commands, a new instance is started in the background, up
+    to `max_size`, and instances idle for `idle_timeout` seconds are stopped,
+    down to `min_size`. Every `health_interval` seconds, instances that are
+    no longer listed by `apptainer instance list` are replaced.
+
+    Args:
+    image_path (str): The image.
+    options (PytainerOptionsExec): Options of the instances, e.g. binds.
+    min_size (int): Number of instances started by `start` and kept running.
+    max_size (int): Maximum number of instances, defaults to `min_size`.
+    dispatch (str): "round-robin" or "least-loaded".
+    max_load (int): Number of concurrent commands per instance above which
+        the pool grows.
+    idle_timeout (float): Seconds after which an idle instance above
+        `min_size` is stopped.
+    health_interval (float): Seconds between health checks, None to only
+        check when `check` is called.
+    agent (bool): Run the commands through an agent in each instance, see
+        Pytainer.instance_start.
+    backend: Starts the processes of the instances, see pytainer.backends.
+    """
+
+    def __init__(
+        self,
+        image_path,
+        options=DEFAULT_EXEC_OPTIONS,
+        min_size=1,
+        max_size=None,
+        dispatch="least-loaded",
+        max_load=1,
+        idle_timeout=60.0,
+        health_interval=30.0,
+        agent=False,
+        backend=None,
+    ):
+        if dispatch not in DISPATCH:
+            raise ValueError(f"dispatch must be one of {DISPATCH}, not {dispatch!r}")
+        self.image_path = image_path
+        self.options = options
+        self.min_size = min_size
+        self.max_size = max(max_size or min_size, min_size)
+        self.dispatch = dispatch
+        self.max_load = max_load
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.agent = agent
+        self.backend = get_backend(backend)
+        self.members = []
+        self._starting = 0
+        self._error = None
+        self._round_robin = itertools.count()
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._closed = threading.Event()
+        self._maintenance = None
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} {self.image_path} "
+            f"size={len(self.members)} min={self.min_size} max={self.max_size}>"
+        )
+
+    def __len__(self):
+        return len(self.members)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Start `min_size` instances concurrently, and the health checks.
+
+        Raises:
+        RuntimeError: If an instance cannot be started.
+        """
+        missing = self.min_size - len(self.members)
+        if missing > 0:
+            with ThreadPoolExecutor(max_workers=missing) as executor:
+                members = list(
+                    executor.map(lambda _: self._start_member(), range(missing))
+                )
+            failed = [m for m in members if isinstance(m, str)]
+            with self._lock:
+                self.members.extend(m for m in members if not isinstance(m, str))
+                self._available.notify_all()
+            if failed:
+                raise RuntimeError(
+                    f"Cannot start instance of {self.image_path}: {failed[0]}"
+                )
+        if self.health_interval is not None and self._maintenance is None:
+            self._maintenance = threading.Thread(target=self._maintain, daemon=True)
+            self._maintenance.start()
+        return self
+
+    def _start_member(self):
+        """Return a new PoolMember, or the error message of apptainer."""
+        pytainer = Pytainer(self.image_path, backend=self.backend)
+        result = pytainer.instance_start(options=self.options, agent=self.agent)
+        if result.has_failed():
+            return result.stderr.strip() or f"returncode {result.returncode}"
+        return PoolMember(pytainer)
+
+    def _acquire(self):
+        with self._lock:
+            while True:
+                if self._closed.is_set():
+                    raise RuntimeError("The pool is closed")
+                members = [m for m in self.members if not m.dead]
+                if members:
+                    break
+                if not self._starting:
+                    if self._error is not None:
+                        error, self._error = self._error, None
+                        raise RuntimeError(
+                            f"Cannot start instance of {self.image_path}: {error}"
+                        )
+                    self._grow_locked()
+                self._available.wait()
+            if self.dispatch == "round-robin":
+                member = members[next(self._round_robin) % len(members)]
+            else:
+                member = min(members, key=lambda m: m.load)
+            member.load += 1
+            member.calls += 1
+            if all(m.load >= self.max_load for m in members):
+                self._grow_locked()
+            return member
+
+    def _release(self, member):
+        with self._lock:
+            member.load -= 1
+            member.last_used = time.monotonic()
+
+    def _grow_locked(self):
+        if len(self.members) + self._starting >= self.max_size:
+            return
+        self._starting += 1
+        threading.Thread(target=self._grow, daemon=True).start()
+
+    def _grow(self):
+        member = self._start_member()
+        with self._lock:
+            self._starting -= 1
+            if not isinstance(member, PoolMember):
+                self._error = member
+            elif self._closed.is_set():
+                member.pytainer.instance_stop()
+            else:
+                self.members.append(member)
+            self._available.notify_all()
+
+    def exec(self, command, options=DEFAULT_EXEC_OPTIONS):
+        """
+        Run a command in one of the instances, see Pytainer.exec.
+
+        If the instance turns out to be gone, it is replaced and the command
+        is retried once on another instance.
+        """
+        for attempt in range(2):
+            member = self._acquire()
+            try:
+                result = member.pytainer.exec(command, options)
+            finally:
+                self._release(member)
+            if attempt or result.returncode != 255 or member.name in self.alive():
+                return result
+            self._replace(member)
+        return result
+
+    def map(self, commands, options=DEFAULT_EXEC_OPTIONS, max_workers=None):
+        """Run `exec` of each command concurrently, returning results in order."""
+        max_workers = max_workers or self.max_size * self.max_load
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda c: self.exec(c, options), commands))
+
+    def alive(self):
+        """Return the names of the running instances, as listed by apptainer."""
+        plan = CommandPlan(
+            ["apptainer", "instance", "list", "--json"],
+            subcommand="instance list",
+            backend=self.backend,
+        )
+        result = plan.run()
+        if result.has_failed():
+            return set()
+        try:
+            instances = json.loads(result.stdout).get("instances") or []
+        except ValueError:
+            return set()
+        return {instance.get("instance") for instance in instances}
+
+    def check(self):
+        """
+        Replace the instances that are gone, stop the idle ones above
+        `min_size` and start instances up to `min_size`.
+
+        Returns:
+        list: Names of the instances that were found dead.
+        """
+        alive = self.alive()
+        now = time.monotonic()
+        with self._lock:
+            dead = [m for m in self.members if m.name not in alive]
+            idle = [
+                m
+                for m in self.members
+                if m not in dead
+                and not m.load
+                and now - m.last_used > self.idle_timeout
+            ]
+        names = [member.name for member in dead]
+        for member in dead:
+            self._replace(member)
+        stopped = []
+        with self._lock:
+            # Members may have been acquired or replaced since they were listed
+            idle = [
+                m
+                for m in idle
+                if m in self.members
+                and not m.load
+                and now - m.last_used > self.idle_timeout
+            ]
+            excess = len(self.members) - self.min_size
+            for member in idle[: max(excess, 0)]:
+                self.members.remove(member)
+                member.dead = True
+                stopped.append(member)
+        for member in stopped:
+            member.pytainer.instance_stop()
+        with self._lock:
+            for _ in range(self.min_size - len(self.members) - self._starting):
+                self._grow_locked()
+        return names
+
+    def _replace(self, member):
+        with self._lock:
+            if member not in self.members:
+                return
+            self.members.remove(member)
+            member.dead = True
+            self._grow_locked()
+        # Make sure it does not linger, and free its atexit handler
+        member.pytainer.instance_stop()
+
+    def _maintain(self):
+        while not self._closed.wait(self.health_interval):
+            try:
+                self.check()
+            except Exception:
+                # Health checks must not kill the pool, retry on the next round
+                continue
+
+    def resize(self, min_size=None, max_size=None):
+        """Change the bounds of the pool, instances are adjusted by `check`."""
+        with self._lock:
+            if min_size is not None:
+                self.min_size = min_size
+            self.max_size = max(max_size or self.max_size, self.min_size)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self.members),
+                "starting": self._starting,
+                "load": sum(m.load for m in self.members),
+                "calls": {m.name: m.calls for m in self.members},
+            }
+
+    def close(self):
+        """Stop all the instances."""
+        self._closed.set()
+        with self._lock:
+            members, self.members = self.members, []
+            self._available.notify_all()
+        for member in members:
+            member.dead = True
+            member.pytainer.instance_stop()
+        if self._maintenance is not None:
+            self._maintenance.join()
+            self._maintenance = None
@@ -1,25 +1,137 @@
+import asyncio
+import atexit
+import os
 import shlex
-
-from .utils import run_command, CommandHandler
-
+import shutil
+import time
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import tracing
+from .agent import AgentError, AgentPlan, agent_directory, agent_request, start_agent
+from .backends import get_backend
+from .capabilities import capabilities
+from .metadata import ImageMetadata, METADATA_CACHE
+from .sif import SIFImage, is_sif, read_metadata
+from .singleflight import run_once, run_once_async
+from .utils import (
+    CommandPlan,
+    PytainerBatchError,
+    split_command,
+    DEFAULT_CAPTURE,
+)
+
+# Version the options below were written against. See capabilities() for what
+# the installed apptainer supports.
 APPTAINER_VERSION = "apptainer version 1.2.4-1.el7"
 
 
 class PytainerOptions:
+    """
+    Options of an apptainer subcommand, stored as argv tokens.
+
+    Options are mutable until `freeze()` returns an immutable copy. Frozen
+    options are hashable, safe to share between threads and cache their
+    serialization. `with_<option>(...)`, e.g. `with_bind("/data")`, returns a
+    new frozen copy with the option added.
+    """
+
+    __slots__ = ("options", "_frozen", "_argv")
+
     def __init__(self):
         self.options = []
+        self._frozen = False
+        self._argv = None
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError(f"{self.__class__.__name__} is frozen")
+        object.__setattr__(self, name, value)
+
+    def __getattr__(self, name):
+        if name.startswith("with_") and callable(getattr(type(self), name[5:], None)):
+            method = getattr(type(self), name[5:])
+
+            def derive(*args, **kwargs):
+                options = self.copy()
+                method(options, *args, **kwargs)
+                return options.freeze()
+
+            return derive
+        raise AttributeError(
+            f"{self.__class__.__name__!r} object has no attribute {name!r}"
+        )
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return self.to_argv() == other.to_argv()
+
+    def __hash__(self):
+        if not self._frozen:
+            raise TypeError(f"unhashable type: mutable {self.__class__.__name__}")
+        return hash((type(self), self._argv))
+
+    def copy(self):
+        """Return a mutable copy of the options."""
+        options = type(self)()
+        options.options = [list(option) for option in self.options]
+        return options
+
+    def freeze(self):
+        """Return an immutable copy of the options."""
+        if self._frozen:
+            return self
+        options = type(self)()
+        options.options = tuple(tuple(option) for option in self.options)
+        options._argv = tuple(token for option in self.options for token in option)
+        options._frozen = True
+        return options
+
+    @property
+    def frozen(self):
+        return self._frozen
+
+    def to_argv(self):
+        if self._argv is None:
+            self._argv = tuple(token for option in self.options for token in option)
+        return list(self._argv)
 
     def to_string(self):
-        return " ".join(self.options)
+        return shlex.join(self.to_argv())
 
-    def add(self, option):
-        self.options.append(option)
+    def add(self, *option):
+        """
+        Add an option given as its argv tokens, e.g. add("--env", "NAME=value").
 
-    def add_all(self, options):
-        self.options.extend(options)
+        A single string is split with shell syntax, so add("--workdir /home")
+        is equivalent to add("--workdir", "/home").
+        """
+        self._check_mutable()
+        self.options.append(self._tokens(option))
+        self._argv = None
 
-    def remove(self, option):
-        self.options.remove(option)
+    def add_all(self, options):
+        for option in options:
+            if isinstance(option, (list, tuple)):
+                self.add(*option)
+            else:
+                self.add(option)
+
+    def remove(self, *option):
+        self._check_mutable()
+        self.options.remove(self._tokens(option))
+        self._argv = None
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError(f"{self.__class__.__name__} is frozen")
+
+    def _tokens(self, option):
+        if len(option) == 1 and isinstance(option[0], str):
+            return shlex.split(option[0])
+        return [str(token) for token in option]
 
     def shell_escape(self, string):
         return shlex.quote(string)
@@ -225,32 +337,31 @@ class PytainerOptionsExec(PytainerOptions):
                                           (with overlay support only)
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def add_caps(self, caps):
-        self.add(f"--add-caps {caps}")
+        self.add("--add-caps", caps)
 
     def allow_setuid(self):
         self.add("--allow-setuid")
 
     def app(self, app):
-        self.add(f"--app {app}")
+        self.add("--app", app)
 
     def apply_cgroups(self, cgroups):
-        self.add(f"--apply-cgroups {cgroups}")
+        self.add("--apply-cgroups", cgroups)
 
     def bind(self, src, dest=None, opts=None):
         dest = dest or src
         opts = opts or "rw"
-        self.add(f"-B {src}:{dest}:{opts}")
+        self.add("-B", f"{src}:{dest}:{opts}")
 
     def blkio_weight(self, weight):
         assert isinstance(weight, int) and 10 <= weight <= 1000
-        self.add(f"--blkio-weight {weight}")
+        self.add("--blkio-weight", weight)
 
     def blkio_weight_device(self, devices):
-        self.add(f"--blkio-weight-device {devices}")
+        self.add("--blkio-weight-device", devices)
 
     def cleanenv(self):
         self.add("--cleanenv")
@@ -266,53 +377,55 @@ class PytainerOptionsExec(PytainerOptions):
 
     def cpu_shares(self, shares):
         shares = shares or -1
-        self.add(f"--cpu-shares {shares}")
+        self.add("--cpu-shares", shares)
 
     def cpus(self, cpus):
-        self.add(f"--cpus {cpus}")
+        self.add("--cpus", cpus)
 
     def cpuset_cpus(self, cpus):
-        self.add(f"--cpuset-cpus {cpus}")
+        self.add("--cpuset-cpus", cpus)
 
     def cpuset_mems(self, mems):
-        self.add(f"--cpuset-mems {mems}")
+        self.add("--cpuset-mems", mems)
 
     def disable_cache(self):
         self.add("--disable-cache")
 
     def dns(self, dns):
-        self.add(f"--dns {dns}")
+        self.add("--dns", dns)
 
     def docker_host(self, docker_host):
-        self.add(f"--docker-host {docker_host}")
+        self.add("--docker-host", docker_host)
 
     def docker_login(self):
         self.add("--docker-login")
 
     def drop_caps(self, caps):
-        self.add(f"--drop-caps {caps}")
+        self.add("--drop-caps", caps)
 
     def env(self, name, value, escape=True):
-        value = self.shell_escape(value) if escape else value
-        self.add(f"--env {name}={value}")
+        if escape:
+            self.add("--env", f"{name}={value}")
+        else:
+            self.add(f"--env {name}={value}")
 
     def env_file(self, env_file):
-        self.add(f"--env-file {env_file}")
+        self.add("--env-file", env_file)
 
     def fakeroot(self):
         self.add("--fakeroot")
 
     def fusemount(self, fusemount):
-        self.add(f"--fusemount {fusemount}")
+        self.add("--fusemount", fusemount)
 
     def help(self):
         self.add("--help")
 
     def home(self, home):
-        self.add(f"--home {home}")
+        self.add("--home", home)
 
     def hostname(self, hostname):
-        self.add(f"--hostname {hostname}")
+        self.add("--hostname", hostname)
 
     def ipc(self):
         self.add("--ipc")
@@ -321,25 +434,25 @@ class PytainerOptionsExec(PytainerOptions):
         self.add("--keep-privs")
 
     def memory(self, memory):
-        self.add(f"--memory {memory}")
+        self.add("--memory", memory)
 
     def memory_reservation(self, memory_reservation):
-        self.add(f"--memory-reservation {memory_reservation}")
+        self.add("--memory-reservation", memory_reservation)
 
     def memory_swap(self, memory_swap):
-        self.add(f"--memory-swap {memory_swap}")
+        self.add("--memory-swap", memory_swap)
 
     def mount(self, mount):
-        self.add(f"--mount {mount}")
+        self.add("--mount", mount)
 
     def net(self):
         self.add("--net")
 
     def network(self, network):
-        self.add(f"--network {network}")
+        self.add("--network", network)
 
     def network_args(self, network_args):
-        self.add(f"--network-args {network_args}")
+        self.add("--network-args", network_args)
 
     def no_eval(self):
         self.add("--no-eval")
@@ -354,7 +467,7 @@ class PytainerOptionsExec(PytainerOptions):
         self.add("--no-init")
 
     def no_mount(self, mount):
-        self.add(f"--no-mount {mount}")
+        self.add("--no-mount", mount)
 
     def no_privs(self):
         self.add("--no-privs")
@@ -372,31 +485,31 @@ class PytainerOptionsExec(PytainerOptions):
         self.add("--oom-kill-disable")
 
     def overlay(self, overlay):
-        self.add(f"--overlay {overlay}")
+        self.add("--overlay", overlay)
 
     def passphrase(self):
         self.add("--passphrase")
 
     def pem_path(self, pem_path):
-        self.add(f"--pem-path {pem_path}")
+        self.add("--pem-path", pem_path)
 
     def pid(self):
         self.add("--pid")
 
     def pids_limit(self, pids_limit):
-        self.add(f"--pids-limit {pids_limit}")
+        self.add("--pids-limit", pids_limit)
 
     def pwd(self, pwd):
-        self.add(f"--pwd {pwd}")
+        self.add("--pwd", pwd)
 
     def rocm(self):
         self.add("--rocm")
 
     def scratch(self, scratch):
-        self.add(f"--scratch {scratch}")
+        self.add("--scratch", scratch)
 
     def security(self, security):
-        self.add(f"--security {security}")
+        self.add("--security", security)
 
     def underlay(self):
         self.add("--underlay")
@@ -414,19 +527,19 @@ class PytainerOptionsExec(PytainerOptions):
         self.add("--vm")
 
     def vm_cpu(self, vm_cpu):
-        self.add(f"--vm-cpu {vm_cpu}")
+        self.add("--vm-cpu", vm_cpu)
 
     def vm_err(self):
         self.add("--vm-err")
 
     def vm_ip(self, vm_ip):
-        self.add(f"--vm-ip {vm_ip}")
+        self.add("--vm-ip", vm_ip)
 
     def vm_ram(self, vm_ram):
-        self.add(f"--vm-ram {vm_ram}")
+        self.add("--vm-ram", vm_ram)
 
     def workdir(self, workdir):
-        self.add(f"--workdir {workdir}")
+        self.add("--workdir", workdir)
 
     def writable(self):
         self.add("--writable")
@@ -478,23 +591,22 @@ class PytainerOptionsPull(PytainerOptions):
                                   oras:// and library://<hostname>/... URIs
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def arch(self, arch):
-        self.add(f"--arch {arch}")
+        self.add("--arch", arch)
 
     def arch_variant(self, arch_variant):
-        self.add(f"--arch-variant {arch_variant}")
+        self.add("--arch-variant", arch_variant)
 
     def dir(self, dir):
-        self.add(f"--dir {dir}")
+        self.add("--dir", dir)
 
     def disable_cache(self):
         self.add("--disable-cache")
 
     def docker_host(self, docker_host):
-        self.add(f"--docker-host {docker_host}")
+        self.add("--docker-host", docker_host)
 
     def docker_login(self):
         self.add("--docker-login")
@@ -503,7 +615,7 @@ class PytainerOptionsPull(PytainerOptions):
         self.add("--force")
 
     def library(self, library):
-        self.add(f"--library {library}")
+        self.add("--library", library)
 
     def no_cleanup(self):
         self.add("--no-cleanup")
@@ -620,25 +732,24 @@ class PytainerOptionsBuild(PytainerOptions):
                                      persistent data (with overlay support only)
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def bind(self, src, dest=None, opts=None):
         dest = dest or src
         opts = opts or "rw"
-        self.add(f"-B {src}:{dest}:{opts}")
+        self.add("-B", f"{src}:{dest}:{opts}")
 
     def build_arg(self, build_arg):
-        self.add(f"--build-arg {build_arg}")
+        self.add("--build-arg", build_arg)
 
     def build_arg_file(self, build_arg_file):
-        self.add(f"--build-arg-file {build_arg_file}")
+        self.add("--build-arg-file", build_arg_file)
 
     def disable_cache(self):
         self.add("--disable-cache")
 
     def docker_host(self, docker_host):
-        self.add(f"--docker-host {docker_host}")
+        self.add("--docker-host", docker_host)
 
     def docker_login(self):
         self.add("--docker-login")
@@ -659,10 +770,10 @@ class PytainerOptionsBuild(PytainerOptions):
         self.add("--json")
 
     def library(self, library):
-        self.add(f"--library {library}")
+        self.add("--library", library)
 
     def mount(self, mount):
-        self.add(f"--mount {mount}")
+        self.add("--mount", mount)
 
     def no_cleanup(self):
         self.add("--no-cleanup")
@@ -683,7 +794,7 @@ class PytainerOptionsBuild(PytainerOptions):
         self.add("--passphrase")
 
     def pem_path(self, pem_path):
-        self.add(f"--pem-path {pem_path}")
+        self.add("--pem-path", pem_path)
 
     def rocm(self):
         self.add("--rocm")
@@ -692,7 +803,7 @@ class PytainerOptionsBuild(PytainerOptions):
         self.add("--sandbox")
 
     def section(self, section):
-        self.add(f"--section {section}")
+        self.add("--section", section)
 
     def update(self):
         self.add("--update")
@@ -736,14 +847,13 @@ class PytainerOptionsInspect(PytainerOptions):
       -t, --test          show the test script for the image
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def all(self):
         self.add("--all")
 
     def app(self, app):
-        self.add(f"--app {app}")
+        self.add("--app", app)
 
     def deffile(self):
         self.add("--deffile")
@@ -975,32 +1085,31 @@ class PytainerOptionsRun(PytainerOptions):
 
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
     def add_caps(self, caps):
-        self.add(f"--add-caps {caps}")
+        self.add("--add-caps", caps)
 
     def allow_setuid(self):
         self.add("--allow-setuid")
 
     def app(self, app):
-        self.add(f"--app {app}")
+        self.add("--app", app)
 
     def apply_cgroups(self, cgroups):
-        self.add(f"--apply-cgroups {cgroups}")
+        self.add("--apply-cgroups", cgroups)
 
     def bind(self, src, dest=None, opts=None):
         dest = dest or src
         opts = opts or "rw"
-        self.add(f"-B {src}:{dest}:{opts}")
+        self.add("-B", f"{src}:{dest}:{opts}")
 
     def blkio_weight(self, weight):
         assert isinstance(weight, int) and 10 <= weight <= 1000
-        self.add(f"--blkio-weight {weight}")
+        self.add("--blkio-weight", weight)
 
     def blkio_weight_device(self, devices):
-        self.add(f"--blkio-weight-device {devices}")
+        self.add("--blkio-weight-device", devices)
 
     def cleanenv(self):
         self.add("--cleanenv")
@@ -1016,53 +1125,55 @@ class PytainerOptionsRun(PytainerOptions):
 
     def cpu_shares(self, shares):
         shares = shares or -1
-        self.add(f"--cpu-shares {shares}")
+        self.add("--cpu-shares", shares)
 
     def cpus(self, cpus):
-        self.add(f"--cpus {cpus}")
+        self.add("--cpus", cpus)
 
     def cpuset_cpus(self, cpus):
-        self.add(f"--cpuset-cpus {cpus}")
+        self.add("--cpuset-cpus", cpus)
 
     def cpuset_mems(self, mems):
-        self.add(f"--cpuset-mems {mems}")
+        self.add("--cpuset-mems", mems)
 
     def disable_cache(self):
         self.add("--disable-cache")
 
     def dns(self, dns):
-        self.add(f"--dns {dns}")
+        self.add("--dns", dns)
 
     def docker_host(self, docker_host):
-        self.add(f"--docker-host {docker_host}")
+        self.add("--docker-host", docker_host)
 
     def docker_login(self):
         self.add("--docker-login")
 
     def drop_caps(self, caps):
-        self.add(f"--drop-caps {caps}")
+        self.add("--drop-caps", caps)
 
     def env(self, name, value, escape=True):
-        value = self.shell_escape(value) if escape else value
-        self.add(f"--env {name}={value}")
+        if escape:
+            self.add("--env", f"{name}={value}")
+        else:
+            self.add(f"--env {name}={value}")
 
     def env_file(self, env_file):
-        self.add(f"--env-file {env_file}")
+        self.add("--env-file", env_file)
 
     def fakeroot(self):
         self.add("--fakeroot")
 
     def fusemount(self, fusemount):
-        self.add(f"--fusemount {fusemount}")
+        self.add("--fusemount", fusemount)
 
     def help(self):
         self.add("--help")
 
     def home(self, home):
-        self.add(f"--home {home}")
+        self.add("--home", home)
 
     def hostname(self, hostname):
-        self.add(f"--hostname {hostname}")
+        self.add("--hostname", hostname)
 
     def ipc(self):
         self.add("--ipc")
@@ -1071,25 +1182,25 @@ class PytainerOptionsRun(PytainerOptions):
         self.add("--keep-privs")
 
     def memory(self, memory):
-        self.add(f"--memory {memory}")
+        self.add("--memory", memory)
 
     def memory_reservation(self, memory_reservation):
-        self.add(f"--memory-reservation {memory_reservation}")
+        self.add("--memory-reservation", memory_reservation)
 
     def memory_swap(self, memory_swap):
-        self.add(f"--memory-swap {memory_swap}")
+        self.add("--memory-swap", memory_swap)
 
     def mount(self, mount):
-        self.add(f"--mount {mount}")
+        self.add("--mount", mount)
 
     def net(self):
         self.add("--net")
 
     def network(self, network):
-        self.add(f"--network {network}")
+        self.add("--network", network)
 
     def network_args(self, network_args):
-        self.add(f"--network-args {network_args}")
+        self.add("--network-args", network_args)
 
     def no_eval(self):
         self.add("--no-eval")
@@ -1104,7 +1215,7 @@ class PytainerOptionsRun(PytainerOptions):
         self.add("--no-init")
 
     def no_mount(self, mount):
-        self.add(f"--no-mount {mount}")
+        self.add("--no-mount", mount)
 
     def no_privs(self):
         self.add("--no-privs")
@@ -1122,31 +1233,31 @@ class PytainerOptionsRun(PytainerOptions):
         self.add("--oom-kill-disable")
 
     def overlay(self, overlay):
-        self.add(f"--overlay {overlay}")
+        self.add("--overlay", overlay)
 
     def passphrase(self):
         self.add("--passphrase")
 
     def pem_path(self, pem_path):
-        self.add(f"--pem-path {pem_path}")
+        self.add("--pem-path", pem_path)
 
     def pid(self):
         self.add("--pid")
 
     def pids_limit(self, pids_limit):
-        self.add(f"--pids-limit {pids_limit}")
+        self.add("--pids-limit", pids_limit)
 
     def pwd(self, pwd):
-        self.add(f"--pwd {pwd}")
+        self.add("--pwd", pwd)
 
     def rocm(self):
         self.add("--rocm")
 
     def scratch(self, scratch):
-        self.add(f"--scratch {scratch}")
+        self.add("--scratch", scratch)
 
     def security(self, security):
-        self.add(f"--security {security}")
+        self.add("--security", security)
 
     def underlay(self):
         self.add("--underlay")
@@ -1164,19 +1275,19 @@ class PytainerOptionsRun(PytainerOptions):
         self.add("--vm")
 
     def vm_cpu(self, vm_cpu):
-        self.add(f"--vm-cpu {vm_cpu}")
+        self.add("--vm-cpu", vm_cpu)
 
     def vm_err(self):
         self.add("--vm-err")
 
     def vm_ip(self, vm_ip):
-        self.add(f"--vm-ip {vm_ip}")
+        self.add("--vm-ip", vm_ip)
 
     def vm_ram(self, vm_ram):
-        self.add(f"--vm-ram {vm_ram}")
+        self.add("--vm-ram", vm_ram)
 
     def workdir(self, workdir):
-        self.add(f"--workdir {workdir}")
+        self.add("--workdir", workdir)
 
     def writable(self):
         self.add("--writable")
@@ -1185,39 +1296,434 @@ class PytainerOptionsRun(PytainerOptions):
         self.add("--writable-tmpfs")
 
 
+# Immutable default options of the Pytainer methods.
+DEFAULT_EXEC_OPTIONS = PytainerOptionsExec().freeze()
+DEFAULT_RUN_OPTIONS = PytainerOptionsRun().freeze()
+DEFAULT_PULL_OPTIONS = PytainerOptionsPull().freeze()
+DEFAULT_BUILD_OPTIONS = PytainerOptionsBuild().freeze()
+DEFAULT_INSPECT_OPTIONS = PytainerOptionsInspect().freeze()
+
+
 class Pytainer:
-    def __init__(self, image_path=None):
+    def __init__(
+        self,
+        image_path=None,
+        store=None,
+        single_flight=True,
+        metadata_cache=None,
+        build_cache=None,
+        capture=DEFAULT_CAPTURE,
+        result_cache=None,
+        backend=None,
+    ):
         self.image_path = image_path
+        # Starts the processes, e.g. "posix_spawn", see pytainer.backends
+        self.backend = get_backend(backend)
+        self.agent = None
+        # How the output of exec and run is kept, the output of the other
+        # subcommands is always captured as text since pytainer parses it.
+        self.capture = capture
+        self.instance = None
+        self.store = store
+        self.single_flight = single_flight
+        self.metadata_cache = metadata_cache or METADATA_CACHE
+        self.build_cache = build_cache
+        # Opt-in memoization of exec and run, see ResultCache
+        self.result_cache = result_cache
+
+    def __enter__(self):
+        if self.instance is None:
+            result = self.instance_start()
+            if result.has_failed():
+                raise RuntimeError(
+                    f"Cannot start instance of {self.image_path}: {result.stderr}"
+                )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instance_stop()
+
+    def _target(self):
+        if self.instance is not None:
+            return f"instance://{self.instance}"
+        return self.image_path
+
+    def _plan(
+        self,
+        subcommand,
+        options,
+        arguments,
+        command=None,
+        image=None,
+        capture=DEFAULT_CAPTURE,
+    ):
+        """
+        Return the plan of `apptainer <subcommand> <options> <arguments>
+        <command>`, timing the serialization of the options and the assembly
+        of the command when tracing is enabled.
+        """
+        traced = tracing.enabled()
+        if traced:
+            start = time.perf_counter()
+        argv = options.to_argv()
+        if traced:
+            serialized = time.perf_counter()
+        cmd = ["apptainer", *subcommand.split(), argv, *arguments]
+        if command is not None:
+            cmd.append(split_command(command))
+        plan = CommandPlan(
+            cmd,
+            subcommand=subcommand,
+            image=image,
+            capture=capture,
+            backend=self.backend,
+        )
+        if traced:
+            plan.phases = {
+                "options": serialized - start,
+                "assembly": time.perf_counter() - serialized,
+            }
+        return plan
+
+    def instance_start(
+        self,
+        name=None,
+        options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS,
+        agent=False,
+        agent_python="python3",
+    ):
+        """
+        Start a persistent instance of the image.
+
+        While the instance is running, `exec` and `run` target `instance://name`
+        and skip the container setup. The instance is stopped by
+        `instance_stop`, when leaving the `with` block or at interpreter exit.
+
+        Args:
+        name (str): Name of the instance, generated if not given.
+        options (PytainerOptionsExec): Options applied to the instance, such
+            as bind mounts or the environment.
+        agent (bool): Also start a command agent in the instance, through
+            which `exec` runs commands without starting apptainer, see
+            pytainer.agent. Only exec options setting the environment or the
+            working directory are supported by the agent, other commands go
+            through apptainer. If the agent cannot be started, a warning is
+            issued and `exec` uses apptainer.
+        agent_python (str): Python interpreter of the image running the agent.
+
+        Returns:
+        CommandHandler: The result of `apptainer instance start`.
+        """
+        if self.instance is not None:
+            raise RuntimeError(f"Instance {self.instance} is already running")
+        name = name or f"pytainer-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        directory = None
+        if agent:
+            directory = agent_directory()
+            options = options.with_bind(directory)
+        plan = self._plan(
+            "instance start", options, [self.image_path, name], image=self.image_path
+        )
+        result = plan.run()
+        if result.has_succeeded():
+            self.instance = name
+            atexit.register(self.instance_stop)
+            if agent:
+                try:
+                    self.agent = start_agent(name, directory, python=agent_python)
+                except AgentError as e:
+                    warnings.warn(f"Running commands without agent: {e}")
+                    shutil.rmtree(directory, ignore_errors=True)
+        elif directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+        return result
+
+    def instance_stop(self):
+        """
+        Stop the instance started by `instance_start`, if any.
+
+        Returns:
+        CommandHandler: The result of `apptainer instance stop`, or None if no
+            instance is running.
+        """
+        if self.instance is None:
+            return None
+        atexit.unregister(self.instance_stop)
+        if self.agent is not None:
+            self.agent.close()
+            self.agent = None
+        plan = CommandPlan(
+            ["apptainer", "instance", "stop", self.instance],
+            subcommand="instance stop",
+            image=self.image_path,
+            backend=self.backend,
+        )
+        self.instance = None
+        return plan.run()
+
+    # Each plan_* method returns an inert CommandPlan that can be run, launched
+    # in the background or streamed any number of times.
+
+    def plan_exec(
+        self, command, options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS
+    ):
+        target = self._target()
+        plan = self._plan(
+            "exec",
+            options,
+            [target],
+            command=command,
+            image=target,
+            capture=self.capture,
+        )
+        if self.agent is not None and self.instance is not None:
+            request = agent_request(options)
+            if request is not None and self.agent.alive():
+                plan = AgentPlan(plan, self.agent, split_command(command), *request)
+        return plan
+
+    def plan_pull(
+        self,
+        image_uri,
+        save_path=None,
+        options: PytainerOptionsPull = DEFAULT_PULL_OPTIONS,
+    ):
+        save_path = save_path or self.image_path
+        return self._plan("pull", options, [save_path, image_uri], image=image_uri)
 
-    def exec(self, command, options: PytainerOptionsExec = PytainerOptionsExec()):
-        cmd = ["apptainer", "exec", options.to_string(), self.image_path, command]
-        return CommandHandler(cmd)
+    def plan_build(
+        self,
+        definition_file,
+        image_path,
+        options: PytainerOptionsBuild = DEFAULT_BUILD_OPTIONS,
+    ):
+        arguments = [image_path, definition_file]
+        return self._plan("build", options, arguments, image=image_path)
+
+    def plan_inspect(self, options: PytainerOptionsInspect = DEFAULT_INSPECT_OPTIONS):
+        return self._plan(
+            "inspect", options, [self.image_path], image=self.image_path
+        )
+
+    def plan_run(self, command, options: PytainerOptionsRun = DEFAULT_RUN_OPTIONS):
+        target = self._target()
+        return self._plan(
+            "run",
+            options,
+            [target],
+            command=command,
+            image=target,
+            capture=self.capture,
+        )
+
+    def exec(self, command, options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS):
+        return self._memoized(self.plan_exec(command, options))
+
+    def _memoized(self, plan):
+        if self.result_cache is None or self.instance is not None:
+            return plan.run()
+        return self.result_cache.run(plan, self.image_path)
+
+    def map(
+        self,
+        commands,
+        options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS,
+        max_workers=None,
+        ordered=True,
+        check=False,
+    ):
+        """
+        Execute many commands concurrently in the container.
+
+        Args:
+        commands (iterable): Commands to execute, each as given to `exec`.
+        options (PytainerOptionsExec): Options shared by all the commands.
+        max_workers (int): Maximum number of concurrent apptainer processes,
+            defaults to the number of CPUs.
+        ordered (bool): Yield results in input order if True, in completion
+            order otherwise.
+        check (bool): Raise a PytainerBatchError once all the results have
+            been yielded if any of the commands failed.
+
+        Yields:
+        CommandHandler: The result of each command.
+        """
+        commands = list(commands)
+        max_workers = max_workers or os.cpu_count() or 1
+        failures = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._memoized, self.plan_exec(command, options)): index
+                for index, command in enumerate(commands)
+            }
+            try:
+                for future in futures if ordered else as_completed(futures):
+                    result = future.result()
+                    if result.has_failed():
+                        failures.append((futures[future], result))
+                    yield result
+            finally:
+                for future in futures:
+                    future.cancel()
+        if check and failures:
+            failures.sort(key=lambda failure: failure[0])
+            raise PytainerBatchError(failures, len(commands))
 
     def pull(
         self,
         image_uri,
         save_path=None,
-        options: PytainerOptionsPull = PytainerOptionsPull(),
+        options: PytainerOptionsPull = DEFAULT_PULL_OPTIONS,
     ):
+        if self.store is not None:
+            return self.store.pull(self, image_uri, save_path, options)
         save_path = save_path or self.image_path
-        cmd = ["apptainer", "pull", options.to_string(), save_path, image_uri]
-        return CommandHandler(cmd)
+        return self._produce(self.plan_pull(image_uri, save_path, options), save_path)
 
     def build(
         self,
         definition_file,
         image_path,
-        options: PytainerOptionsBuild = PytainerOptionsBuild(),
+        options: PytainerOptionsBuild = DEFAULT_BUILD_OPTIONS,
+    ):
+        if self.build_cache is not None:
+            return self.build_cache.build(self, definition_file, image_path, options)
+        plan = self.plan_build(definition_file, image_path, options)
+        return self._produce(plan, image_path)
+
+    def _produce(self, plan, target):
+        if self.single_flight:
+            return run_once(plan, target)
+        return plan.run()
+
+    def inspect(self, options: PytainerOptionsInspect = DEFAULT_INSPECT_OPTIONS):
+        return self.plan_inspect(options).run()
+
+    def run(self, command, options: PytainerOptionsRun = DEFAULT_RUN_OPTIONS):
+        return self._memoized(self.plan_run(command, options))
+
+    def metadata(self, refresh=False):
+        """
+        Return the metadata of the image.
+
+        The metadata is read directly from SIF images when they hold it, and
+        obtained from `apptainer inspect` otherwise. It is memoized by the
+        metadata cache of the Pytainer, so that it is only read again when the
+        image changes.
+
+        Args:
+        refresh (bool): Ignore the cached metadata of the image.
+
+        Returns:
+        ImageMetadata: The labels, environment, scripts and apps of the image.
+
+        Raises:
+        RuntimeError: If the image cannot be inspected.
+        """
+        if refresh:
+            self.metadata_cache.invalidate(self.image_path)
+        return self.metadata_cache.get(self.image_path, self._inspect_metadata)
+
+    def capabilities(self, refresh=False):
+        """
+        Return the Capabilities of the installed apptainer, probed once per
+        process and cached on disk.
+        """
+        return capabilities("apptainer", refresh=refresh)
+
+    def sif(self):
+        """Return a SIFImage reading the image in-process."""
+        return SIFImage(self.image_path)
+
+    def _inspect_metadata(self):
+        if is_sif(self.image_path):
+            metadata = read_metadata(self.image_path, complete=True)
+            if metadata is not None:
+                return metadata
+        options = PytainerOptionsInspect()
+        options.all()
+        result = self.inspect(options)
+        if result.has_failed():
+            raise RuntimeError(f"Cannot inspect {self.image_path}: {result.stderr}")
+        return ImageMetadata.from_json(result.stdout)
+
+    # Coroutine versions of the methods above. They run apptainer through an
+    # asyncio subprocess so that a single event loop can drive many
+    # invocations concurrently. Pulls and builds coordinated with others
+    # producing the same image only wait for the lock file in a thread, while
+    # those going through the store or the build cache run in a thread.
+
+    async def exec_async(
+        self, command, options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS
+    ):
+        if self.result_cache is not None:
+            return await asyncio.to_thread(self.exec, command, options)
+        return await self.plan_exec(command, options).run_async()
+
+    async def pull_async(
+        self,
+        image_uri,
+        save_path=None,
+        options: PytainerOptionsPull = DEFAULT_PULL_OPTIONS,
+    ):
+        if self.store is not None:
+            return await asyncio.to_thread(self.pull, image_uri, save_path, options)
+        save_path = save_path or self.image_path
+        plan = self.plan_pull(image_uri, save_path, options)
+        return await self._produce_async(plan, save_path)
+
+    async def build_async(
+        self,
+        definition_file,
+        image_path,
+        options: PytainerOptionsBuild = DEFAULT_BUILD_OPTIONS,
+    ):
+        if self.build_cache is not None:
+            return await asyncio.to_thread(
+                self.build, definition_file, image_path, options
+            )
+        plan = self.plan_build(definition_file, image_path, options)
+        return await self._produce_async(plan, image_path)
+
+    async def _produce_async(self, plan, target):
+        if self.single_flight:
+            return await run_once_async(plan, target)
+        return await plan.run_async()
+
+    async def inspect_async(
+        self, options: PytainerOptionsInspect = DEFAULT_INSPECT_OPTIONS
+    ):
+        return await self.plan_inspect(options).run_async()
+
+    async def run_async(
+        self, command, options: PytainerOptionsRun = DEFAULT_RUN_OPTIONS
     ):
-        cmd = ["apptainer", "build", options.to_string(), image_path, definition_file]
-        return CommandHandler(cmd)
+        if self.result_cache is not None:
+            return await asyncio.to_thread(self.run, command, options)
+        return await self.plan_run(command, options).run_async()
 
-    def inspect(self, options: PytainerOptionsInspect = PytainerOptionsInspect()):
-        cmd = ["apptainer", "inspect", options.to_string(), self.image_path]
-        return CommandHandler(cmd)
+    # Streaming versions of exec and run. The output is yielded while the
+    # command runs instead of being buffered, see CommandStream for the
+    # keyword arguments.
 
-    def run(self, command, options: PytainerOptionsRun = PytainerOptionsRun()):
-        cmd = ["apptainer", "run", options.to_string(), self.image_path, command]
-        return CommandHandler(cmd)
+    def exec_stream(
+        self, command, options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS, **kwargs
+    ):
+        return self.plan_exec(command, options).stream(**kwargs)
+
+    def run_stream(
+        self, command, options: PytainerOptionsRun = DEFAULT_RUN_OPTIONS, **kwargs
+    ):
+        return self.plan_run(command, options).stream(**kwargs)
+
+    def exec_stream_async(
+        self, command, options: PytainerOptionsExec = DEFAULT_EXEC_OPTIONS, **kwargs
+    ):
+        return self.plan_exec(command, options).stream_async(**kwargs)
+
+    def run_stream_async(
+        self, command, options: PytainerOptionsRun = DEFAULT_RUN_OPTIONS, **kwargs
+    ):
+        return self.plan_run(command, options).stream_async(**kwargs)
 
     # Additional methods can be added here for other Apptainer functionalities
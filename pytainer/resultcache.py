@@ -0,0 +1,312 @@
+import base64
+import collections
+import hashlib
+import json
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+from .singleflight import SingleFlight
+from .store import file_digest
+from .utils import CommandHandler
+
+# Options after which the host environment no longer reaches the container.
+CLEAN_ENV_OPTIONS = {"--cleanenv", "-e", "--containall", "-C"}
+# Variables that are passed to the container even with a clean environment.
+ENV_PREFIXES = ("APPTAINERENV_", "APPTAINER_", "SINGULARITYENV_")
+
+
+class ResultCache:
+    """
+    Memoize the results of deterministic exec and run commands.
+
+    Entries are keyed by the sha256 of the image, the command line (with its
+    options), the environment that reaches the container and the working
+    directory. Only commands on local image files are cached, not those on
+    instances, sandboxes or remote images. Concurrent identical commands
+    share a single execution.
+
+    Args:
+    max_entries (int): Number of entries kept in memory, least recently
+        used first evicted.
+    ttl (float): Seconds after which an entry expires, never if None.
+    cache_dir (str): Directory of the on-disk tier, shared between
+        processes, disabled if None.
+    max_disk_entries (int): Number of entries kept on disk. The directory is
+        only trimmed once the entries written by this process may have
+        pushed it over the limit, down to 90% of it, so a directory shared
+        by several processes can temporarily hold more entries.
+    cache_failures (bool): Also cache the results of failed commands.
+    """
+
+    def __init__(
+        self,
+        max_entries=1024,
+        ttl=None,
+        cache_dir=None,
+        max_disk_entries=10000,
+        cache_failures=False,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.cache_failures = cache_failures
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._digests = {}
+        # Entries on disk as of the last trim, plus those written since
+        self._disk_entries = None
+        self._lock = threading.Lock()
+        self._flights = SingleFlight()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(max_entries={self.max_entries}, "
+            f"ttl={self.ttl})"
+        )
+
+    def image_digest(self, image_path):
+        """
+        Return the sha256 of an image file, memoized by its path, size and
+        modification time, or None if it is not a local file.
+        """
+        try:
+            stat = os.stat(image_path)
+        except (OSError, TypeError):
+            return None
+        if not os.path.isfile(image_path):
+            return None
+        path = os.path.realpath(image_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            memo = self._digests.get(path)
+        if memo is not None and memo[0] == signature:
+            return memo[1]
+        digest = file_digest(image_path)
+        with self._lock:
+            # Only the digest of the current version of each image is kept
+            self._digests[path] = (signature, digest)
+        return digest
+
+    def key(self, plan, image_path):
+        """Return the cache key of a plan run on `image_path`, or None."""
+        digest = self.image_digest(image_path)
+        if digest is None:
+            return None
+        argv = plan.command_flatten
+        if CLEAN_ENV_OPTIONS.intersection(_options(plan)):
+            environ = {
+                name: value
+                for name, value in os.environ.items()
+                if name.startswith(ENV_PREFIXES)
+            }
+        else:
+            environ = dict(os.environ)
+        data = {
+            "image": digest,
+            "command": argv,
+            "environ": sorted(environ.items()),
+            "cwd": os.getcwd(),
+            "capture": [
+                plan.capture.text,
+                plan.capture.stdout,
+                plan.capture.stderr,
+                plan.capture.limit,
+            ],
+        }
+        return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+    def run(self, plan, image_path):
+        """
+        Return the result of `plan` from the cache, running it on a miss.
+
+        Returns:
+        CommandHandler: The result of the command. On a hit, the command is
+            not run.
+        """
+        key = self.key(plan, image_path)
+        if key is None:
+            return plan.run()
+        entry = self._get(key)
+        if entry is None:
+            entry = self._flights.do(key, self._load, key, plan)
+        else:
+            with self._lock:
+                self.hits += 1
+        returncode, stdout, stderr = entry
+        completed = subprocess.CompletedProcess(
+            args=plan.command_flatten,
+            stdout=stdout,
+            stderr=stderr,
+            returncode=returncode,
+        )
+        return CommandHandler(plan.command, result=completed, text=plan.capture.text)
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                expires, entry = item
+                if expires is None or expires > now:
+                    self._entries.move_to_end(key)
+                    return entry
+                del self._entries[key]
+        item = self._read(key)
+        if item is None:
+            return None
+        self._remember(key, *item)
+        return item[1]
+
+    def _load(self, key, plan):
+        # A concurrent leader may have stored the entry in the meantime
+        entry = self._get(key)
+        if entry is not None:
+            with self._lock:
+                self.hits += 1
+            return entry
+        with self._lock:
+            self.misses += 1
+        result = plan.run()
+        entry = (result.returncode, *result.raw())
+        if result.has_succeeded() or self.cache_failures:
+            expires = None if self.ttl is None else time.time() + self.ttl
+            self._remember(key, expires, entry)
+            self._write(key, expires, entry)
+        return entry
+
+    def _remember(self, key, expires, entry):
+        with self._lock:
+            self._entries[key] = (expires, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read(self, key):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as fi:
+                data = json.load(fi)
+            expires = data["expires"]
+            if expires is not None and expires <= time.time():
+                os.remove(path)
+                return None
+            stdout, stderr = _decode(data["stdout"]), _decode(data["stderr"])
+            entry = (data["returncode"], stdout, stderr)
+            # The modification time orders the entries for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return expires, entry
+
+    def _write(self, key, expires, entry):
+        if self.cache_dir is None:
+            return
+        returncode, stdout, stderr = entry
+        data = {
+            "expires": expires,
+            "returncode": returncode,
+            "stdout": _encode(stdout),
+            "stderr": _encode(stderr),
+        }
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        try:
+            with open(tmp_path, "w") as fo:
+                json.dump(data, fo)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_entries is not None:
+                self._disk_entries += 1
+                if self._disk_entries <= self.max_disk_entries:
+                    return
+            # Concurrent writers count their entries instead of trimming too
+            self._disk_entries = 0
+        try:
+            remaining = self._evict()
+        except OSError:
+            remaining = None
+        with self._lock:
+            if remaining is None or self._disk_entries is None:
+                # Count again on the next write after a failure or a clear
+                self._disk_entries = None
+            else:
+                self._disk_entries += remaining
+
+    def _evict(self):
+        """
+        Remove the least recently used entries on disk, down to 90% of
+        `max_disk_entries` when over it, and return the number left.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((os.stat(path).st_mtime_ns, path))
+                except FileNotFoundError:
+                    continue
+        if len(entries) <= self.max_disk_entries:
+            return len(entries)
+        entries.sort()
+        keep = self.max_disk_entries * 9 // 10
+        for _, path in entries[: len(entries) - keep]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return keep
+
+    def stats(self):
+        """Return the number of hits, misses and entries in memory."""
+        with self._lock:
+            entries = len(self._entries)
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    def clear(self):
+        """Remove all the entries, in memory and on disk."""
+        with self._lock:
+            self._entries.clear()
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".json"):
+                    os.remove(os.path.join(self.cache_dir, name))
+            with self._lock:
+                self._disk_entries = None
+
+
+def _options(plan):
+    """
+    Return the apptainer options of a plan, the list between the subcommand
+    and the image, so that those of the command run in the container, e.g.
+    `make -C /src`, are not mistaken for them.
+    """
+    for part in plan.command:
+        if isinstance(part, list):
+            return part
+    return []
+
+
+def _encode(output):
+    if isinstance(output, bytes):
+        return {"base64": base64.b64encode(output).decode()}
+    return output
+
+
+def _decode(output):
+    if isinstance(output, dict):
+        return base64.b64decode(output["base64"])
+    return output
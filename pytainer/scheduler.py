@@ -0,0 +1,372 @@
+import collections
+import glob
+import math
+import os
+import re
+import threading
+from concurrent.futures import Future
+
+from .pytainer import DEFAULT_EXEC_OPTIONS, DEFAULT_RUN_OPTIONS, Pytainer
+
+SIZE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*$", re.IGNORECASE)
+UNITS = {"": 1, "b": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_size(size):
+    """Return a size in bytes, given as an int or as apptainer does, e.g. "2g"."""
+    if size is None:
+        return 0
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = SIZE.match(str(size))
+    if match is None:
+        raise ValueError(f"Invalid size {size!r}")
+    return int(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+
+def parse_cpu_list(cpus):
+    """Return the CPU ids of a list such as "0-3,8", as in --cpuset-cpus."""
+    result = set()
+    for part in str(cpus).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        result.update(range(int(first), int(last or first) + 1))
+    return result
+
+
+def format_cpu_list(cpus):
+    """Return the shortest list of ranges of CPU ids, e.g. "0-3,8"."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(
+        str(first) if first == last else f"{first}-{last}" for first, last in ranges
+    )
+
+
+class Topology:
+    """
+    CPUs and memory of the node the scheduler runs on.
+
+    Attributes:
+    cpus (list): Ids of the CPUs this process may run on.
+    nodes (dict): Maps each NUMA node to the list of its CPUs. Machines
+        without NUMA information have a single node 0.
+    memory (int): Available memory in bytes.
+    """
+
+    def __init__(self, cpus=None, nodes=None, memory=None):
+        self.cpus = sorted(cpus if cpus is not None else _allowed_cpus())
+        allowed = set(self.cpus)
+        nodes = nodes if nodes is not None else _numa_nodes()
+        self.nodes = {
+            node: sorted(allowed & set(node_cpus))
+            for node, node_cpus in nodes.items()
+            if allowed & set(node_cpus)
+        }
+        missing = allowed - {cpu for cpus in self.nodes.values() for cpu in cpus}
+        if missing or not self.nodes:
+            self.nodes.setdefault(0, [])
+            self.nodes[0] = sorted(set(self.nodes[0]) | missing)
+        self.memory = parse_size(memory) if memory is not None else _memory()
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(cpus={format_cpu_list(self.cpus)!r}, "
+            f"nodes={len(self.nodes)}, memory={self.memory})"
+        )
+
+    def node_of(self, cpu):
+        for node, cpus in self.nodes.items():
+            if cpu in cpus:
+                return node
+        return None
+
+
+def _allowed_cpus():
+    try:
+        return os.sched_getaffinity(0)
+    except AttributeError:
+        return range(os.cpu_count() or 1)
+
+
+def _numa_nodes():
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        try:
+            with open(path) as fi:
+                nodes[node] = sorted(parse_cpu_list(fi.read()))
+        except (OSError, ValueError):
+            continue
+    return nodes
+
+
+def _memory():
+    try:
+        with open("/proc/meminfo") as fi:
+            meminfo = dict(line.split(":", 1) for line in fi)
+        key = "MemAvailable" if "MemAvailable" in meminfo else "MemTotal"
+        return int(meminfo[key].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class Job:
+    """A command waiting for or holding resources of a ResourceScheduler."""
+
+    __slots__ = ("plan_factory", "cpus", "memory", "pinned", "future", "bypassed")
+
+    def __init__(self, plan_factory, cpus, memory, pinned):
+        self.plan_factory = plan_factory
+        self.cpus = cpus
+        self.memory = memory
+        # CPUs requested by the options of the job, if any
+        self.pinned = pinned
+        self.future = Future()
+        self.bypassed = 0
+
+
+class ResourceScheduler:
+    """
+    Run exec and run commands once the CPUs and memory they declare are free.
+
+    The requirements of a job are taken from its options (`--cpus`,
+    `--memory`, `--cpuset-cpus`) unless given explicitly. Each admitted job
+    gets its own `--cpuset-cpus`, disjoint from the ones of the other running
+    jobs and taken from a single NUMA node when possible, along with the
+    matching `--cpuset-mems`. Jobs are admitted in order. A job that fits may
+    start ahead of a blocked one, but a job is bypassed at most
+    `max_bypass` times, so large jobs are not starved.
+
+    Args:
+    pytainer (Pytainer): Runs the jobs.
+    cpus (int or iterable): Number or ids of the CPUs to schedule on,
+        defaults to the CPUs this process may run on.
+    memory (int or str): Memory to schedule, defaults to the available
+        memory.
+    pin (bool): Add `--cpuset-cpus` and `--cpuset-mems` to the options of the
+        jobs. Otherwise the scheduler only does admission control.
+    max_bypass (int): Number of times a job may be overtaken.
+    """
+
+    def __init__(self, pytainer=None, cpus=None, memory=None, pin=True, max_bypass=16):
+        self.pytainer = pytainer or Pytainer()
+        if isinstance(cpus, int):
+            cpus = sorted(_allowed_cpus())[:cpus]
+        self.topology = Topology(cpus=cpus, memory=memory)
+        self.pin = pin
+        self.max_bypass = max_bypass
+        self.free_cpus = set(self.topology.cpus)
+        self.free_memory = self.topology.memory
+        self._queue = collections.deque()
+        self._running = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._shutdown = False
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} {self.topology!r} "
+            f"running={self._running} queued={len(self._queue)}>"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def submit_exec(
+        self, command, options=DEFAULT_EXEC_OPTIONS, cpus=None, memory=None
+    ):
+        """
+        Queue `pytainer.exec(command, options)`, see `submit`.
+
+        Returns:
+        Future: Resolves to the CommandHandler of the command.
+        """
+        return self.submit("exec", command, options, cpus, memory)
+
+    def submit_run(self, command, options=DEFAULT_RUN_OPTIONS, cpus=None, memory=None):
+        return self.submit("run", command, options, cpus, memory)
+
+    def submit(self, subcommand, command, options, cpus=None, memory=None):
+        """
+        Queue a job running `command` with `subcommand`, "exec" or "run".
+
+        Args:
+        cpus (int): Number of CPUs needed, defaults to `--cpus` rounded up,
+            or 1.
+        memory (int or str): Memory needed, defaults to `--memory`, or 0.
+
+        Raises:
+        ValueError: If the job can never fit on the node.
+        RuntimeError: If the scheduler has been shut down.
+        """
+        plan = {"exec": self.pytainer.plan_exec, "run": self.pytainer.plan_run}
+        if subcommand not in plan:
+            raise ValueError(f"Cannot schedule {subcommand!r} commands")
+        declared = _declared(options)
+        pinned = None
+        if "--cpuset-cpus" in declared:
+            pinned = parse_cpu_list(declared["--cpuset-cpus"])
+        if cpus is None:
+            if pinned is not None:
+                cpus = len(pinned)
+            elif "--cpus" in declared:
+                cpus = math.ceil(float(declared["--cpus"]))
+            else:
+                cpus = 1
+        memory = parse_size(memory if memory is not None else declared.get("--memory"))
+        if pinned is not None and not pinned <= set(self.topology.cpus):
+            raise ValueError(f"CPUs {format_cpu_list(pinned)} are not scheduled")
+        if not 0 < cpus <= len(self.topology.cpus) or memory > self.topology.memory:
+            raise ValueError(
+                f"Job needing {cpus} CPUs and {memory} bytes does not fit in "
+                f"{self.topology!r}"
+            )
+
+        def plan_factory(assigned):
+            job_options = options
+            if self.pin and pinned is None:
+                job_options = options.with_cpuset_cpus(format_cpu_list(assigned))
+                nodes = {self.topology.node_of(cpu) for cpu in assigned}
+                if len(self.topology.nodes) > 1 and "--cpuset-mems" not in declared:
+                    mems = format_cpu_list(nodes)
+                    job_options = job_options.with_cpuset_mems(mems)
+            return plan[subcommand](command, job_options)
+
+        job = Job(plan_factory, cpus, memory, pinned)
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit jobs after shutdown")
+            self._queue.append(job)
+            started = self._admit()
+        self._start(started)
+        return job.future
+
+    def _admit(self):
+        """Take the jobs that can start from the queue, with their CPUs."""
+        started = []
+        blocked = []
+        for job in list(self._queue):
+            if job.future.cancelled():
+                self._queue.remove(job)
+                continue
+            if any(b.bypassed >= self.max_bypass for b in blocked):
+                break
+            assigned = self._allocate(job)
+            if assigned is None:
+                blocked.append(job)
+                continue
+            if not job.future.set_running_or_notify_cancel():
+                self._queue.remove(job)
+                continue
+            self._queue.remove(job)
+            for b in blocked:
+                b.bypassed += 1
+            self.free_cpus -= assigned
+            self.free_memory -= job.memory
+            self._running += 1
+            started.append((job, assigned))
+        return started
+
+    def _allocate(self, job):
+        if job.memory > self.free_memory:
+            return None
+        if job.pinned is not None:
+            return set(job.pinned) if job.pinned <= self.free_cpus else None
+        if job.cpus > len(self.free_cpus):
+            return None
+        free = {
+            node: [cpu for cpu in cpus if cpu in self.free_cpus]
+            for node, cpus in self.topology.nodes.items()
+        }
+        # Best fit: the node with the fewest free CPUs that can hold the job,
+        # so that large free nodes are kept for large jobs.
+        fitting = [node for node, cpus in free.items() if len(cpus) >= job.cpus]
+        if fitting:
+            node = min(fitting, key=lambda node: (len(free[node]), node))
+            return set(_contiguous(free[node], job.cpus))
+        assigned = []
+        for node in sorted(free, key=lambda node: -len(free[node])):
+            assigned.extend(free[node][: job.cpus - len(assigned)])
+        return set(assigned)
+
+    def _start(self, started):
+        for job, assigned in started:
+            try:
+                future = job.plan_factory(assigned).launch()
+            except BaseException as e:
+                self._release(job, assigned)
+                job.future.set_exception(e)
+                continue
+            future.add_done_callback(
+                lambda future, job=job, assigned=assigned: self._done(
+                    job, assigned, future
+                )
+            )
+
+    def _done(self, job, assigned, future):
+        self._release(job, assigned)
+        job.future.set_result(future.result())
+
+    def _release(self, job, assigned):
+        with self._lock:
+            self.free_cpus |= assigned
+            self.free_memory += job.memory
+            self._running -= 1
+            started = self._admit()
+            self._idle.notify_all()
+        self._start(started)
+
+    def map(self, commands, options=DEFAULT_EXEC_OPTIONS, cpus=None, memory=None):
+        """Run `exec` of each command, returning the results in order."""
+        futures = [self.submit_exec(c, options, cpus, memory) for c in commands]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self._running,
+                "queued": len(self._queue),
+                "free_cpus": len(self.free_cpus),
+                "free_memory": self.free_memory,
+            }
+
+    def shutdown(self, wait=True, cancel_queued=False):
+        """
+        Stop accepting jobs, optionally cancelling the queued ones, and wait
+        for the running and queued jobs to complete.
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_queued:
+                for job in self._queue:
+                    job.future.cancel()
+                self._queue.clear()
+            if wait:
+                self._idle.wait_for(lambda: not self._running and not self._queue)
+
+
+def _declared(options):
+    """Return the value of each option, e.g. {"--cpus": "2"}."""
+    return {
+        tokens[0]: tokens[1] if len(tokens) > 1 else None for tokens in options.options
+    }
+
+
+def _contiguous(cpus, count):
+    """Return `count` of `cpus`, preferring a run of consecutive ids."""
+    cpus = sorted(cpus)
+    for start in range(len(cpus) - count + 1):
+        window = cpus[start : start + count]
+        if window[-1] - window[0] == count - 1:
+            return window
+    return cpus[:count]
@@ -0,0 +1,295 @@
+import json
+import mmap
+import struct
+import uuid
+from dataclasses import dataclass
+
+from .metadata import ImageMetadata
+
+SIF_MAGIC = b"SIF_MAGIC\0"
+
+# Global header and descriptor layouts of the Singularity Image Format, see
+# https://github.com/apptainer/sif. All fields are little endian and packed.
+HEADER = struct.Struct("<32s10s3s3s16sqqqqqqqq")
+DESCRIPTOR = struct.Struct("<iBIIIqqqqqqq128s384s")
+PARTITION = struct.Struct("<ii3s")
+GROUP_MASK = 0xF0000000
+
+DATA_DEFFILE = 0x4001
+DATA_ENVVAR = 0x4002
+DATA_LABELS = 0x4003
+DATA_PARTITION = 0x4004
+DATA_SIGNATURE = 0x4005
+DATA_GENERIC_JSON = 0x4006
+DATA_GENERIC = 0x4007
+DATA_CRYPTO_MESSAGE = 0x4008
+DATA_SBOM = 0x4009
+DATA_OCI_ROOT_INDEX = 0x400A
+DATA_OCI_BLOB = 0x400B
+
+DATA_TYPES = {
+    DATA_DEFFILE: "Def.FILE",
+    DATA_ENVVAR: "Env.Vars",
+    DATA_LABELS: "JSON.Labels",
+    DATA_PARTITION: "FS",
+    DATA_SIGNATURE: "Signature",
+    DATA_GENERIC_JSON: "JSON.Generic",
+    DATA_GENERIC: "Generic/Raw",
+    DATA_CRYPTO_MESSAGE: "Cryptographic Message",
+    DATA_SBOM: "SBOM",
+    DATA_OCI_ROOT_INDEX: "OCI.RootIndex",
+    DATA_OCI_BLOB: "OCI.Blob",
+}
+
+FS_TYPES = {
+    1: "Squashfs",
+    2: "Ext3",
+    3: "Data.Archive",
+    4: "Raw",
+    5: "Encrypted squashfs",
+}
+PART_TYPES = {1: "System", 2: "*System", 3: "Data", 4: "Overlay"}
+ARCHITECTURES = {
+    "01": "386",
+    "02": "amd64",
+    "03": "arm",
+    "04": "arm64",
+    "05": "ppc64",
+    "06": "ppc64le",
+    "07": "mips",
+    "08": "mipsle",
+    "09": "mips64",
+    "10": "mips64le",
+    "11": "s390x",
+    "12": "riscv64",
+}
+
+
+def _cstring(data):
+    return data.split(b"\0", 1)[0].decode(errors="replace")
+
+
+@dataclass(frozen=True)
+class SIFPartition:
+    fstype: str
+    parttype: str
+    arch: str
+
+
+@dataclass(frozen=True)
+class SIFDescriptor:
+    """A data object of a SIF image. `offset` and `size` locate its data."""
+
+    datatype: int
+    id: int
+    group_id: int
+    linked_id: int
+    offset: int
+    size: int
+    size_with_padding: int
+    created_at: int
+    modified_at: int
+    name: str
+    extra: bytes
+
+    @property
+    def type_name(self):
+        return DATA_TYPES.get(self.datatype, hex(self.datatype))
+
+    @property
+    def partition(self):
+        """The partition information of a partition descriptor, else None."""
+        if self.datatype != DATA_PARTITION:
+            return None
+        fstype, parttype, arch = PARTITION.unpack_from(self.extra)
+        return SIFPartition(
+            fstype=FS_TYPES.get(fstype, str(fstype)),
+            parttype=PART_TYPES.get(parttype, str(parttype)),
+            arch=ARCHITECTURES.get(_cstring(arch), _cstring(arch)),
+        )
+
+
+class SIFImage:
+    """
+    Read the metadata of a SIF image without spawning apptainer.
+
+    The image is memory-mapped and only the global header and the descriptor
+    table are parsed. Data objects are read on demand, and `data` returns a
+    zero-copy view, so the squashfs partitions are never copied.
+
+    Args:
+    path (str): Path of the SIF image.
+
+    Raises:
+    ValueError: If the file is not a SIF image.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fi:
+            try:
+                self._mmap = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"{path} is not a SIF image") from None
+        try:
+            self._parse()
+        except (ValueError, struct.error) as e:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a SIF image: {e}") from None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.path!r})"
+
+    def close(self):
+        self._mmap.close()
+
+    def _parse(self):
+        (
+            launch,
+            magic,
+            version,
+            arch,
+            image_id,
+            self.created_at,
+            self.modified_at,
+            self.descriptors_free,
+            self.descriptors_total,
+            descriptors_offset,
+            descriptors_size,
+            self.data_offset,
+            self.data_size,
+        ) = HEADER.unpack_from(self._mmap)
+        if magic != SIF_MAGIC:
+            raise ValueError("bad magic")
+        self.launch_script = _cstring(launch)
+        self.version = _cstring(version)
+        self.arch = ARCHITECTURES.get(_cstring(arch), _cstring(arch))
+        self.id = uuid.UUID(bytes=image_id)
+        if descriptors_offset + descriptors_size > len(self._mmap):
+            raise ValueError("truncated descriptor table")
+        self.descriptors = []
+        for index in range(self.descriptors_total):
+            offset = descriptors_offset + index * DESCRIPTOR.size
+            fields = DESCRIPTOR.unpack_from(self._mmap, offset)
+            if not fields[1]:
+                continue
+            descriptor = SIFDescriptor(
+                datatype=fields[0],
+                id=fields[2],
+                group_id=fields[3] & ~GROUP_MASK,
+                linked_id=fields[4],
+                offset=fields[5],
+                size=fields[6],
+                size_with_padding=fields[7],
+                created_at=fields[8],
+                modified_at=fields[9],
+                name=_cstring(fields[12]),
+                extra=fields[13],
+            )
+            if descriptor.offset + descriptor.size > len(self._mmap):
+                raise ValueError(f"descriptor {descriptor.id} out of bounds")
+            self.descriptors.append(descriptor)
+
+    def find(self, datatype):
+        """Return the descriptors of the given data type."""
+        return [d for d in self.descriptors if d.datatype == datatype]
+
+    def data(self, descriptor):
+        """Return a zero-copy memoryview of the data of a descriptor."""
+        view = memoryview(self._mmap)
+        return view[descriptor.offset : descriptor.offset + descriptor.size]
+
+    def read(self, descriptor):
+        """Return the data of a descriptor as bytes."""
+        return self._mmap[descriptor.offset : descriptor.offset + descriptor.size]
+
+    def _read_last(self, datatype):
+        descriptors = self.find(datatype)
+        if not descriptors:
+            return None
+        return self.read(descriptors[-1])
+
+    def deffile(self):
+        data = self._read_last(DATA_DEFFILE)
+        return None if data is None else data.decode(errors="replace")
+
+    def environment(self):
+        data = self._read_last(DATA_ENVVAR)
+        return None if data is None else data.decode(errors="replace")
+
+    def labels(self):
+        data = self._read_last(DATA_LABELS)
+        if data is not None:
+            return json.loads(data)
+        metadata = self._inspect_metadata()
+        if metadata is not None:
+            return metadata["data"]["attributes"].get("labels") or {}
+        return None
+
+    def partitions(self):
+        """Return (descriptor, SIFPartition) pairs of the partitions."""
+        return [(d, d.partition) for d in self.find(DATA_PARTITION)]
+
+    def _inspect_metadata(self):
+        """
+        Return the metadata apptainer stores as a JSON object at build time,
+        in the format of `apptainer inspect --json`, or None.
+        """
+        for descriptor in reversed(self.find(DATA_GENERIC_JSON)):
+            try:
+                data = json.loads(self.read(descriptor))
+            except ValueError:
+                continue
+            if isinstance(data, dict) and "attributes" in data.get("data", {}):
+                return data
+        return None
+
+    def metadata(self, complete=False):
+        """
+        Return the metadata of the image.
+
+        Args:
+        complete (bool): Only return metadata that holds everything
+            `apptainer inspect --all` reports, i.e. the JSON metadata stored
+            by apptainer at build time.
+
+        Returns:
+        ImageMetadata: The metadata, or None if the image does not hold it.
+        """
+        data = self._inspect_metadata()
+        if data is not None:
+            return ImageMetadata.from_json(data)
+        if complete:
+            return None
+        labels = self.labels()
+        deffile = self.deffile()
+        environment = self.environment()
+        if labels is None and deffile is None and environment is None:
+            return None
+        return ImageMetadata(
+            labels=labels or {},
+            environment={"": environment} if environment else {},
+            deffile=deffile,
+        )
+
+
+def is_sif(path):
+    """Return whether `path` is a SIF image."""
+    try:
+        with open(path, "rb") as fi:
+            header = fi.read(HEADER.size)
+    except OSError:
+        return False
+    return len(header) == HEADER.size and header[32:42] == SIF_MAGIC
+
+
+def read_metadata(path, complete=False):
+    """Return the metadata of a SIF image, see SIFImage.metadata."""
+    with SIFImage(path) as image:
+        return image.metadata(complete=complete)
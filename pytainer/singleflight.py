@@ -0,0 +1,229 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
+from .utils import make_result
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls within a process.
+
+    While a call for a key is running, further calls with the same key wait
+    for it and share its result (or exception) instead of running again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._leave(key)
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        Coroutine counterpart of `do`, where `fn` is a coroutine function.
+        Calls are shared with those of `do` for the same key.
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._leave(key)
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            # A cancelled follower must not cancel the call of the others
+            future.set_running_or_notify_cancel()
+            return future, True
+
+    def _leave(self, key):
+        with self._lock:
+            del self._calls[key]
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive lock on `path` across processes. The lock file is
+    created if needed and yielded open for reading and writing.
+    """
+    lock = _acquire(path)
+    try:
+        yield lock
+    finally:
+        _release(lock)
+
+
+@asynccontextmanager
+async def file_lock_async(path):
+    """
+    Asynchronous counterpart of `file_lock`, waiting for the lock in a thread
+    so that the event loop is not blocked.
+    """
+    task = asyncio.ensure_future(asyncio.to_thread(_acquire, path))
+    try:
+        lock = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # Release the lock once the thread obtains it
+        task.add_done_callback(
+            lambda task: task.cancelled()
+            or task.exception() is not None
+            or _release(task.result())
+        )
+        raise
+    try:
+        yield lock
+    finally:
+        _release(lock)
+
+
+def _acquire(path):
+    lock = open(path, "a+")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    except BaseException:
+        lock.close()
+        raise
+    return lock
+
+
+def _release(lock):
+    try:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    finally:
+        lock.close()
+
+
+def lock_path(target):
+    """
+    Return the path of the lock file of `target`, in a directory of the user
+    on the node, so that no lock file is left next to the target.
+    """
+    directory = os.path.join(tempfile.gettempdir(), f"pytainer-{os.getuid()}", "locks")
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    digest = hashlib.sha256(os.path.abspath(target).encode()).hexdigest()
+    return os.path.join(directory, f"{digest}.lock")
+
+
+_FLIGHTS = SingleFlight()
+
+
+def run_once(plan, target):
+    """
+    Run a plan that produces `target`, such as a pull or a build, so that only
+    one command produces a given target at a time on the node.
+
+    Within the process, concurrent identical plans share a single execution.
+    Across processes, the command holds the lock file of the target, see
+    `lock_path`. A process that waited for the lock does not run its command
+    again when the target has been produced in the meantime by the same
+    command.
+
+    Returns:
+    CommandHandler: The result of the command, or a successful result if the
+        target was produced by another process.
+    """
+    target = os.path.abspath(target)
+    key = (target, tuple(plan.command_flatten))
+    return _FLIGHTS.do(key, _run_locked, plan, target)
+
+
+async def run_once_async(plan, target):
+    """
+    Coroutine counterpart of `run_once`. The command runs in the event loop
+    and is killed if the coroutine is cancelled, only the wait for the lock
+    file takes a thread.
+    """
+    target = os.path.abspath(target)
+    key = (target, tuple(plan.command_flatten))
+    return await _FLIGHTS.do_async(key, _run_locked_async, plan, target)
+
+
+def _run_locked(plan, target):
+    before = _signature(target)
+    with file_lock(lock_path(target)) as lock:
+        result = _produced(plan, target, before, lock)
+        if result is None:
+            result = plan.run()
+            _record(plan, result, lock)
+        return result
+
+
+async def _run_locked_async(plan, target):
+    before = _signature(target)
+    async with file_lock_async(lock_path(target)) as lock:
+        result = _produced(plan, target, before, lock)
+        if result is None:
+            result = await plan.run_async()
+            _record(plan, result, lock)
+        return result
+
+
+def _produced(plan, target, before, lock):
+    """
+    Return a successful result if `target` was produced by the same command
+    while waiting for the lock, None otherwise.
+    """
+    after = _signature(target)
+    produced = after is not None and after != before
+    if produced and _producer(lock) == plan.command_flatten:
+        return make_result(
+            plan.command,
+            stderr=f"INFO:    {target} produced by a concurrent command\n",
+        )
+    return None
+
+
+def _record(plan, result, lock):
+    if result.has_succeeded():
+        lock.seek(0)
+        lock.truncate()
+        json.dump({"command": plan.command_flatten}, lock)
+        lock.flush()
+
+
+def _signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _producer(lock):
+    lock.seek(0)
+    try:
+        return json.load(lock)["command"]
+    except (ValueError, KeyError):
+        return None
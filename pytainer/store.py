@@ -0,0 +1,286 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+from .singleflight import SingleFlight, file_lock
+from .utils import CommandHandler, flatten, make_result
+
+_FLIGHTS = SingleFlight()
+
+
+class ImageStore:
+    """
+    Local content-addressed store of pulled images.
+
+    Each image is stored once under `<root>/blobs/<sha256>.sif` and linked
+    into the paths requested by `Pytainer.pull`. The index maps every source
+    URI to the digest of the image it resolved to, so identical images pulled
+    from different URIs share a single file. The size and last use time of
+    each image are recorded, and the least recently used images are evicted
+    once the store grows over `max_size` bytes. Images still placed at a path
+    through a hard link or a symbolic link are not evicted, since removing
+    them would free no space or leave a dangling link, so the store can stay
+    over `max_size` while they are in use. With `link="copy"`, any image can
+    be evicted.
+
+    A URI found in the index is not pulled again unless the pull options
+    contain `--force`.
+
+    Args:
+    root (str): Directory of the store, created if needed.
+    max_size (int): Maximum size of the store in bytes, unbounded if None.
+    link (str): How images are placed at the requested path, one of
+        "hardlink", "symlink" or "copy". Hard links fall back to symbolic
+        links across file systems.
+    """
+
+    LINK_MODES = ("hardlink", "symlink", "copy")
+
+    def __init__(self, root, max_size=None, link="hardlink"):
+        if link not in self.LINK_MODES:
+            raise ValueError(f"link must be one of {self.LINK_MODES}, not {link!r}")
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.link = link
+        self.blobs_dir = os.path.join(self.root, "blobs")
+        self.tmp_dir = os.path.join(self.root, "tmp")
+        self.index_path = os.path.join(self.root, "index.json")
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.root!r}, max_size={self.max_size})"
+
+    def blob_path(self, digest):
+        return os.path.join(self.blobs_dir, f"{digest}.sif")
+
+    @contextmanager
+    def _locked_index(self):
+        """Lock the index across processes and yield it for modification."""
+        with open(os.path.join(self.root, "index.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self._read_index()
+            yield index
+            self._write_index(index)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as fi:
+                return json.load(fi)
+        except FileNotFoundError:
+            return {"uris": {}, "blobs": {}}
+
+    def _write_index(self, index):
+        tmp_path = f"{self.index_path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as fo:
+            json.dump(index, fo, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, uri):
+        """
+        Return the path of the stored image of `uri`, or None if the store
+        does not hold it.
+        """
+        with self._locked_index() as index:
+            digest = index["uris"].get(uri)
+            if digest is None:
+                return None
+            if not os.path.exists(self.blob_path(digest)):
+                self._forget(index, digest)
+                return None
+            index["blobs"][digest]["last_used"] = time.time()
+            return self.blob_path(digest)
+
+    def add(self, uri, image_path):
+        """
+        Move the image at `image_path`, obtained from `uri`, into the store.
+
+        Returns:
+        str: The path of the stored image.
+        """
+        digest = file_digest(image_path)
+        blob = self.blob_path(digest)
+        with self._locked_index() as index:
+            if os.path.exists(blob):
+                os.remove(image_path)
+            else:
+                os.replace(image_path, blob)
+            index["uris"][uri] = digest
+            entry = index["blobs"].setdefault(digest, {})
+            entry["size"] = os.path.getsize(blob)
+            entry["last_used"] = time.time()
+            self._evict(index, keep=digest)
+        return blob
+
+    def _fetch(self, pytainer, image_uri, options, force):
+        """
+        Pull `image_uri` into the store unless it is already there, holding a
+        lock so that a single process pulls a given URI at a time.
+
+        Returns:
+        tuple: The CommandHandler of the pull and the path of the stored
+            image, None if the pull failed.
+        """
+        uri_digest = hashlib.sha256(image_uri.encode()).hexdigest()
+        with file_lock(os.path.join(self.tmp_dir, f"{uri_digest}.lock")):
+            blob = None if force else self.get(image_uri)
+            if blob is not None:
+                result = make_result(
+                    [], stderr=f"INFO:    Using image {blob} from the store\n"
+                )
+            else:
+                tmp_path = os.path.join(self.tmp_dir, f"{uuid.uuid4().hex}.sif")
+                result = pytainer.plan_pull(image_uri, tmp_path, options).run()
+                if result.has_failed():
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    return result, None
+                blob = self.add(image_uri, tmp_path)
+        return result, blob
+
+    def size(self):
+        """Return the total size in bytes of the stored images."""
+        return sum(blob["size"] for blob in self._read_index()["blobs"].values())
+
+    def entries(self):
+        """
+        Return the stored images as a dict mapping each digest to its size,
+        last use time and source URIs.
+        """
+        index = self._read_index()
+        entries = {
+            digest: dict(blob, uris=[]) for digest, blob in index["blobs"].items()
+        }
+        for uri, digest in index["uris"].items():
+            entries[digest]["uris"].append(uri)
+        return entries
+
+    def evict(self, digest):
+        """
+        Remove the image with the given digest from the store, even if it is
+        still linked from a placed path.
+        """
+        with self._locked_index() as index:
+            self._forget(index, digest)
+
+    def _forget(self, index, digest):
+        index["blobs"].pop(digest, None)
+        index["uris"] = {
+            uri: value for uri, value in index["uris"].items() if value != digest
+        }
+        if os.path.exists(self.blob_path(digest)):
+            os.remove(self.blob_path(digest))
+
+    def _evict(self, index, keep=None):
+        if self.max_size is None:
+            return
+        blobs = sorted(index["blobs"].items(), key=lambda item: item[1]["last_used"])
+        total = sum(blob["size"] for _, blob in blobs)
+        for digest, blob in blobs:
+            if total <= self.max_size:
+                break
+            if digest == keep or self._in_use(digest, blob):
+                continue
+            self._forget(index, digest)
+            total -= blob["size"]
+
+    def _in_use(self, digest, blob):
+        """
+        Return whether a placed path still links to the image, pruning the
+        symbolic links that were removed or replaced since.
+        """
+        path = self.blob_path(digest)
+        try:
+            if os.stat(path).st_nlink > 1:
+                return True
+        except FileNotFoundError:
+            return False
+        blob["symlinks"] = [
+            link
+            for link in blob.get("symlinks", [])
+            if os.path.islink(link) and os.readlink(link) == path
+        ]
+        return bool(blob["symlinks"])
+
+    def place(self, blob, path, force=False):
+        """Make the stored image `blob` available at `path`."""
+        link = place_file(blob, path, link=self.link, force=force)
+        if link == "symlink":
+            digest = os.path.basename(blob)[: -len(".sif")]
+            with self._locked_index() as index:
+                entry = index["blobs"].get(digest)
+                if entry is not None:
+                    symlinks = entry.setdefault("symlinks", [])
+                    symlinks.append(os.path.abspath(path))
+
+    def pull(self, pytainer, image_uri, save_path, options):
+        """
+        Pull `image_uri` to `save_path` through the store.
+
+        The image is only pulled if the store does not already hold it.
+
+        Returns:
+        CommandHandler: The result of the pull. When the image came from the
+            store, the command is not run and the result is successful.
+        """
+        save_path = save_path or pytainer.image_path
+        plan = pytainer.plan_pull(image_uri, save_path, options)
+        force = "--force" in flatten(plan.command)
+        key = (self.root, image_uri, force)
+        result, blob = _FLIGHTS.do(
+            key, self._fetch, pytainer, image_uri, options, force
+        )
+        if blob is None:
+            return CommandHandler(plan.command, result=result.result)
+        try:
+            self.place(blob, save_path, force=force)
+        except OSError as e:
+            stderr = f"FATAL:   {e}\n"
+            return make_result(plan.command, returncode=255, stderr=stderr)
+        return make_result(plan.command, stdout=result.stdout, stderr=result.stderr)
+
+
+def place_file(source, path, link="hardlink", force=False):
+    """
+    Make the file `source` available at `path` by linking or copying it, see
+    ImageStore. The file is replaced atomically if it exists and `force` is
+    True.
+
+    Returns:
+    str: How the file was placed, "hardlink", "symlink" or "copy".
+
+    Raises:
+    FileExistsError: If `path` exists and `force` is False.
+    """
+    path = os.path.abspath(path)
+    if os.path.lexists(path) and not force:
+        raise FileExistsError(f"Image file already exists: {path}")
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}"
+    )
+    if link == "copy":
+        shutil.copyfile(source, tmp_path)
+    elif link == "hardlink":
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            os.symlink(source, tmp_path)
+            link = "symlink"
+    else:
+        os.symlink(source, tmp_path)
+    os.replace(tmp_path, path)
+    return link
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as fi:
+        while chunk := fi.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,191 @@
+"""
+Per-call tracing of apptainer invocations.
+
+Hooks registered with `add_hook` receive a TraceRecord for every command
+run by pytainer, with the time spent in each phase of the call:
+
+    options       serialization of the options into argv tokens
+    assembly      assembly of the command line
+    spawn         creation of the apptainer process
+    first_output  wait for the first byte of output, if any
+    exit          wait for the process to exit
+    decode        creation of the result, whose output is decoded lazily
+
+Records also carry the number of bytes written by the command on stdout and
+stderr. While no hook is registered, tracing costs a single truth test per
+call.
+"""
+
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+_HOOKS = []
+_START_HOOKS = []
+_LOCK = threading.Lock()
+
+
+class TraceRecord:
+    """
+    Timings of a single command.
+
+    Attributes:
+    command (list): The argv of the command.
+    subcommand (str): The apptainer subcommand, e.g. "exec".
+    image (str): The image, instance or URI the command targets.
+    returncode (int): The return code of the command.
+    start (float): Wall-clock time at which the command was started.
+    phases (dict): Duration in seconds of each phase, in order.
+    stdout_bytes (int): Number of bytes written on stdout.
+    stderr_bytes (int): Number of bytes written on stderr.
+    """
+
+    __slots__ = (
+        "command",
+        "subcommand",
+        "image",
+        "returncode",
+        "start",
+        "phases",
+        "stdout_bytes",
+        "stderr_bytes",
+    )
+
+    def __init__(
+        self,
+        command,
+        subcommand,
+        image,
+        returncode,
+        start,
+        phases,
+        stdout_bytes=0,
+        stderr_bytes=0,
+    ):
+        self.command = command
+        self.subcommand = subcommand
+        self.image = image
+        self.returncode = returncode
+        self.start = start
+        self.phases = phases
+        self.stdout_bytes = stdout_bytes
+        self.stderr_bytes = stderr_bytes
+
+    def __repr__(self) -> str:
+        phases = " ".join(
+            f"{name}={value * 1e3:.3f}ms" for name, value in self.phases.items()
+        )
+        return (
+            f"<{self.__class__.__name__} {self.subcommand} {self.image} "
+            f"returncode={self.returncode} {phases}>"
+        )
+
+    @property
+    def duration(self):
+        return sum(self.phases.values())
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Span:
+    """
+    Measure the phases of a command, see `start`.
+
+    The code reading the output of the command adds to `stdout_bytes` and
+    `stderr_bytes`.
+    """
+
+    __slots__ = ("plan", "phases", "start", "stdout_bytes", "stderr_bytes", "_last")
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.phases = dict(plan.phases or {})
+        self.start = time.time()
+        self.stdout_bytes = 0
+        self.stderr_bytes = 0
+        self._last = time.perf_counter()
+        for hook in list(_START_HOOKS):
+            _call(hook, plan)
+
+    def mark(self, phase):
+        """End `phase`, which started at the end of the previous one."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def finish(self, returncode):
+        """
+        Send the record of the command to the hooks.
+
+        `returncode` is None if the command was interrupted before its exit
+        could be observed, e.g. when an asyncio task is cancelled.
+        """
+        record = TraceRecord(
+            command=self.plan.command_flatten,
+            subcommand=self.plan.subcommand,
+            image=self.plan.image,
+            returncode=returncode,
+            start=self.start,
+            phases=self.phases,
+            stdout_bytes=self.stdout_bytes,
+            stderr_bytes=self.stderr_bytes,
+        )
+        for hook in list(_HOOKS):
+            _call(hook, record)
+
+
+def _call(hook, argument):
+    try:
+        hook(argument)
+    except Exception as e:
+        warnings.warn(f"pytainer tracing hook {hook!r} failed: {e!r}")
+
+
+def enabled():
+    """Return whether any hook is registered."""
+    return bool(_HOOKS)
+
+
+def start(plan):
+    """Return a Span for a run of `plan`, or None if tracing is disabled."""
+    if not _HOOKS:
+        return None
+    return Span(plan)
+
+
+def add_hook(hook, on_start=None):
+    """
+    Call `hook(record)` with the TraceRecord of every command, and
+    `on_start(plan)` with the CommandPlan of every command when it starts.
+    """
+    with _LOCK:
+        _HOOKS.append(hook)
+        if on_start is not None:
+            _START_HOOKS.append(on_start)
+
+
+def remove_hook(hook, on_start=None):
+    with _LOCK:
+        _HOOKS.remove(hook)
+        if on_start is not None:
+            _START_HOOKS.remove(on_start)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the TraceRecord of the commands run within the block.
+
+    Example:
+        with tracing.collect() as records:
+            pytnr.exec("ls /")
+        print(records[0].phases)
+    """
+    records = []
+    add_hook(records.append)
+    try:
+        yield records
+    finally:
+        remove_hook(records.append)
@@ -1,52 +1,877 @@
+import asyncio
+import codecs
+import collections
+import io
+import os
+import selectors
+import shlex
 import subprocess
+import threading
+from concurrent.futures import CancelledError
+from dataclasses import dataclass
 
+from . import tracing
 
-class CommandHandler(subprocess.CompletedProcess):
-    def __init__(self, command):
+
+@dataclass(frozen=True, slots=True)
+class CaptureOptions:
+    """
+    How the output of a command is kept in its CommandHandler.
+
+    Attributes:
+    text (bool): Return stdout and stderr as str, decoded on first access as
+        `text=True` would. Otherwise they are returned as bytes.
+    stdout (bool): Capture stdout. When False, it is sent to /dev/null and
+        `stdout` is None.
+    stderr (bool): Capture stderr, see `stdout`.
+    limit (int): Keep at most this many bytes of each stream, the rest of the
+        output is read and dropped.
+    """
+
+    text: bool = True
+    stdout: bool = True
+    stderr: bool = True
+    limit: int | None = None
+
+    @property
+    def complete(self):
+        """Whether both streams are captured in full."""
+        return self.stdout and self.stderr and self.limit is None
+
+
+DEFAULT_CAPTURE = CaptureOptions()
+
+
+class CommandHandler:
+    """
+    Result of a command.
+
+    The output is stored as it was read and only decoded when `stdout` or
+    `stderr` is first accessed, so results whose output is never looked at
+    cost no decoding. The interface is the one of subprocess.CompletedProcess.
+
+    Args:
+    command (list): The command, possibly nested. It is run if `result` is
+        None.
+    result: A CompletedProcess or CommandHandler whose output and return code
+        are taken over, as str or bytes.
+    text (bool): Whether `stdout` and `stderr` are str or bytes.
+    backend: Runs the command if `result` is None, see CommandPlan.
+    """
+
+    __slots__ = ("command", "returncode", "text", "_stdout", "_stderr")
+
+    def __init__(self, command, result=None, text=True, backend=None):
         self.command = command
-        self.command_flatten = flatten(self.command)
-        self.result = run_command(self.command_flatten)
-        self.stdout = self.result.stdout
-        self.stderr = self.result.stderr
-        self.returncode = self.result.returncode
+        self.text = text
+        if result is None:
+            if backend is None:
+                result = run_command(flatten(self.command))
+            else:
+                result = backend.run(flatten(self.command))
+        if isinstance(result, CommandHandler):
+            self._stdout, self._stderr = result._stdout, result._stderr
+        else:
+            self._stdout, self._stderr = result.stdout, result.stderr
+        self.returncode = result.returncode
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(args={self.command_flatten!r}, "
+            f"returncode={self.returncode})"
+        )
+
+    @property
+    def command_flatten(self):
+        return flatten(self.command)
+
+    @property
+    def args(self):
+        return self.command_flatten
+
+    @property
+    def result(self):
+        # Kept for compatibility, the handler used to wrap a CompletedProcess
+        return self
+
+    @property
+    def stdout(self):
+        self._stdout = self._convert(self._stdout)
+        return self._stdout
+
+    @property
+    def stderr(self):
+        self._stderr = self._convert(self._stderr)
+        return self._stderr
+
+    def raw(self):
+        """Return stdout and stderr as stored, bytes until they are decoded."""
+        return self._stdout, self._stderr
+
+    def _convert(self, output):
+        if self.text and isinstance(output, bytes):
+            return decode_output(output)
+        if not self.text and isinstance(output, str):
+            return output.encode()
+        return output
+
+    def check_returncode(self):
+        """Raise CalledProcessError if the command failed."""
+        if self.returncode:
+            raise subprocess.CalledProcessError(
+                self.returncode, self.command_flatten, self.stdout, self.stderr
+            )
 
     def has_failed(self):
-        if self.result.returncode != 0:
+        if self.returncode != 0:
             return True
         else:
             return False
 
     def has_succeeded(self):
-        if self.result.returncode == 0:
+        if self.returncode == 0:
             return True
         else:
             return False
 
     def get_stdout(self):
-        return self.result.stdout
+        return self.stdout
 
     def get_stderr(self):
-        return self.result.stderr
+        return self.stderr
 
     def get_returncode(self):
-        return self.result.returncode
+        return self.returncode
 
     def get_command(self):
         return self.command
 
+    @classmethod
+    async def create_async(cls, command, backend=None):
+        return await CommandPlan(command, backend=backend).run_async()
 
-def run_command(command: str | list):
-    try:
-        command = " ".join(command)
-        result = subprocess.run(
-            command, capture_output=True, shell=True, text=True, check=True
+
+class CommandPlan:
+    """
+    An inert and reusable description of a command.
+
+    Nothing is executed when the plan is built. Each call to `run`,
+    `run_async`, `launch` or `stream` starts a new process, so a plan can be
+    queued, retried or handed over to another thread.
+
+    Processes are started by `backend`, see pytainer.backends, or by
+    subprocess if it is None.
+    """
+
+    def __init__(
+        self,
+        command,
+        subcommand=None,
+        image=None,
+        capture=DEFAULT_CAPTURE,
+        backend=None,
+    ):
+        self.command = command
+        self.command_flatten = flatten(self.command)
+        self.subcommand = subcommand
+        self.image = image
+        self.capture = capture
+        self.backend = backend
+        # Durations of the phases spent building the plan, see tracing.
+        self.phases = None
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({shlex.join(self.command_flatten)})"
+
+    def run(self):
+        """Run the command and wait for it to complete."""
+        span = tracing.start(self)
+        if self.backend is None:
+            result = run_command(self.command_flatten, self.capture, span)
+        else:
+            result = self.backend.run(self.command_flatten, self.capture, span)
+        handler = CommandHandler(self.command, result=result, text=self.capture.text)
+        if span is not None:
+            span.mark("decode")
+            span.finish(handler.returncode)
+        return handler
+
+    async def run_async(self):
+        """Run the command in an asyncio subprocess."""
+        span = tracing.start(self)
+        if self.backend is None:
+            run = run_command_async
+        else:
+            run = self.backend.run_async
+        try:
+            result = await run(self.command_flatten, self.capture, span)
+        except BaseException:
+            if span is not None:
+                span.finish(None)
+            raise
+        handler = CommandHandler(self.command, result=result, text=self.capture.text)
+        if span is not None:
+            span.mark("decode")
+            span.finish(handler.returncode)
+        return handler
+
+    def launch(self):
+        """Start the command without waiting for it, see CommandFuture."""
+        return CommandFuture(self)
+
+    def stream(self, **kwargs):
+        return CommandStream(
+            self.command, span=tracing.start(self), backend=self.backend, **kwargs
         )
-        return result
-    except subprocess.CalledProcessError as e:
+
+    def stream_async(self, **kwargs):
+        return AsyncCommandStream(
+            self.command, span=tracing.start(self), backend=self.backend, **kwargs
+        )
+
+    def get_command(self):
+        return self.command
+
+
+class CommandFuture:
+    """
+    Handle on a command started by CommandPlan.launch.
+
+    The output is collected in a background thread. The interface follows
+    concurrent.futures.Future: `result` returns the CommandHandler of the
+    command once it has completed.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.process = None
+        self._result = None
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._span = tracing.start(plan)
+        try:
+            self.process = spawn(plan.command_flatten, plan.capture, plan.backend)
+        except OSError as e:
+            self._set_result(spawn_error(plan.command_flatten, e))
+            return
+        if self._span is not None:
+            self._span.mark("spawn")
+        threading.Thread(target=self._communicate, daemon=True).start()
+
+    def __repr__(self) -> str:
+        if self.cancelled():
+            state = "cancelled"
+        elif self.done():
+            state = f"finished returncode={self._result.returncode}"
+        else:
+            state = "running"
+        return f"<{self.__class__.__name__} {state} {self.plan!r}>"
+
+    def _communicate(self):
+        if self._span is None and self.plan.capture.complete:
+            stdout, stderr = self.process.communicate()
+        else:
+            stdout, stderr = read_output(
+                self.process, self._span, self.plan.capture.limit
+            )
+        self.process.wait()
+        if self._span is not None:
+            self._span.mark("exit")
         result = subprocess.CompletedProcess(
-            args=command, stdout=e.stdout, stderr=e.stderr, returncode=e.returncode
+            args=self.plan.command_flatten,
+            stdout=stdout,
+            stderr=stderr,
+            returncode=self.process.returncode,
         )
-        return result
+        self._set_result(result)
+
+    def _set_result(self, result):
+        with self._lock:
+            self._result = CommandHandler(
+                self.plan.command, result=result, text=self.plan.capture.text
+            )
+            if self._span is not None:
+                self._span.mark("decode")
+                self._span.finish(self._result.returncode)
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def running(self):
+        return not self._done.is_set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def wait(self, timeout=None):
+        """
+        Wait for the command to complete.
+
+        Returns:
+        bool: True if the command has completed, False on timeout.
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Return the CommandHandler of the command, waiting at most `timeout`
+        seconds for it.
+
+        Raises:
+        TimeoutError: If the command is still running after `timeout` seconds.
+        CancelledError: If the command has been cancelled.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"{self.plan!r} still running after {timeout}s")
+        if self._cancelled:
+            raise CancelledError()
+        return self._result
+
+    def cancel(self):
+        """
+        Kill the command if it is still running.
+
+        Returns:
+        bool: True if the command has been cancelled, False if it had already
+            completed.
+        """
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._cancelled = True
+        self.process.kill()
+        return True
+
+    def add_done_callback(self, callback):
+        """Call `callback(future)` once the command has completed."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+class CommandStream:
+    """
+    Iterate over the output of a command while it is running.
+
+    stdout is yielded line by line, or in chunks of at most `chunk_size` bytes,
+    as bytes if `binary` is True and as str otherwise. stderr is drained in the
+    background and only its last `stderr_tail` lines are kept, so memory use
+    does not depend on the amount of output.
+
+    Args:
+    command (list): The command to run, possibly nested.
+    binary (bool): Yield bytes instead of str.
+    chunk_size (int): Yield chunks of at most this many bytes instead of lines.
+    tee (callable or file): Receives every piece of stdout that is yielded.
+    stderr_tee (callable or file): Receives every line of stderr.
+    stderr_tail (int): Number of stderr lines kept in `stderr_tail`.
+    span (tracing.Span): Measures the phases of the command, if traced.
+    backend: Starts the process, see CommandPlan.
+    """
+
+    def __init__(
+        self,
+        command,
+        binary=False,
+        chunk_size=None,
+        tee=None,
+        stderr_tee=None,
+        stderr_tail=100,
+        span=None,
+        backend=None,
+    ):
+        self.command = command
+        self.command_flatten = flatten(self.command)
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.stderr_tail = collections.deque(maxlen=stderr_tail)
+        self.returncode = None
+        self._span = span
+        self._tee = make_sink(tee)
+        self._stderr_tee = make_sink(stderr_tee)
+        try:
+            self.process = spawn(self.command_flatten, backend=backend)
+        except OSError as e:
+            if span is not None:
+                span.finish(spawn_error(self.command_flatten, e).returncode)
+            raise
+        self._mark("spawn")
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        decoder = None if self.binary else make_decoder()
+        stdout = self.process.stdout
+        while True:
+            if self.chunk_size:
+                data = stdout.read1(self.chunk_size)
+            else:
+                data = stdout.readline()
+            if not data:
+                break
+            if self._span is not None:
+                self._span.stdout_bytes += len(data)
+                if "first_output" not in self._span.phases:
+                    self._mark("first_output")
+            if decoder is not None:
+                data = decoder.decode(data)
+                if not data:
+                    continue
+            if self._tee is not None:
+                self._tee(data)
+            yield data
+        self._finish()
+
+    def _drain_stderr(self):
+        decoder = None if self.binary else make_decoder()
+        for line in self.process.stderr:
+            if self._span is not None:
+                self._span.stderr_bytes += len(line)
+            if decoder is not None:
+                line = decoder.decode(line)
+            self.stderr_tail.append(line)
+            if self._stderr_tee is not None:
+                self._stderr_tee(line)
+
+    def wait(self):
+        """
+        Consume the remaining output and wait for the command to exit.
+
+        Returns:
+        int: The return code of the command.
+        """
+        if self.returncode is None:
+            for _ in self:
+                pass
+        return self.returncode
+
+    def _finish(self):
+        if self.returncode is None:
+            self.returncode = self.process.wait()
+            self._stderr_thread.join()
+            self._end()
+
+    def _mark(self, phase):
+        if self._span is not None:
+            self._span.mark(phase)
+
+    def _end(self):
+        if self._span is not None:
+            span, self._span = self._span, None
+            span.mark("exit")
+            span.finish(self.returncode)
+
+    def close(self):
+        """Kill the command if it is still running and release its pipes."""
+        if self.process.poll() is None:
+            self.process.kill()
+        self.returncode = self.process.wait()
+        self._stderr_thread.join()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self._end()
+
+    def has_failed(self):
+        return self.wait() != 0
+
+    def has_succeeded(self):
+        return self.wait() == 0
+
+    def get_command(self):
+        return self.command
+
+
+class AsyncCommandStream:
+    """
+    Asynchronous counterpart of CommandStream, to be used with `async for`.
+
+    The process is spawned on the first iteration or when entering the
+    `async with` block. The arguments are the same as CommandStream's.
+    """
+
+    def __init__(
+        self,
+        command,
+        binary=False,
+        chunk_size=None,
+        tee=None,
+        stderr_tee=None,
+        stderr_tail=100,
+        span=None,
+        backend=None,
+    ):
+        self.command = command
+        self.command_flatten = flatten(self.command)
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.stderr_tail = collections.deque(maxlen=stderr_tail)
+        self.returncode = None
+        self._span = span
+        self._backend = backend
+        self.process = None
+        self._tee = make_sink(tee)
+        self._stderr_tee = make_sink(stderr_tee)
+        self._stderr_task = None
+
+    async def __aenter__(self):
+        await self._spawn()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _spawn(self):
+        if self.process is None:
+            try:
+                if self._backend is None:
+                    self.process = await asyncio.create_subprocess_exec(
+                        *self.command_flatten,
+                        stdout=asyncio.subprocess.PIPE,
+                        stderr=asyncio.subprocess.PIPE,
+                    )
+                else:
+                    self.process = await self._backend.spawn_async(
+                        self.command_flatten
+                    )
+            except OSError as e:
+                if self._span is not None:
+                    span, self._span = self._span, None
+                    span.finish(spawn_error(self.command_flatten, e).returncode)
+                raise
+            self._mark("spawn")
+            self._stderr_task = asyncio.ensure_future(self._drain_stderr())
+
+    async def __aiter__(self):
+        await self._spawn()
+        decoder = None if self.binary else make_decoder()
+        stdout = self.process.stdout
+        lines = None if self.chunk_size else read_lines_async(stdout)
+        while True:
+            if lines is None:
+                data = await stdout.read(self.chunk_size)
+            else:
+                data = await anext(lines, b"")
+            if not data:
+                break
+            if self._span is not None:
+                self._span.stdout_bytes += len(data)
+                if "first_output" not in self._span.phases:
+                    self._mark("first_output")
+            if decoder is not None:
+                data = decoder.decode(data)
+                if not data:
+                    continue
+            if self._tee is not None:
+                self._tee(data)
+            yield data
+        await self._finish()
+
+    async def _drain_stderr(self):
+        decoder = None if self.binary else make_decoder()
+        async for line in read_lines_async(self.process.stderr):
+            if self._span is not None:
+                self._span.stderr_bytes += len(line)
+            if decoder is not None:
+                line = decoder.decode(line)
+            self.stderr_tail.append(line)
+            if self._stderr_tee is not None:
+                self._stderr_tee(line)
+
+    async def wait(self):
+        if self.returncode is None:
+            async for _ in self:
+                pass
+        return self.returncode
+
+    async def _finish(self):
+        if self.returncode is None:
+            self.returncode = await self.process.wait()
+            await self._stderr_task
+            self._end()
+
+    _mark = CommandStream._mark
+    _end = CommandStream._end
+
+    async def close(self):
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            self.process.kill()
+        self.returncode = await self.process.wait()
+        await self._stderr_task
+        self._end()
+
+    def get_command(self):
+        return self.command
+
+
+async def read_lines_async(stream, chunk_size=65536):
+    """
+    Yield the lines of an asyncio stream, with their newline, whatever their
+    length, unlike StreamReader.readline which is bounded by the limit of the
+    stream.
+    """
+    parts = []
+    while True:
+        data = await stream.read(chunk_size)
+        if not data:
+            break
+        start = 0
+        end = data.find(b"\n")
+        while end >= 0:
+            parts.append(data[start : end + 1])
+            yield b"".join(parts)
+            parts = []
+            start = end + 1
+            end = data.find(b"\n", start)
+        if start < len(data):
+            parts.append(data[start:])
+    if parts:
+        yield b"".join(parts)
+
+
+def make_sink(sink):
+    """Return a callable writing to `sink`, which is a callable or a file."""
+    if sink is None or callable(sink):
+        return sink
+    return sink.write
+
+
+def make_decoder():
+    return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
+class PytainerBatchError(Exception):
+    """
+    Raised when some of the commands of a batch failed.
+
+    Attributes:
+    failures (list): (index, CommandHandler) pairs of the failed commands,
+        sorted by index.
+    total (int): Number of commands in the batch.
+    """
+
+    def __init__(self, failures, total):
+        self.failures = failures
+        self.total = total
+        message = f"{len(failures)} of {total} commands failed"
+        if failures:
+            index, result = failures[0]
+            message += f" (first: #{index} {result.get_command()!r}"
+            message += f" returned {result.returncode})"
+        super().__init__(message)
+
+
+def make_result(command, returncode=0, stdout="", stderr=""):
+    """
+    Return the CommandHandler of a command that was not run, e.g. because its
+    outcome was found in a cache.
+    """
+    completed = subprocess.CompletedProcess(
+        args=flatten(command), stdout=stdout, stderr=stderr, returncode=returncode
+    )
+    return CommandHandler(command, result=completed)
+
+
+def run_command(command: str | list, capture=DEFAULT_CAPTURE, span=None):
+    """
+    Run a command and capture its output as bytes.
+
+    A list is executed directly as an argv, without going through a shell. A
+    string is run by the shell.
+
+    Args:
+    command (str or list): The command.
+    capture (CaptureOptions): Which output to keep.
+    span (tracing.Span): Measures the phases of the command, if traced.
+    """
+    shell = isinstance(command, str)
+    if span is None and capture.complete:
+        try:
+            return subprocess.run(command, capture_output=True, shell=shell)
+        except OSError as e:
+            return spawn_error(command, e)
+    try:
+        process = subprocess.Popen(command, shell=shell, **pipes(capture))
+    except OSError as e:
+        return spawn_error(command, e)
+    if span is not None:
+        span.mark("spawn")
+    stdout, stderr = read_output(process, span, capture.limit)
+    process.wait()
+    if span is not None:
+        span.mark("exit")
+    return subprocess.CompletedProcess(
+        args=command, stdout=stdout, stderr=stderr, returncode=process.returncode
+    )
+
+
+async def run_command_async(
+    command: str | list, capture=DEFAULT_CAPTURE, span=None
+):
+    """Asynchronous counterpart of run_command."""
+    sizes = [0, 0]
+    try:
+        if isinstance(command, str):
+            process = await asyncio.create_subprocess_shell(
+                command, **pipes(capture)
+            )
+        else:
+            process = await asyncio.create_subprocess_exec(*command, **pipes(capture))
+    except OSError as e:
+        return spawn_error(command, e)
+    if span is not None:
+        span.mark("spawn")
+    try:
+        if capture.complete and span is None:
+            stdout, stderr = await process.communicate()
+        else:
+            # Read the streams to time the first output and count the bytes
+            stdout, stderr = await asyncio.gather(
+                read_stream_async(process.stdout, capture.limit, sizes, 0, span),
+                read_stream_async(process.stderr, capture.limit, sizes, 1, span),
+            )
+            await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    if span is not None:
+        span.mark("exit")
+        span.stdout_bytes += sizes[0]
+        span.stderr_bytes += sizes[1]
+    return subprocess.CompletedProcess(
+        args=command, stdout=stdout, stderr=stderr, returncode=process.returncode
+    )
+
+
+def spawn(command, capture=DEFAULT_CAPTURE, backend=None):
+    """
+    Start a command with `backend`, or subprocess if None, and return its
+    Popen-like process.
+
+    Raises:
+    OSError: If the command cannot be executed.
+    """
+    if backend is None:
+        return subprocess.Popen(command, **pipes(capture))
+    return backend.spawn(command, capture)
+
+
+def pipes(capture):
+    """Return the stdout and stderr arguments of Popen for `capture`."""
+    return {
+        "stdout": subprocess.PIPE if capture.stdout else subprocess.DEVNULL,
+        "stderr": subprocess.PIPE if capture.stderr else subprocess.DEVNULL,
+    }
+
+
+def read_output(process, span=None, limit=None):
+    """
+    Read the stdout and stderr of `process` until both are closed.
+
+    Args:
+    process (Popen): The process, whose streams that are not pipes are
+        returned as None.
+    span (tracing.Span): Marks its "first_output" phase when the first byte
+        arrives, and counts the bytes read.
+    limit (int): Keep at most this many bytes of each stream.
+    """
+    buffers = {}
+    sizes = {}
+    with selectors.DefaultSelector() as selector:
+        for pipe in (process.stdout, process.stderr):
+            if pipe is not None:
+                selector.register(pipe, selectors.EVENT_READ)
+                buffers[pipe], sizes[pipe] = [], 0
+        while selector.get_map():
+            for key, _ in selector.select():
+                data = os.read(key.fd, 65536)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    continue
+                if span is not None and "first_output" not in span.phases:
+                    span.mark("first_output")
+                pipe = key.fileobj
+                sizes[pipe] += len(data)
+                if limit is not None:
+                    data = data[: max(limit - sizes[pipe] + len(data), 0)]
+                if data:
+                    buffers[pipe].append(data)
+    if span is not None:
+        span.stdout_bytes += sizes.get(process.stdout, 0)
+        span.stderr_bytes += sizes.get(process.stderr, 0)
+    return tuple(
+        None if pipe is None else b"".join(buffers[pipe])
+        for pipe in (process.stdout, process.stderr)
+    )
+
+
+async def read_stream_async(stream, limit, sizes, index, span=None):
+    """
+    Read an asyncio stream until EOF, keeping at most `limit` bytes and
+    counting the bytes read in `sizes[index]`. The "first_output" phase of
+    `span` is marked when the first byte arrives on any stream.
+    """
+    if stream is None:
+        return None
+    chunks, kept = [], 0
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            return b"".join(chunks)
+        if span is not None and "first_output" not in span.phases:
+            span.mark("first_output")
+        sizes[index] += len(data)
+        if limit is not None:
+            data = data[: max(limit - kept, 0)]
+        kept += len(data)
+        if data:
+            chunks.append(data)
+
+
+def decode_output(data):
+    """Decode the output of a command as `text=True` would."""
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def spawn_error(command, error):
+    """
+    Return the CompletedProcess of a command that could not be started, with
+    the return code a shell would have given.
+    """
+    returncode = 127 if isinstance(error, FileNotFoundError) else 126
+    return subprocess.CompletedProcess(
+        args=command,
+        stdout="",
+        stderr=f"{command[0]}: {error.strerror}\n",
+        returncode=returncode,
+    )
+
+
+def split_command(command):
+    """
+    Return the argv of a command given as a string with shell syntax, or as a
+    list of arguments.
+    """
+    if isinstance(command, str):
+        return shlex.split(command)
+    return list(command)
 
 
 def flatten(lst):
@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+
+import pytest
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+FAKE_APPTAINER = os.path.join(ROOT_PATH, "fake_apptainer.py")
+
+
+@pytest.fixture
+def fake_apptainer(tmp_path, monkeypatch):
+    """
+    Put a fake apptainer executable first on PATH.
+
+    Returns the path of the log file in which each invocation's argv is
+    recorded as a JSON line.
+    """
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    script = bindir / "apptainer"
+    script.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_APPTAINER}" "$@"\n')
+    script.chmod(0o755)
+    log = tmp_path / "apptainer.log"
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_APPTAINER_LOG", str(log))
+    monkeypatch.setenv("FAKE_APPTAINER_INSTANCES", str(tmp_path / "instances"))
+    return log
+
+
+def exec_count(log):
+    """Return the number of exec invocations recorded in a fake_apptainer log."""
+    return sum(json.loads(line)[0] == "exec" for line in log.read_text().splitlines())
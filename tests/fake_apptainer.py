@@ -0,0 +1,183 @@
+"""
+Minimal stand-in for the apptainer binary used by the test suite.
+
+The image argument of exec/run is located as the first argument that looks like
+an image reference, everything after it is executed on the host.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+IMAGE_PREFIXES = ("instance://", "docker://", "library://", "oras://", "shub://")
+
+
+def is_image(arg):
+    return arg.endswith(".sif") or arg.startswith(IMAGE_PREFIXES)
+
+
+def log(argv):
+    path = os.environ.get("FAKE_APPTAINER_LOG")
+    if path:
+        with open(path, "a") as fo:
+            fo.write(json.dumps(argv) + "\n")
+
+
+def positional(args):
+    return [arg for arg in args if not arg.startswith("-")]
+
+
+def cmd_exec(args):
+    for i, arg in enumerate(args):
+        if arg.startswith("instance://") and not os.path.exists(
+            os.path.join(instance_dir(), arg[len("instance://") :])
+        ):
+            print(f"FATAL: no instance found with name {arg}", file=sys.stderr)
+            return 255
+        if is_image(arg):
+            command = args[i + 1 :]
+            break
+    else:
+        print("FATAL: no image given", file=sys.stderr)
+        return 255
+    try:
+        return subprocess.run(command).returncode
+    except FileNotFoundError:
+        print(f"FATAL: {command[0]}: executable file not found", file=sys.stderr)
+        return 255
+
+
+def cmd_pull(args):
+    save_path, uri = positional(args)[-2:]
+    if os.path.exists(save_path) and "--force" not in args:
+        print(f"FATAL: Image file already exists: {save_path}", file=sys.stderr)
+        return 255
+    with open(save_path, "w") as fo:
+        fo.write(f"SIF:{uri}\n")
+    return 0
+
+
+def cmd_build(args):
+    image_path, definition_file = positional(args)[-2:]
+    with open(definition_file) as fi:
+        definition = fi.read()
+    header = dict(
+        line.split(":", 1) for line in definition.splitlines() if line[:1].isupper()
+    )
+    if header.get("Bootstrap", "").strip() == "localimage":
+        base = os.path.abspath(header["From"].strip())
+        if not os.path.exists(base):
+            print(f"FATAL: {base} does not exist", file=sys.stderr)
+            return 255
+    with open(image_path, "w") as fo:
+        fo.write(definition)
+    return 0
+
+
+def cmd_inspect(args):
+    image_path = positional(args)[-1]
+    if not os.path.exists(image_path):
+        print(f"FATAL: could not open image {image_path}", file=sys.stderr)
+        return 255
+    metadata = {
+        "data": {
+            "attributes": {
+                "labels": {"org.label-schema.build-date": "Monday_1_January_2024"},
+                "runscript": "#!/bin/sh\nexec /bin/sh \"$@\"\n",
+            }
+        },
+        "type": "container",
+    }
+    print(json.dumps(metadata))
+    return 0
+
+
+def instance_dir():
+    path = os.environ.get("FAKE_APPTAINER_INSTANCES", "instances")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cmd_instance(args):
+    action, args = args[0], args[1:]
+    if action == "start":
+        image_path, name = positional(args)[-2:]
+        path = os.path.join(instance_dir(), name)
+        if os.path.exists(path):
+            print(f"FATAL: instance {name} already exists", file=sys.stderr)
+            return 255
+        with open(path, "w") as fo:
+            fo.write(json.dumps({"instance": name, "img": image_path, "pid": 1}))
+        return 0
+    if action == "stop":
+        name = positional(args)[-1]
+        path = os.path.join(instance_dir(), name)
+        if not os.path.exists(path):
+            print(f"FATAL: no instance found with name {name}", file=sys.stderr)
+            return 255
+        os.remove(path)
+        return 0
+    if action == "list":
+        instances = []
+        for name in sorted(os.listdir(instance_dir())):
+            with open(os.path.join(instance_dir(), name)) as fi:
+                instances.append(json.load(fi))
+        print(json.dumps({"instances": instances}))
+        return 0
+    return 255
+
+
+def cmd_version(args):
+    print("apptainer version 1.2.4")
+    return 0
+
+
+def cmd_help(args):
+    print("Usage:\n  apptainer [global options...]\n\nAvailable Commands:")
+    for command in sorted(COMMANDS):
+        if not command.startswith("-"):
+            print(f"  {command:<10} {command} command")
+    print()
+    return 0
+
+
+def cmd_buildcfg(args):
+    print(f"LIBEXECDIR={os.path.dirname(__file__)}/libexec")
+    return 0
+
+
+def subcommand_help(argv):
+    print(f"Usage:\n  apptainer {' '.join(argv[:-1])} [options...]\n\nOptions:")
+    print("  -B, --bind strings   a user-bind path specification")
+    print("      --fakeroot       run container in new user namespace as uid 0")
+    print(f"  -h, --help           help for {argv[0]}")
+    return 0
+
+
+COMMANDS = {
+    "exec": cmd_exec,
+    "run": cmd_exec,
+    "pull": cmd_pull,
+    "build": cmd_build,
+    "inspect": cmd_inspect,
+    "instance": cmd_instance,
+    "version": cmd_version,
+    "--version": cmd_version,
+    "help": cmd_help,
+    "buildcfg": cmd_buildcfg,
+}
+
+
+def main(argv):
+    log(argv)
+    if not argv or argv[0] not in COMMANDS:
+        print(f"FATAL: unknown command {argv[:1]}", file=sys.stderr)
+        return 255
+    if argv[-1] == "--help":
+        return subcommand_help(argv)
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+import pytainer
+from pytainer import tracing
+from pytainer.agent import agent_request
+
+from .conftest import exec_count
+
+
+def test_agent_exec(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    assert pytnr.instance_start(agent=True).has_succeeded()
+    try:
+        assert pytnr.agent is not None and pytnr.agent.alive()
+        execs = exec_count(fake_apptainer)
+        result = pytnr.exec(["sh", "-c", "echo out; echo err >&2; exit 3"])
+        assert result.returncode == 3
+        assert (result.stdout, result.stderr) == ("out\n", "err\n")
+        options = pytainer.PytainerOptionsExec().with_env("GREETING", "a b")
+        options = options.with_pwd("/")
+        assert pytnr.exec("sh -c 'echo $GREETING; pwd'", options).stdout == "a b\n/\n"
+        assert asyncio.run(pytnr.exec_async("echo async")).stdout == "async\n"
+        assert pytnr.exec("missing-command").returncode == 127
+        # None of these went through apptainer
+        assert exec_count(fake_apptainer) == execs
+        # Unsupported options fall back to apptainer
+        assert pytnr.exec("true", options.with_cleanenv()).has_succeeded()
+        assert exec_count(fake_apptainer) == execs + 1
+        directory = pytnr.agent.directory
+    finally:
+        pytnr.instance_stop()
+    assert pytnr.agent is None and not os.path.exists(directory)
+
+
+def test_agent_fallback(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    pytnr.instance_start(agent=True)
+    try:
+        os.remove(pytnr.agent.socket_path)
+        assert pytnr.exec("echo fallback").stdout == "fallback\n"
+    finally:
+        pytnr.instance_stop()
+
+
+def test_agent_environment(fake_apptainer, tmp_path, monkeypatch):
+    pytnr = pytainer.Pytainer("fake.sif")
+    monkeypatch.setenv("EARLY_VAR", "early")
+    pytnr.instance_start(agent=True)
+    try:
+        execs = exec_count(fake_apptainer)
+        monkeypatch.setenv("LATE_VAR", "set-after-start")
+        monkeypatch.delenv("EARLY_VAR")
+        monkeypatch.chdir(tmp_path)
+        command = "sh -c 'echo $LATE_VAR; echo ${EARLY_VAR-unset}; pwd'"
+        expected = f"set-after-start\nunset\n{tmp_path}\n"
+        assert pytnr.exec(command).stdout == expected
+        assert exec_count(fake_apptainer) == execs
+    finally:
+        pytnr.instance_stop()
+
+
+def test_agent_fallback_traced_once(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    pytnr.instance_start(agent=True)
+    try:
+        os.remove(pytnr.agent.socket_path)
+        with tracing.collect() as records:
+            assert pytnr.exec("true").has_succeeded()
+        assert [record.returncode for record in records] == [0]
+    finally:
+        pytnr.instance_stop()
+
+
+def test_agent_request():
+    options = pytainer.PytainerOptionsExec()
+    assert agent_request(options) == ({}, None)
+    assert agent_request(options.with_env("A", "1")) == ({"A": "1"}, None)
+    assert agent_request(options.with_env("A", "1,B=2")) is None
+    assert agent_request(options.with_bind("/data")) is None
@@ -0,0 +1,67 @@
+import json
+import signal
+
+import pytest
+
+import pytainer
+from pytainer.backends import PosixSpawnBackend, get_backend
+from pytainer.utils import CaptureOptions, CommandPlan
+
+
+def test_get_backend():
+    assert isinstance(get_backend("posix_spawn"), PosixSpawnBackend)
+    assert get_backend(None) is None
+    backend = PosixSpawnBackend()
+    assert get_backend(backend) is backend
+    with pytest.raises(ValueError):
+        get_backend("fork")
+
+
+def test_posix_spawn_run():
+    backend = PosixSpawnBackend()
+    result = backend.run(["sh", "-c", "printf out; printf err >&2; exit 3"])
+    assert (result.returncode, result.stdout, result.stderr) == (3, b"out", b"err")
+    result = backend.run("printf '%s' \"$0\"")
+    assert result.stdout == b"/bin/sh"
+    result = backend.run(["missing-command"])
+    assert result.returncode == 127
+    assert "missing-command" in result.stderr
+
+
+def test_posix_spawn_capture():
+    backend = PosixSpawnBackend()
+    capture = CaptureOptions(stderr=False, limit=3)
+    result = backend.run(["sh", "-c", "echo hello; echo oops >&2"], capture)
+    assert (result.stdout, result.stderr) == (b"hel", None)
+
+
+def test_posix_spawn_restores_signals():
+    # Python ignores SIGPIPE, the child must not inherit it
+    backend = PosixSpawnBackend()
+    result = backend.run(["sh", "-c", "yes | head -c 1 >/dev/null; echo ok"])
+    assert result.stdout == b"ok\n"
+    process = backend.spawn(["sleep", "10"])
+    process.kill()
+    assert process.wait(timeout=5) == -signal.SIGKILL
+    assert process.poll() == -signal.SIGKILL
+
+
+def test_plan_backend():
+    plan = CommandPlan(["sh", "-c", "echo hello"], backend=PosixSpawnBackend())
+    assert plan.run().stdout == "hello\n"
+    assert plan.launch().result().stdout == "hello\n"
+    with plan.stream() as stream:
+        assert list(stream) == ["hello\n"]
+    assert stream.returncode == 0
+    future = CommandPlan(["sleep", "10"], backend=PosixSpawnBackend()).launch()
+    assert future.cancel()
+    assert future.wait(5)
+
+
+def test_pytainer_backend(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif", backend="posix_spawn")
+    assert isinstance(pytnr.plan_exec("echo hello").backend, PosixSpawnBackend)
+    result = pytnr.exec("echo hello")
+    assert result.has_succeeded()
+    argv = json.loads(fake_apptainer.read_text().splitlines()[-1])
+    assert argv == ["exec", "fake.sif", "echo", "hello"]
@@ -0,0 +1,53 @@
+import subprocess
+
+import pytainer
+from pytainer.batching import split_batch
+from pytainer.utils import CommandHandler
+
+from .conftest import exec_count
+
+
+def test_batcher(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    commands = [
+        "echo first",
+        ["printf", "%s", "no newline"],
+        ["sh", "-c", "echo oops >&2; exit 3"],
+        ["sh", "-c", "exit 4"],
+        "missing-command",
+        ["printf", "%s", "a b", "$HOME"],
+    ]
+    with pytainer.CommandBatcher(pytnr, batch_size=4, linger=10) as batcher:
+        results = batcher.map(commands)
+    assert [r.returncode for r in results] == [0, 0, 3, 4, 127, 0]
+    assert [r.stdout for r in results[:2]] == ["first\n", "no newline"]
+    assert results[2].stderr == "oops\n" and results[2].stdout == ""
+    assert results[5].stdout == "a b$HOME"
+    assert results[0].args == pytnr.plan_exec("echo first").command_flatten
+    assert exec_count(fake_apptainer) == 2
+
+
+def test_batcher_linger(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    batcher = pytainer.CommandBatcher(pytnr, batch_size=100, linger=0.05)
+    futures = [batcher.submit(f"echo {i}") for i in range(3)]
+    other = batcher.submit("echo env", pytainer.PytainerOptionsExec().with_cleanenv())
+    assert [f.result(timeout=30).stdout for f in futures] == ["0\n", "1\n", "2\n"]
+    assert other.result(timeout=30).stdout == "env\n"
+    batcher.close()
+    assert exec_count(fake_apptainer) == 2
+
+
+def test_split_batch_failure():
+    token = "0123"
+    completed = subprocess.CompletedProcess(
+        args=["apptainer"],
+        returncode=255,
+        stdout=b"ok\n\n0123 0 0\npartial",
+        stderr=b"\n0123 0 0\nFATAL: killed\n",
+    )
+    batch = CommandHandler(["apptainer"], result=completed, text=False)
+    results = split_batch(batch, token, [["a"], ["b"], ["c"]])
+    assert [r.returncode for r in results] == [0, 255, 255]
+    assert [r.stdout for r in results] == ["ok\n", "partial", ""]
+    assert results[1].stderr == "FATAL: killed\n"
@@ -0,0 +1,20 @@
+import os
+import runpy
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK = os.path.join(ROOT_PATH, "benchmarks", "bench_overhead.py")
+
+
+def test_bench_overhead(tmp_path):
+    main = runpy.run_path(BENCHMARK)["main"]
+    report = main(["--calls", "4", "--concurrency", "2", "--json", str(tmp_path / "r")])
+    assert set(report["modes"]) >= {
+        "direct",
+        "exec",
+        "exec:posix_spawn",
+        "exec:fake",
+        "launch[2]",
+        "async[2]",
+    }
+    assert report["bytes_per_result"] > 0
+    assert (tmp_path / "r").exists()
@@ -0,0 +1,63 @@
+import os
+
+import pytainer
+
+ALPINE_DEFINITION = os.path.join(os.path.dirname(__file__), "alpine.def")
+
+DEFINITION = """Bootstrap: docker
+From: alpine:latest
+
+%files
+    data.txt /opt/data.txt
+
+%post
+    apk update
+"""
+
+
+def test_definition():
+    definition = pytainer.Definition(
+        DEFINITION + "\nBootstrap: localimage\nFrom: base.sif\n\n%runscript\n    ls\n"
+    )
+    assert definition.bootstrap == "docker"
+    assert definition.source == "alpine:latest"
+    assert len(definition.stages) == 2
+    assert definition.section("post").strip() == "apk update"
+    assert definition.section("runscript").strip() == "ls"
+    assert [os.path.basename(i) for i in definition.local_images()] == ["base.sif"]
+    ((source, destination),) = definition.files()
+    assert source == os.path.join(os.getcwd(), "data.txt")
+    assert destination == "/opt/data.txt"
+    definition = pytainer.Definition.from_file(ALPINE_DEFINITION, directory="/opt")
+    assert definition.directory() == "/opt"
+
+
+def test_build_cache(fake_apptainer, tmp_path, monkeypatch):
+    # %files sources are resolved against the current directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "defs").mkdir()
+    definition_file = tmp_path / "defs" / "alpine.def"
+    definition_file.write_text(DEFINITION)
+    data = tmp_path / "data.txt"
+    data.write_text("1")
+    cache = pytainer.BuildCache(tmp_path / "cache")
+    pytnr = pytainer.Pytainer(build_cache=cache)
+
+    def build(name, options=pytainer.PytainerOptionsBuild()):
+        image = str(tmp_path / name)
+        return pytnr.build(str(definition_file), image, options).returncode
+
+    assert build("first.sif") == 0
+    assert build("second.sif") == 0
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+    data.write_text("2")
+    assert build("third.sif") == 0
+    options = pytainer.PytainerOptionsBuild()
+    options.build_arg("VERSION=2")
+    assert build("fourth.sif", options) == 0
+    options.force()
+    assert build("fourth.sif", options) == 0
+    assert cache.stats() == {"hits": 2, "misses": 3, "entries": 3}
+    log = fake_apptainer.read_text().splitlines()
+    assert sum('"build"' in line for line in log) == 3
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import pytainer
+
+
+def write_definition(tmp_path, name, base=None):
+    path = tmp_path / f"{name}.def"
+    if base is None:
+        path.write_text("Bootstrap: docker\nFrom: alpine:latest\n")
+    else:
+        path.write_text(f"Bootstrap: localimage\nFrom: {base}.sif\n")
+    return str(path)
+
+
+def test_build_graph(fake_apptainer, tmp_path, monkeypatch):
+    # Relative bases are resolved against the current directory
+    monkeypatch.chdir(tmp_path)
+    graph = pytainer.BuildGraph(max_workers=4)
+    for name, base in [
+        ("app", "base"),
+        ("tools", "base"),
+        ("base", None),
+        ("orphan", "missing"),
+        ("orphan-app", "orphan"),
+        ("orphan-app-2", "orphan-app"),
+    ]:
+        graph.add(write_definition(tmp_path, name, base), tmp_path / f"{name}.sif")
+    order = [image.rsplit("/", 1)[1] for image in graph.order()]
+    assert order.index("base.sif") < order.index("app.sif")
+
+    report = graph.build()
+    images = {image.rsplit("/", 1)[1]: image for image in graph.targets}
+    assert sorted(report.succeeded) == sorted(
+        images[name] for name in ("app.sif", "tools.sif", "base.sif")
+    )
+    assert report.failed == [images["orphan.sif"]]
+    assert report.skipped == {
+        images["orphan-app.sif"]: images["orphan.sif"],
+        images["orphan-app-2.sif"]: images["orphan.sif"],
+    }
+    assert report.has_failed()
+
+    builds = [json.loads(line) for line in fake_apptainer.read_text().splitlines()]
+    built = [argv[-2].rsplit("/", 1)[1] for argv in builds]
+    assert built.index("base.sif") < built.index("app.sif")
+    assert "orphan-app.sif" not in built
+
+
+def test_build_graph_cycle(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    graph = pytainer.BuildGraph()
+    graph.add(write_definition(tmp_path, "a", "b"), tmp_path / "a.sif")
+    graph.add(write_definition(tmp_path, "b", "a"), tmp_path / "b.sif")
+    with pytest.raises(ValueError):
+        graph.build()
@@ -0,0 +1,35 @@
+import json
+
+import pytainer
+
+
+def test_capabilities(fake_apptainer, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    caps = pytainer.capabilities(cache_dir=cache_dir, refresh=True)
+    assert caps.version == "1.2.4"
+    assert caps.version_info == (1, 2, 4)
+    assert caps.supports("exec") and caps.supports("instance start")
+    assert caps.supports("exec", "--fakeroot")
+    assert not caps.supports("exec", "--no-such-flag")
+    assert not caps.supports("no-such-command")
+    assert caps.suid is False
+
+    probes = len(fake_apptainer.read_text().splitlines())
+    assert pytainer.capabilities(cache_dir=cache_dir) is caps
+    assert len(fake_apptainer.read_text().splitlines()) == probes
+    ((path,),) = [list((tmp_path / "cache").iterdir())]
+    assert json.loads(path.read_text())["version"] == "1.2.4"
+
+
+def test_capabilities_environment(fake_apptainer, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.setenv("APPTAINER_CACHEDIR", "/first")
+    assert pytainer.capabilities(cache_dir=cache_dir).cache_dir == "/first"
+    ((path,),) = [list((tmp_path / "cache").iterdir())]
+    assert "cache_dir" not in json.loads(path.read_text())
+    # The binary is not probed again for another environment
+    monkeypatch.setenv("APPTAINER_CACHEDIR", "/second")
+    probes = len(fake_apptainer.read_text().splitlines())
+    caps = pytainer.capabilities(cache_dir=cache_dir)
+    assert (caps.cache_dir, caps.version) == ("/second", "1.2.4")
+    assert len(fake_apptainer.read_text().splitlines()) == probes
@@ -0,0 +1,158 @@
+import asyncio
+import os
+import time
+
+import pytainer
+from pytainer import tracing
+from pytainer.backends import get_backend
+from pytainer.fake import FakeBackend
+from pytainer.scheduler import ResourceScheduler
+from pytainer.utils import CaptureOptions, CommandHandler, CommandPlan
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+ALPINE_APPTAINER_DEFINITION = os.path.join(ROOT_PATH, "alpine.def")
+
+
+def test_exec_run():
+    backend = FakeBackend(output_size=100, commands={"id": lambda args: (0, "0", "")})
+    pytnr = pytainer.Pytainer("alpine.sif", backend=backend)
+    assert pytnr.exec("echo hello world").stdout == "hello world\n"
+    assert pytnr.exec("false").returncode == 1
+    assert pytnr.exec(["id", "-u"]).stdout == "0"
+    result = pytnr.run("ls /")
+    assert result.has_succeeded()
+    assert len(result.stdout) == 100
+    options = pytainer.PytainerOptionsExec()
+    options.workdir("/tmp")
+    options.cleanenv()
+    assert pytnr.exec("echo ok", options).stdout == "ok\n"
+    assert backend.stats()["calls"] == {"exec": 4, "run": 1}
+    assert isinstance(get_backend("fake"), FakeBackend)
+    command = ["apptainer", "exec", "x.sif", "echo", "x"]
+    assert CommandHandler(command, backend=backend).stdout == "x\n"
+
+
+def test_failures_deterministic():
+    def returncodes(seed):
+        backend = FakeBackend(failure_rate={"exec": 0.3}, seed=seed)
+        pytnr = pytainer.Pytainer("alpine.sif", backend=backend)
+        results = list(pytnr.map(["true"] * 50 + ["echo 1"] * 50, max_workers=8))
+        assert backend.stats()["failures"]["exec"] == sum(
+            r.returncode == 255 for r in results
+        )
+        return [r.returncode for r in results]
+
+    first = returncodes(seed=1)
+    assert first == returncodes(seed=1)
+    assert first != returncodes(seed=2)
+    assert 0 < first.count(255) < 100
+    assert set(first) == {0, 255}
+
+
+def test_latency():
+    backend = FakeBackend(latency={"exec": 0.05}, jitter=0.2)
+    pytnr = pytainer.Pytainer("alpine.sif", backend=backend)
+    start = time.monotonic()
+    results = list(pytnr.map(["true"] * 32, max_workers=32))
+    assert 0.04 < time.monotonic() - start < 1
+    assert all(r.has_succeeded() for r in results)
+
+    async def main():
+        return await asyncio.gather(*(pytnr.exec_async("echo 1") for _ in range(32)))
+
+    start = time.monotonic()
+    assert [r.stdout for r in asyncio.run(main())] == ["1\n"] * 32
+    assert time.monotonic() - start < 1
+
+
+def test_pull_build_inspect(tmp_path):
+    backend = FakeBackend()
+    image = str(tmp_path / "alpine.sif")
+    pytnr = pytainer.Pytainer(image, backend=backend)
+    assert pytnr.pull("docker://alpine:latest").returncode == 0
+    assert (tmp_path / "alpine.sif").exists()
+    assert pytnr.pull("docker://alpine:latest").returncode == 255
+    options = pytainer.PytainerOptionsPull()
+    options.force()
+    assert pytnr.pull("docker://alpine:latest", options=options).returncode == 0
+    built = str(tmp_path / "built.sif")
+    result = pytnr.build(ALPINE_APPTAINER_DEFINITION, built)
+    assert result.returncode == 0
+    assert pytnr.build(str(tmp_path / "missing.def"), built).returncode == 255
+    assert pytnr.inspect().returncode == 0
+    labels = pytnr.metadata().labels
+    assert labels == {"org.label-schema.usage": "docker://alpine:latest"}
+    missing = pytainer.Pytainer(str(tmp_path / "missing.sif"), backend=backend)
+    assert missing.inspect().stderr.startswith("FATAL:")
+
+
+def test_capture_and_tracing():
+    backend = FakeBackend(output_size=1000)
+    command = ["apptainer", "exec", "alpine.sif", "cat"]
+    plan = CommandPlan(command, capture=CaptureOptions(limit=10), backend=backend)
+    with tracing.collect() as records:
+        assert plan.run().stdout == "pytainer f"
+        assert plan.launch().result().stdout == "pytainer f"
+    assert [record.stdout_bytes for record in records] == [1000, 1000]
+    assert "first_output" in records[0].phases
+    assert CommandPlan(["ls"], backend=backend).run().returncode == 127
+
+
+def test_cancel():
+    backend = FakeBackend(latency=10, output_size=1 << 20)
+    plan = CommandPlan(["apptainer", "exec", "alpine.sif", "cat"], backend=backend)
+    future = plan.launch()
+    assert future.cancel()
+    assert future.wait(5)
+    stream = plan.stream(chunk_size=4096)
+    stream.close()
+    assert stream.returncode == -9
+
+    async def main():
+        async with plan.stream_async() as stream:
+            pass
+        return stream.returncode
+
+    assert asyncio.run(main()) == -9
+
+
+def test_streams():
+    backend = FakeBackend(output_size=200000)
+    plan = CommandPlan(["apptainer", "run", "alpine.sif"], backend=backend)
+    with plan.stream(binary=True) as stream:
+        assert sum(len(line) for line in stream) == 200000
+    assert stream.returncode == 0
+
+
+def test_instances_and_pool():
+    backend = FakeBackend()
+    pytnr = pytainer.Pytainer("alpine.sif", backend=backend)
+    command = ["apptainer", "exec", "instance://missing", "true"]
+    assert CommandPlan(command, backend=backend).run().returncode == 255
+    with pytnr:
+        assert pytnr.exec("echo in").stdout == "in\n"
+        assert list(backend.instances) == [pytnr.instance]
+    assert not backend.instances
+    with pytainer.InstancePool(
+        "alpine.sif", min_size=2, health_interval=None, backend=backend
+    ) as pool:
+        results = pool.map([f"echo {i}" for i in range(20)], max_workers=4)
+        assert [r.stdout for r in results] == [f"{i}\n" for i in range(20)]
+        assert len(pool.alive()) == 2
+        names = sorted(member.name for member in pool.members)
+        backend.instances.clear()
+        assert sorted(pool.check()) == names
+        deadline = time.monotonic() + 5
+        while len(pool) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(pool.alive()) == 2
+    assert not backend.instances
+
+
+def test_scheduler():
+    backend = FakeBackend(latency=0.01)
+    pytnr = pytainer.Pytainer("alpine.sif", backend=backend)
+    scheduler = ResourceScheduler(pytnr, cpus=range(2))
+    results = scheduler.map([f"echo {i}" for i in range(10)], cpus=1)
+    scheduler.shutdown()
+    assert [r.stdout for r in results] == [f"{i}\n" for i in range(10)]
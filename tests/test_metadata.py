@@ -0,0 +1,71 @@
+import os
+
+import pytainer
+
+
+def count_inspects(log):
+    return sum('"inspect"' in line for line in log.read_text().splitlines())
+
+
+def test_metadata(fake_apptainer, tmp_path):
+    image = tmp_path / "alpine.sif"
+    image.write_text("image")
+    pytnr = pytainer.Pytainer(str(image), metadata_cache=pytainer.MetadataCache())
+    metadata = pytnr.metadata()
+    assert metadata.build_date == "Monday_1_January_2024"
+    assert metadata.runscript.startswith("#!/bin/sh")
+    assert pytnr.metadata() is metadata
+    assert count_inspects(fake_apptainer) == 1
+
+    image.write_text("modified image")
+    pytnr.metadata()
+    assert count_inspects(fake_apptainer) == 2
+    pytnr.metadata(refresh=True)
+    assert count_inspects(fake_apptainer) == 3
+
+
+def test_metadata_disk_cache(fake_apptainer, tmp_path):
+    image = tmp_path / "alpine.sif"
+    image.write_text("image")
+    cache_dir = str(tmp_path / "cache")
+    for _ in range(2):
+        cache = pytainer.MetadataCache(cache_dir, validate="digest")
+        metadata = pytainer.Pytainer(str(image), metadata_cache=cache).metadata()
+        assert metadata.labels
+    assert count_inspects(fake_apptainer) == 1
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_metadata_digest_memoized(fake_apptainer, tmp_path, monkeypatch):
+    digests = []
+
+    def counting_digest(path):
+        digests.append(path)
+        return file_digest(path)
+
+    file_digest = pytainer.metadata.file_digest
+    monkeypatch.setattr(pytainer.metadata, "file_digest", counting_digest)
+    image = tmp_path / "alpine.sif"
+    image.write_text("image")
+    cache = pytainer.MetadataCache(validate="digest")
+    pytnr = pytainer.Pytainer(str(image), metadata_cache=cache)
+    for _ in range(5):
+        pytnr.metadata()
+    assert len(digests) == 1
+    assert count_inspects(fake_apptainer) == 1
+
+    # A modified image is hashed again and replaces the previous entry
+    image.write_text("modified image")
+    pytnr.metadata()
+    assert len(digests) == 2
+    assert count_inspects(fake_apptainer) == 2
+    assert len(cache._entries) == 1
+
+
+def test_metadata_from_json():
+    metadata = pytainer.ImageMetadata.from_json(
+        '{"data": {"attributes": {"deffile": "Bootstrap: docker", "apps": ""}}}'
+    )
+    assert metadata.deffile == "Bootstrap: docker"
+    assert metadata.labels == {} and metadata.apps == {}
+    assert metadata.build_date is None
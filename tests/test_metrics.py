@@ -0,0 +1,56 @@
+import json
+
+import pytainer
+from pytainer.metrics import Histogram, MetricsRegistry
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(buckets=(1.0, 2.0, 4.0))
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+        histogram.observe(value)
+    assert histogram.count == 5
+    assert histogram.cumulative() == [(1.0, 1), (2.0, 3), (4.0, 4), (float("inf"), 5)]
+    assert 1.0 < histogram.quantile(0.5) <= 2.0
+    assert histogram.quantile(0.99) == 4.0
+
+
+def test_registry(fake_apptainer, tmp_path):
+    registry = MetricsRegistry()
+    registry.enable()
+    try:
+        pytnr = pytainer.Pytainer("fake.sif")
+        pytnr.exec("echo hello")
+        pytnr.exec("false")
+        pytnr.plan_exec("echo launched").launch().result(timeout=30)
+        pytnr.inspect()
+    finally:
+        registry.disable()
+    pytnr.exec("echo ignored")
+
+    snapshot = registry.snapshot()
+    exec_metrics = snapshot["subcommands"]["exec"]
+    assert exec_metrics["count"] == 3
+    assert exec_metrics["returncodes"] == {"0": 2, "1": 1}
+    assert exec_metrics["failed"] == 1
+    assert exec_metrics["stdout_bytes"] == len("hello\nlaunched\n")
+    assert exec_metrics["latency"]["p50"] is not None
+    assert snapshot["subcommands"]["inspect"]["count"] == 1
+    assert snapshot["in_flight"] == 0
+    assert snapshot["in_flight_max"] >= 1
+
+    path = tmp_path / "metrics" / "pytainer.prom"
+    registry.write(str(path))
+    text = path.read_text()
+    assert 'pytainer_commands_total{subcommand="exec",returncode="1"} 1' in text
+    bucket = 'pytainer_command_duration_seconds_bucket{subcommand="exec",le="+Inf"}'
+    assert f"{bucket} 3" in text
+    assert "# TYPE pytainer_command_duration_seconds histogram" in text
+    assert 'pytainer_stdout_bytes_total{subcommand="exec"} 15' in text
+
+    registry.write(str(tmp_path / "metrics.json"), format="json")
+    assert json.loads((tmp_path / "metrics.json").read_text()) == snapshot
+    assert sorted(p.name for p in path.parent.iterdir()) == ["pytainer.prom"]
+
+    registry.reset()
+    assert registry.snapshot()["subcommands"]["exec"]["count"] == 0
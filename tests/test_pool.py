@@ -0,0 +1,78 @@
+import os
+import time
+
+import pytest
+
+import pytainer
+from pytainer.fake import FakeBackend
+
+
+def test_pool_dispatch(fake_apptainer):
+    with pytainer.InstancePool(
+        "fake.sif", min_size=2, dispatch="round-robin", health_interval=None
+    ) as pool:
+        assert len(pool) == 2
+        results = [pool.exec(f"echo {i}") for i in range(4)]
+        assert [r.stdout for r in results] == [f"{i}\n" for i in range(4)]
+        assert sorted(pool.stats()["calls"].values()) == [2, 2]
+        names = {member.name for member in pool.members}
+        assert pool.alive() == names
+    assert pool.alive() == set()
+    with pytest.raises(RuntimeError):
+        pool.exec("true")
+
+
+def test_pool_grow_shrink(fake_apptainer):
+    pool = pytainer.InstancePool(
+        "fake.sif", min_size=1, max_size=3, idle_timeout=0, health_interval=None
+    )
+    with pool:
+        results = pool.map([["sh", "-c", f"sleep 0.3; echo {i}"] for i in range(6)])
+        assert [r.stdout for r in results] == [f"{i}\n" for i in range(6)]
+        assert len(pool) > 1
+        assert pool.check() == []
+        assert len(pool) == 1
+
+
+def test_pool_health(fake_apptainer):
+    with pytainer.InstancePool("fake.sif", min_size=1, health_interval=None) as pool:
+        dead = pool.members[0].name
+        os.remove(os.path.join(os.environ["FAKE_APPTAINER_INSTANCES"], dead))
+        # The command is retried on a new instance
+        assert pool.exec("echo retried").stdout == "retried\n"
+        assert pool.members[0].name != dead
+
+        dead = pool.members[0].name
+        os.remove(os.path.join(os.environ["FAKE_APPTAINER_INSTANCES"], dead))
+        assert pool.check() == [dead]
+        assert pool.exec("true").has_succeeded()
+        assert len(pool) == 1
+
+
+def test_pool_check_busy(monkeypatch):
+    backend = FakeBackend()
+    pool = pytainer.InstancePool(
+        "fake.sif", min_size=1, idle_timeout=0, health_interval=None, backend=backend
+    )
+    with pool:
+        pool.resize(min_size=3)
+        pool.check()
+        while len(pool) < 3:
+            time.sleep(0.01)
+        pool.resize(min_size=1)
+        dead, *idle = pool.members
+        name = dead.name
+        del backend.instances[name]
+        replace = pool._replace
+
+        def acquire_and_replace(member):
+            # The idle members get busy between the two checks
+            with pool._lock:
+                for busy in idle:
+                    busy.load += 1
+            replace(member)
+
+        monkeypatch.setattr(pool, "_replace", acquire_and_replace)
+        assert pool.check() == [name]
+        assert all(member in pool.members and not member.dead for member in idle)
+        assert all(member.name in backend.instances for member in idle)
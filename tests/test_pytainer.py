@@ -1,5 +1,9 @@
+import asyncio
+import pytest
 import pytainer
 import os
+import shutil
+import time
 import io
 
 ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -8,6 +12,13 @@ ALPINE_APPTAINER_REMOTE_IMAGE = "library://alpine:latest"
 ALPINE_APPTAINER_DEFINITION = os.path.join(ROOT_PATH, "alpine.def")
 ALPINE_APPTAINER_IMAGE = os.path.join(ROOT_PATH, "alpine.sif")
 
+# Without apptainer, the tests that need it run on the fake backend
+BACKEND = None
+if shutil.which("apptainer") is None:
+    BACKEND = pytainer.FakeBackend(
+        commands={"unkown": lambda args: (127, "", "unkown: command not found\n")}
+    )
+
 
 def clean_env():
     if os.path.exists(ALPINE_APPTAINER_IMAGE):
@@ -17,7 +28,7 @@ def clean_env():
 # Test for the build method
 def test_build():
     clean_env()
-    pytnr = pytainer.Pytainer()
+    pytnr = pytainer.Pytainer(backend=BACKEND)
     result = pytnr.build(ALPINE_APPTAINER_DEFINITION, ALPINE_APPTAINER_IMAGE)
     assert result.returncode == 0
 
@@ -25,32 +36,32 @@ def test_build():
 # Test for the pull method
 def test_pull():
     clean_env()
-    pytnr = pytainer.Pytainer()
+    pytnr = pytainer.Pytainer(backend=BACKEND)
     result = pytnr.pull(ALPINE_APPTAINER_REMOTE_IMAGE, ALPINE_APPTAINER_IMAGE)
     assert result.returncode == 0
 
 
 def test_exec_success():
-    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE)
+    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE, backend=BACKEND)
     result = pytnr.exec("ls /")
     assert result.returncode == 0
 
 
 def test_exec_failure():
-    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE)
+    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE, backend=BACKEND)
     result = pytnr.exec("unkown command")
     assert result.returncode != 0
 
 
 # Test for the exec method
 def test_exec():
-    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE)
+    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE, backend=BACKEND)
     result = pytnr.exec("ls /")
     assert result.returncode == 0
 
 
 def test_inspect():
-    pytnr = pytainer.Pytainer(ALPINE_APPTAINER_IMAGE)
+    pytnr = pytainer.Pytainer(ALPINE_APPTAINER_IMAGE, backend=BACKEND)
     options = pytainer.PytainerOptionsInspect()
     options.all()
     result = pytnr.inspect(options=options)
@@ -59,7 +70,7 @@ def test_inspect():
 
 # Test for the run method
 def test_run():
-    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE)
+    pytnr = pytainer.Pytainer(ALPINE_DOCKER_REMOTE_IMAGE, backend=BACKEND)
     result = pytnr.run('echo "Hello from container"')
     assert result.returncode == 0
 
@@ -90,6 +101,265 @@ def test_pytainer_option_pull():
     assert _repr == "PytainerOptionsPull(--force --disable-cache)"
 
 
+def test_exec_async(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+
+    async def main():
+        return await asyncio.gather(
+            pytnr.exec_async("echo 1"),
+            pytnr.exec_async("echo 2"),
+            pytnr.run_async("false"),
+        )
+
+    first, second, third = asyncio.run(main())
+    assert first.returncode == 0 and first.stdout == "1\n"
+    assert second.returncode == 0 and second.stdout == "2\n"
+    assert third.has_failed()
+
+
+def test_build_async(fake_apptainer, tmp_path):
+    image = str(tmp_path / "alpine.sif")
+    pytnr = pytainer.Pytainer(image)
+    result = asyncio.run(pytnr.build_async(ALPINE_APPTAINER_DEFINITION, image))
+    assert result.returncode == 0
+    assert os.path.exists(image)
+    result = asyncio.run(pytnr.inspect_async())
+    assert result.returncode == 0
+
+
+@pytest.mark.parametrize("single_flight", [True, False])
+def test_pull_async_concurrency(tmp_path, single_flight):
+    # Pulls run in the event loop, they are not limited by the default executor
+    backend = pytainer.FakeBackend(latency={"pull": 0.5})
+    pytnr = pytainer.Pytainer(single_flight=single_flight, backend=backend)
+
+    async def main():
+        return await asyncio.gather(
+            *(
+                pytnr.pull_async("docker://alpine", str(tmp_path / f"{i}.sif"))
+                for i in range(128)
+            )
+        )
+
+    start = time.monotonic()
+    assert [result.returncode for result in asyncio.run(main())] == [0] * 128
+    assert time.monotonic() - start < 1.5
+
+
+def test_pull_async_single_flight(tmp_path):
+    backend = pytainer.FakeBackend(latency={"pull": 0.2})
+    pytnr = pytainer.Pytainer(str(tmp_path / "alpine.sif"), backend=backend)
+    options = pytainer.PytainerOptionsPull().with_force()
+
+    async def main():
+        # A cancelled pull does not keep the lock file of the image
+        task = asyncio.ensure_future(pytnr.pull_async("docker://alpine", None, options))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        pulls = (pytnr.pull_async("docker://alpine", None, options) for _ in range(8))
+        return await asyncio.wait_for(asyncio.gather(*pulls), timeout=5)
+
+    assert [result.returncode for result in asyncio.run(main())] == [0] * 8
+    # The identical concurrent pulls shared a single command
+    assert backend.stats()["calls"]["pull"] == 2
+
+
+def test_map(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    commands = [f"echo {i}" for i in range(8)]
+    results = list(pytnr.map(commands, max_workers=4))
+    assert [r.stdout for r in results] == [f"{i}\n" for i in range(8)]
+    results = list(pytnr.map(commands, max_workers=4, ordered=False))
+    assert sorted(r.stdout for r in results) == sorted(f"{i}\n" for i in range(8))
+
+
+def test_map_failures(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    commands = ["true", "false", "echo ok", "false"]
+    try:
+        list(pytnr.map(commands, check=True))
+    except pytainer.PytainerBatchError as e:
+        assert [index for index, _ in e.failures] == [1, 3]
+        assert e.total == 4
+    else:
+        assert False, "PytainerBatchError not raised"
+
+
+def test_instance(fake_apptainer):
+    with pytainer.Pytainer("fake.sif") as pytnr:
+        assert pytnr.instance is not None
+        result = pytnr.exec("echo hello")
+        assert result.returncode == 0
+        assert f"instance://{pytnr.instance}" in result.get_command()
+        name = pytnr.instance
+    assert pytnr.instance is None
+    result = pytnr.exec("echo hello")
+    assert f"instance://{name}" not in result.get_command()
+    assert pytnr.instance_stop() is None
+
+
+def test_exec_stream(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    output = io.StringIO()
+    with pytnr.exec_stream("seq 1 5", tee=output) as stream:
+        lines = list(stream)
+    assert lines == [f"{i}\n" for i in range(1, 6)]
+    assert output.getvalue() == "1\n2\n3\n4\n5\n"
+    assert stream.returncode == 0
+
+    stream = pytnr.exec_stream("head -c 10000 /dev/zero", binary=True, chunk_size=512)
+    chunks = list(stream)
+    assert all(len(chunk) <= 512 for chunk in chunks)
+    assert sum(len(chunk) for chunk in chunks) == 10000
+
+    stream = pytnr.exec_stream("ls /nonexistent")
+    assert stream.has_failed()
+    assert stream.stderr_tail
+
+
+def test_exec_stream_async(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+
+    async def main():
+        lines = []
+        async with pytnr.exec_stream_async("seq 1 3") as stream:
+            async for line in stream:
+                lines.append(line)
+        return lines, stream.returncode
+
+    assert asyncio.run(main()) == (["1\n", "2\n", "3\n"], 0)
+
+
+def test_exec_stream_async_long_lines(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    command = ["sh", "-c", "head -c 200000 /dev/zero | tr '\\0' a; echo; echo b >&2"]
+
+    async def main():
+        async with pytnr.exec_stream_async(command) as stream:
+            lines = [line async for line in stream]
+        return lines, list(stream.stderr_tail), stream.returncode
+
+    lines, stderr, returncode = asyncio.run(main())
+    assert lines == ["a" * 200000 + "\n"]
+    assert (stderr, returncode) == (["b\n"], 0)
+
+
+def test_pytainer_option_argv():
+    options = pytainer.PytainerOptionsExec()
+    options.env("GREETING", "hello world; $HOME")
+    options.bind("/data")
+    options.add("--workdir /tmp")
+    assert options.to_argv() == [
+        "--env",
+        "GREETING=hello world; $HOME",
+        "-B",
+        "/data:/data:rw",
+        "--workdir",
+        "/tmp",
+    ]
+    options.remove("--workdir", "/tmp")
+    fmt = options.to_string()
+    assert fmt == "--env 'GREETING=hello world; $HOME' -B /data:/data:rw"
+
+
+def test_exec_argv(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    result = pytnr.exec(["printf", "%s|", "a b", "$HOME"])
+    assert result.stdout == "a b|$HOME|"
+    result = pytnr.exec("printf '%s|' 'a b' c")
+    assert result.stdout == "a b|c|"
+
+
+def test_plan_launch(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    plan = pytnr.plan_exec("echo planned")
+    assert not os.path.exists(fake_apptainer)
+    futures = [plan.launch() for _ in range(3)]
+    for future in futures:
+        assert future.wait(timeout=30)
+        assert future.done()
+        assert future.result().stdout == "planned\n"
+    assert plan.run().stdout == "planned\n"
+
+
+def test_plan_cancel(fake_apptainer):
+    import concurrent.futures
+
+    pytnr = pytainer.Pytainer("fake.sif")
+    future = pytnr.plan_exec("sleep 30").launch()
+    try:
+        future.result(timeout=0.01)
+    except TimeoutError:
+        pass
+    else:
+        assert False, "TimeoutError not raised"
+    assert future.cancel()
+    assert future.wait(timeout=30)
+    assert future.cancelled()
+    assert not future.cancel()
+    try:
+        future.result()
+    except concurrent.futures.CancelledError:
+        pass
+    else:
+        assert False, "CancelledError not raised"
+
+
+def test_pytainer_option_frozen():
+    options = pytainer.PytainerOptionsExec()
+    options.cleanenv()
+    frozen = options.freeze()
+    assert frozen.frozen and frozen.freeze() is frozen
+    options.workdir("/tmp")
+    assert frozen.to_argv() == ["--cleanenv"]
+    try:
+        frozen.workdir("/tmp")
+    except TypeError:
+        pass
+    else:
+        assert False, "frozen options were modified"
+
+    derived = frozen.with_bind("/data").with_env("A", "1")
+    assert derived.frozen
+    assert derived.to_argv() == ["--cleanenv", "-B", "/data:/data:rw", "--env", "A=1"]
+    assert frozen.to_argv() == ["--cleanenv"]
+    assert derived == frozen.with_bind("/data").with_env("A", "1")
+    assert len({derived, frozen.with_bind("/data").with_env("A", "1"), frozen}) == 2
+    assert derived != pytainer.PytainerOptionsRun().with_cleanenv()
+    try:
+        hash(options)
+    except TypeError:
+        pass
+    else:
+        assert False, "mutable options are hashable"
+    assert not hasattr(frozen, "__dict__")
+
+
+def test_capture(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    result = pytnr.exec("printf 'a\r\nb'")
+    assert isinstance(result._stdout, bytes)
+    assert result.stdout == "a\nb" and result.stdout is result.stdout
+    assert result.result is result and result.args[:2] == ["apptainer", "exec"]
+
+    pytnr.capture = pytainer.CaptureOptions(text=False)
+    assert pytnr.exec("printf 'a\r\nb'").stdout == b"a\r\nb"
+
+    pytnr.capture = pytainer.CaptureOptions(stdout=False, limit=4)
+    command = "echo 0123456789; echo 0123456789 >&2; exit 3"
+    for result in (
+        pytnr.exec(["sh", "-c", command]),
+        pytnr.plan_exec(["sh", "-c", command]).launch().result(timeout=30),
+        asyncio.run(pytnr.exec_async(["sh", "-c", command])),
+    ):
+        assert result.returncode == 3
+        assert result.stdout is None
+        assert result.stderr == "0123"
+    # Only the output of exec and run is affected
+    assert len(pytnr.inspect().stderr) > 4
+
+
 if __name__ == "__main__":
     test_build()
     test_pull()
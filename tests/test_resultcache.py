@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+
+import pytainer
+
+from .conftest import exec_count
+
+
+def test_result_cache(fake_apptainer, tmp_path, monkeypatch):
+    image = tmp_path / "image.sif"
+    image.write_text("image")
+    cache = pytainer.ResultCache(max_entries=2, cache_dir=str(tmp_path / "cache"))
+    pytnr = pytainer.Pytainer(str(image), result_cache=cache)
+
+    first = pytnr.exec(["sh", "-c", "echo $$"])
+    assert pytnr.exec(["sh", "-c", "echo $$"]).stdout == first.stdout
+    assert exec_count(fake_apptainer) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+    # Options, environment and failures are not shared
+    cleanenv = pytainer.PytainerOptionsExec().with_cleanenv()
+    pytnr.exec(["sh", "-c", "echo $$"], cleanenv)
+    monkeypatch.setenv("PYTAINER_TEST", "1")
+    pytnr.exec(["sh", "-c", "echo $$"])
+    pytnr.exec("false")
+    pytnr.exec("false")
+    assert exec_count(fake_apptainer) == 5
+
+    # Entries evicted from memory are found on disk, also by other processes
+    other_cache = pytainer.ResultCache(cache_dir=str(tmp_path / "cache"))
+    other = pytainer.Pytainer(str(image), result_cache=other_cache)
+    monkeypatch.delenv("PYTAINER_TEST")
+    assert other.exec(["sh", "-c", "echo $$"]).stdout == first.stdout
+    assert exec_count(fake_apptainer) == 5
+
+    # A modified image is a different image
+    image.write_text("modified image")
+    assert pytnr.exec(["sh", "-c", "echo $$"]).stdout != first.stdout
+
+
+def test_result_cache_ttl_and_coalescing(fake_apptainer, tmp_path):
+    image = tmp_path / "image.sif"
+    image.write_text("image")
+    cache = pytainer.ResultCache(ttl=0.5)
+    pytnr = pytainer.Pytainer(str(image), result_cache=cache)
+    command = ["sh", "-c", "sleep 0.2; echo $$"]
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(pytnr.exec(command)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({result.stdout for result in results}) == 1
+    assert exec_count(fake_apptainer) == 1
+    time.sleep(0.6)
+    assert pytnr.exec(command).stdout != results[0].stdout
+    assert exec_count(fake_apptainer) == 2
+
+
+def test_result_cache_disk_eviction(tmp_path, monkeypatch):
+    image = tmp_path / "image.sif"
+    image.write_text("image")
+    cache_dir = tmp_path / "cache"
+    cache = pytainer.ResultCache(cache_dir=str(cache_dir), max_disk_entries=100)
+    backend = pytainer.FakeBackend()
+    pytnr = pytainer.Pytainer(str(image), result_cache=cache, backend=backend)
+    listdir = os.listdir
+    listings = []
+
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+
+    monkeypatch.setattr(os, "listdir", counting_listdir)
+    commands = [f"echo {i}" for i in range(250)]
+    assert [r.stdout for r in pytnr.map(commands)] == [f"{i}\n" for i in range(250)]
+    # The directory is not listed on every write, only to trim it
+    assert len(listings) <= 20
+    assert len(listdir(cache_dir)) <= 100
+
+    # map goes through the cache
+    list(pytnr.map(commands[-5:]))
+    assert backend.stats()["calls"]["exec"] == 250
+
+
+def test_result_cache_key_payload_options(tmp_path, monkeypatch):
+    image = tmp_path / "image.sif"
+    image.write_text("image")
+    cache = pytainer.ResultCache()
+    pytnr = pytainer.Pytainer(str(image), result_cache=cache)
+    cleanenv = pytainer.PytainerOptionsExec().with_cleanenv()
+
+    def keys(command):
+        plans = [pytnr.plan_exec(command), pytnr.plan_exec(command, cleanenv)]
+        monkeypatch.setenv("PYTAINER_TEST", "1")
+        first = [cache.key(plan, str(image)) for plan in plans]
+        monkeypatch.setenv("PYTAINER_TEST", "2")
+        return first, [cache.key(plan, str(image)) for plan in plans]
+
+    # -C and -e of the command run in the container are not apptainer options
+    for command in ("make -C /src", "grep -e x /etc/hosts"):
+        (env_1, clean_1), (env_2, clean_2) = keys(command)
+        assert env_1 != env_2
+        assert clean_1 == clean_2
+
+    # A modified image replaces the memoized digest of the previous version
+    for content in ("v1", "version 2", "v3"):
+        image.write_text(content)
+        cache.image_digest(str(image))
+    assert len(cache._digests) == 1
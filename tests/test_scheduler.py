@@ -0,0 +1,98 @@
+import json
+import threading
+
+import pytest
+
+import pytainer
+from pytainer.scheduler import (
+    ResourceScheduler,
+    Topology,
+    format_cpu_list,
+    parse_cpu_list,
+    parse_size,
+)
+
+
+def test_parse():
+    assert parse_size("2g") == 2 << 30
+    assert parse_size("512M") == 512 << 20
+    assert parse_size(1024) == 1024
+    assert parse_cpu_list("0-3,8") == {0, 1, 2, 3, 8}
+    assert format_cpu_list({0, 1, 2, 3, 8, 10, 11}) == "0-3,8,10-11"
+
+
+def test_topology():
+    nodes = {0: [0, 1, 2], 1: [3, 4, 5, 6]}
+    topology = Topology(cpus=range(6), nodes=nodes, memory="1g")
+    assert topology.nodes == {0: [0, 1, 2], 1: [3, 4, 5]}
+    assert topology.node_of(4) == 1
+    assert topology.memory == 1 << 30
+
+
+def cpusets(log):
+    cpusets = []
+    for line in log.read_text().splitlines():
+        argv = json.loads(line)
+        cpusets.append(argv[argv.index("--cpuset-cpus") + 1])
+    return cpusets
+
+
+def test_scheduler(fake_apptainer):
+    scheduler = ResourceScheduler(
+        pytainer.Pytainer("fake.sif"), cpus=range(4), memory="1g"
+    )
+    scheduler.topology.nodes = {0: [0, 1], 1: [2, 3]}
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    options = pytainer.PytainerOptionsExec().with_cpus(2)
+    with scheduler:
+        futures = [
+            scheduler.submit_exec(["sh", "-c", f"sleep 0.2; echo {i}"], options)
+            for i in range(5)
+        ]
+        with lock:
+            running.append(scheduler.stats()["running"])
+            peak.append(scheduler.stats()["queued"])
+    assert [future.result().stdout for future in futures] == [
+        f"{i}\n" for i in range(5)
+    ]
+    assert running == [2] and peak == [3]
+    assert set(cpusets(fake_apptainer)) == {"0-1", "2-3"}
+    assert scheduler.stats() == {
+        "running": 0,
+        "queued": 0,
+        "free_cpus": 4,
+        "free_memory": 1 << 30,
+    }
+    with pytest.raises(RuntimeError):
+        scheduler.submit_exec("true")
+
+
+def test_scheduler_memory_and_bypass(fake_apptainer):
+    scheduler = ResourceScheduler(
+        pytainer.Pytainer("fake.sif"), cpus=range(2), memory="1g", max_bypass=1
+    )
+    big = pytainer.PytainerOptionsExec().with_memory("1g")
+    first = scheduler.submit_exec(["sleep", "0.2"], cpus=1, memory="512m")
+    blocked = scheduler.submit_exec("true", big)
+    assert scheduler.stats()["queued"] == 1
+    # Overtakes the blocked job, which cannot be bypassed any more
+    second = scheduler.submit_exec("true", cpus=1)
+    third = scheduler.submit_exec("true", cpus=1)
+    assert scheduler.stats()["queued"] == 2
+    scheduler.shutdown()
+    for future in (first, blocked, second, third):
+        assert future.result().has_succeeded()
+    with pytest.raises(ValueError):
+        scheduler.submit_exec("true", cpus=3)
+
+
+def test_scheduler_pinned(fake_apptainer):
+    scheduler = ResourceScheduler(pytainer.Pytainer("fake.sif"), cpus=range(4))
+    options = pytainer.PytainerOptionsExec().with_cpuset_cpus("1-2")
+    assert scheduler.submit_exec("true", options).result().has_succeeded()
+    assert cpusets(fake_apptainer) == ["1-2"]
+    with pytest.raises(ValueError):
+        scheduler.submit_exec("true", options.with_cpuset_cpus("1-9"))
@@ -0,0 +1,135 @@
+import json
+import uuid
+
+import pytest
+
+import pytainer
+from pytainer import sif
+
+IMAGE_ID = uuid.UUID("12345678-1234-5678-1234-567812345678")
+DESCRIPTORS_OFFSET = 4096
+
+
+def make_sif(path, objects, descriptors_total=8):
+    """
+    Write a SIF image holding `objects`, a list of (datatype, data, extra)
+    tuples, following the layout of the SIF specification.
+    """
+    data_offset = DESCRIPTORS_OFFSET + descriptors_total * sif.DESCRIPTOR.size
+    descriptors = b""
+    data = b""
+    for index, (datatype, payload, extra) in enumerate(objects):
+        descriptors += sif.DESCRIPTOR.pack(
+            datatype,
+            1,
+            index + 1,
+            sif.GROUP_MASK | 1,
+            0,
+            data_offset + len(data),
+            len(payload),
+            len(payload),
+            1700000000,
+            1700000000,
+            0,
+            0,
+            f"object-{index}".encode(),
+            extra,
+        )
+        data += payload
+    header = sif.HEADER.pack(
+        b"#!/usr/bin/env run-singularity\n",
+        sif.SIF_MAGIC,
+        b"01\0",
+        b"02\0",
+        IMAGE_ID.bytes,
+        1700000000,
+        1700000001,
+        descriptors_total - len(objects),
+        descriptors_total,
+        DESCRIPTORS_OFFSET,
+        descriptors_total * sif.DESCRIPTOR.size,
+        data_offset,
+        len(data),
+    )
+    with open(path, "wb") as fo:
+        fo.write(header.ljust(DESCRIPTORS_OFFSET, b"\0"))
+        fo.write(descriptors.ljust(descriptors_total * sif.DESCRIPTOR.size, b"\0"))
+        fo.write(data)
+
+
+DEFFILE = b"Bootstrap: docker\nFrom: alpine:latest\n"
+INSPECT_METADATA = {
+    "data": {
+        "attributes": {
+            "labels": {"org.label-schema.build-date": "Friday_1_March_2024"},
+            "deffile": DEFFILE.decode(),
+            "runscript": "#!/bin/sh\nexec /bin/sh\n",
+        }
+    },
+    "type": "container",
+}
+SQUASHFS = b"hsqs" + b"\0" * 1020
+
+
+@pytest.fixture
+def sif_image(tmp_path):
+    path = tmp_path / "alpine.sif"
+    make_sif(
+        path,
+        [
+            (sif.DATA_DEFFILE, DEFFILE, b""),
+            (sif.DATA_GENERIC_JSON, json.dumps(INSPECT_METADATA).encode(), b""),
+            (sif.DATA_PARTITION, SQUASHFS, sif.PARTITION.pack(1, 2, b"02\0")),
+        ],
+    )
+    return str(path)
+
+
+def test_sif_header(sif_image):
+    with pytainer.SIFImage(sif_image) as image:
+        assert image.id == IMAGE_ID
+        assert image.arch == "amd64"
+        assert image.version == "01"
+        assert len(image.descriptors) == 3
+        assert image.deffile() == DEFFILE.decode()
+        ((descriptor, partition),) = image.partitions()
+        assert partition == pytainer.SIFPartition("Squashfs", "*System", "amd64")
+        assert descriptor.group_id == 1
+        assert descriptor.size == len(SQUASHFS)
+        view = image.data(descriptor)
+        assert view[:4] == b"hsqs"
+        view.release()
+
+
+def test_sif_metadata(fake_apptainer, sif_image):
+    pytnr = pytainer.Pytainer(sif_image, metadata_cache=pytainer.MetadataCache())
+    metadata = pytnr.metadata()
+    assert metadata.build_date == "Friday_1_March_2024"
+    assert metadata.deffile == DEFFILE.decode()
+    assert not fake_apptainer.exists()
+
+
+def test_sif_legacy_objects(tmp_path):
+    path = tmp_path / "legacy.sif"
+    labels = {"maintainer": "pytainer"}
+    make_sif(
+        path,
+        [
+            (sif.DATA_LABELS, json.dumps(labels).encode(), b""),
+            (sif.DATA_ENVVAR, b"export LC_ALL=C\n", b""),
+        ],
+    )
+    with pytainer.SIFImage(str(path)) as image:
+        assert image.labels() == labels
+        assert image.metadata(complete=True) is None
+        metadata = image.metadata()
+    assert metadata.labels == labels
+    assert metadata.environment == {"": "export LC_ALL=C\n"}
+
+
+def test_not_sif(tmp_path):
+    path = tmp_path / "image.sif"
+    path.write_text("not a sif image")
+    assert not sif.is_sif(str(path))
+    with pytest.raises(ValueError):
+        pytainer.SIFImage(str(path))
@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+import threading
+
+import pytainer
+
+
+def pull(save_path, barrier=None):
+    if barrier is not None:
+        barrier.wait()
+    pytnr = pytainer.Pytainer()
+    return pytnr.pull("docker://alpine:latest", save_path).returncode
+
+
+def count_pulls(log):
+    return sum('"pull"' in line for line in log.read_text().splitlines())
+
+
+def test_single_flight_threads(fake_apptainer, tmp_path):
+    save_path = str(tmp_path / "alpine.sif")
+    barrier = threading.Barrier(8)
+    returncodes = []
+    threads = [
+        threading.Thread(target=lambda: returncodes.append(pull(save_path, barrier)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert returncodes == [0] * 8
+    assert count_pulls(fake_apptainer) == 1
+    assert sorted(os.listdir(tmp_path)) == ["alpine.sif", "apptainer.log", "bin"]
+
+
+def test_single_flight_processes(fake_apptainer, tmp_path):
+    save_path = str(tmp_path / "alpine.sif")
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(4)
+    processes = [
+        context.Process(target=lambda: exit(pull(save_path, barrier)))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * 4
+    assert count_pulls(fake_apptainer) == 1
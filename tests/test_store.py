@@ -0,0 +1,55 @@
+import os
+
+import pytainer
+
+
+def test_store_pull_dedup(fake_apptainer, tmp_path):
+    store = pytainer.ImageStore(tmp_path / "store")
+    pytnr = pytainer.Pytainer(store=store)
+    first = tmp_path / "first.sif"
+    second = tmp_path / "second.sif"
+    assert pytnr.pull("docker://alpine:latest", str(first)).returncode == 0
+    assert pytnr.pull("docker://alpine:latest", str(second)).returncode == 0
+    assert first.read_text() == second.read_text() == "SIF:docker://alpine:latest\n"
+    assert os.path.samefile(first, second)
+    pulls = [line for line in fake_apptainer.read_text().splitlines() if "pull" in line]
+    assert len(pulls) == 1
+
+    result = pytnr.pull("docker://alpine:latest", str(second))
+    assert result.has_failed()
+    options = pytainer.PytainerOptionsPull()
+    options.force()
+    assert pytnr.pull("docker://alpine:latest", str(second), options).returncode == 0
+    assert len(store.entries()) == 1
+
+
+def test_store_lru(fake_apptainer, tmp_path):
+    image_size = len("SIF:docker://alpine:3.X\n")
+    store = pytainer.ImageStore(
+        tmp_path / "store", max_size=2 * image_size, link="copy"
+    )
+    pytnr = pytainer.Pytainer(store=store)
+    for version in range(3):
+        uri = f"docker://alpine:3.{version}"
+        assert pytnr.pull(uri, str(tmp_path / f"{version}.sif")).returncode == 0
+    assert store.size() == 2 * image_size
+    assert store.get("docker://alpine:3.0") is None
+    assert store.get("docker://alpine:3.2") is not None
+
+
+def test_store_lru_links(fake_apptainer, tmp_path):
+    image_size = len("SIF:docker://alpine:3.X\n")
+    for link in ("symlink", "hardlink"):
+        root = tmp_path / link
+        store = pytainer.ImageStore(root / "store", max_size=image_size, link=link)
+        pytnr = pytainer.Pytainer(store=store)
+        for version in range(2):
+            uri = f"docker://alpine:3.{version}"
+            assert pytnr.pull(uri, str(root / f"{version}.sif")).returncode == 0
+        assert (root / "0.sif").read_text() == "SIF:docker://alpine:3.0\n"
+        assert store.size() == 2 * image_size
+
+        os.remove(root / "0.sif")
+        assert pytnr.pull("docker://alpine:3.2", str(root / "2.sif")).returncode == 0
+        assert store.get("docker://alpine:3.0") is None
+        assert store.size() == 2 * image_size
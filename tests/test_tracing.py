@@ -0,0 +1,51 @@
+import asyncio
+import warnings
+
+import pytainer
+from pytainer import tracing
+
+PHASES = ["options", "assembly", "spawn", "first_output", "exit", "decode"]
+
+
+def test_trace_exec(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    with tracing.collect() as records:
+        result = pytnr.exec("echo traced")
+    assert result.stdout == "traced\n"
+    assert len(records) == 1
+    record = records[0]
+    assert record.subcommand == "exec"
+    assert record.image == "fake.sif"
+    assert record.returncode == 0
+    assert list(record.phases) == PHASES
+    assert all(value >= 0 for value in record.phases.values())
+    assert record.duration == sum(record.phases.values())
+    assert not tracing.enabled()
+
+
+def test_trace_launch_stream_async(fake_apptainer):
+    pytnr = pytainer.Pytainer("fake.sif")
+    with tracing.collect() as records:
+        assert pytnr.plan_exec("false").launch().result(timeout=30).returncode == 1
+        with pytnr.exec_stream("echo streamed") as stream:
+            assert list(stream) == ["streamed\n"]
+        asyncio.run(pytnr.exec_async("echo async"))
+    assert [record.returncode for record in records] == [1, 0, 0]
+    assert "first_output" not in records[0].phases
+    assert list(records[1].phases) == PHASES[:-1]
+    assert list(records[2].phases) == PHASES
+
+
+def test_trace_hook_failure(fake_apptainer):
+    def hook(record):
+        raise ValueError("broken hook")
+
+    tracing.add_hook(hook)
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            result = pytainer.Pytainer("fake.sif").exec("true")
+    finally:
+        tracing.remove_hook(hook)
+    assert result.has_succeeded()
+    assert "broken hook" in str(caught[0].message)